@@ -0,0 +1,185 @@
+"""
+Aconex 异步客户端
+
+- 所有请求共用一个 aiohttp.ClientSession（单一连接池，复用 TLS 连接）
+- 同时在途的请求数由 AdaptiveLimiter 按 429/503 和延迟自适应调整（上限 config.max_in_flight）
+- 同步代码通过 run_sync() 把协程投递到后台事件循环线程执行，不再需要为每个请求开线程
+- 资源 API 的 Authorization 头由 TokenManager 统一添加，401 时单次刷新 token 后重发
+- 每次尝试记录到 METRICS（接口、状态码、重试、字节数、延迟）
+- stream() 把响应体分块交给调用方写入（附件下载），不在内存中保留整个响应体；名额只占用到响应头
+"""
+import asyncio
+import threading
+import time
+from typing import Any, Awaitable, Callable, Optional, TypeVar, Union
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from adaptive_limiter import AdaptiveLimiter, RETRY_STATUS, retryDelay
+from config import config
+from metrics import METRICS
+from token_manager import TokenManager, needs_bearer
+
+T = TypeVar("T")
+
+# 未拿到完整响应的连接级错误，与 429/5xx 一样按 config.retry_times 重试
+CONNECTION_ERRORS = (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError)
+
+_LOOP: Optional[asyncio.AbstractEventLoop] = None
+_LOOP_LOCK = threading.Lock()
+
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    """获取（必要时启动）后台事件循环线程"""
+    global _LOOP
+    with _LOOP_LOCK:
+        if _LOOP is None or _LOOP.is_closed():
+            _LOOP = asyncio.new_event_loop()
+            threading.Thread(target=_LOOP.run_forever, name="aconex-async-loop", daemon=True).start()
+    return _LOOP
+
+
+async def _fetchStage(coro: Awaitable[T]) -> T:
+    # 在事件循环线程上进入 fetch 阶段（--profile 时由此在该线程启用 profile）
+    with METRICS.stage("fetch"):
+        return await coro
+
+
+def run_sync(coro: Awaitable[T]) -> T:
+    """在后台事件循环中执行协程并阻塞等待结果，供同步函数做薄包装"""
+    return asyncio.run_coroutine_threadsafe(_fetchStage(coro), get_loop()).result()
+
+
+class AsyncAconexClient:
+    """共享连接池 + 自适应在途请求上限的 Aconex HTTP 客户端"""
+
+    def __init__(self, max_in_flight: Optional[int] = None, token_manager: Optional[TokenManager] = None,
+                 limiter: Optional[AdaptiveLimiter] = None):
+        self.max_in_flight = max_in_flight or config.max_in_flight
+        self.token_manager = token_manager
+        self.limiter = limiter or AdaptiveLimiter(max_limit=self.max_in_flight)
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _ensure_session(self) -> aiohttp.ClientSession:
+        # session 与创建它的事件循环绑定，循环变化时重建
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._loop is not loop:
+            # stream() 传输响应体时不占用限流名额，连接池为同时下载的分段预留连接，避免请求排队等连接而被误判为拥塞
+            pool_size = self.max_in_flight + config.download_concurrent_files * config.download_split
+            connector = aiohttp.TCPConnector(limit=pool_size, limit_per_host=pool_size)
+            self._session = aiohttp.ClientSession(connector=connector)
+            self._loop = loop
+        return self._session
+
+    @staticmethod
+    def _proxy_for(url: str) -> Optional[str]:
+        if not config.proxies:
+            return None
+        return config.proxies.get(urlsplit(url).scheme)
+
+    async def _auth_headers(self, url: str, headers: Optional[dict]) -> Optional[dict]:
+        if self.token_manager is None or not needs_bearer(url):
+            return headers
+        return {**(headers or {}), "Authorization": f"Bearer {await self.token_manager.get_token_async()}"}
+
+    async def request(self, method: str, url: str, headers: Optional[dict] = None, **kwargs: Any) -> bytes:
+        """
+        发送请求并返回响应体；429/5xx 和连接中断 / 超时按 config.retry_times / retry_delay 指数退避重试
+
+        每次尝试单独占用限流名额并记录延迟 / 状态码，退避等待期间不占用名额
+        """
+        return await self._send(method, url, headers, None, **kwargs)
+
+    async def stream(self, url: str, on_response: Callable[[aiohttp.ClientResponse], Callable[[bytes], Any]],
+                     headers: Optional[dict] = None, **kwargs: Any) -> int:
+        """
+        GET 并把响应体分块（config.download_chunk_size）交给 on_response(response) 返回的写入函数，返回写入的字节数
+
+        重试和 token 处理与 request() 相同（只针对开始写入之前的失败）；传输中断的异常直接抛出，由调用方从断点续传。
+        限流名额只占用到响应头（记录的延迟也只计到响应头），传输响应体时不占用名额，大文件不会挤占元数据请求；
+        写入函数在线程池中逐块顺序调用
+        """
+        kwargs.setdefault("timeout", aiohttp.ClientTimeout(total=None, sock_connect=60, sock_read=60))
+        return await self._send("GET", url, headers, on_response, **kwargs)
+
+    async def _send(self, method: str, url: str, headers: Optional[dict],
+                    on_response: Optional[Callable[[aiohttp.ClientResponse], Callable[[bytes], Any]]],
+                    **kwargs: Any) -> Union[bytes, int]:
+        session = self._ensure_session()
+        token_retried = False
+        attempt = 0
+        while True:
+            req_headers = await self._auth_headers(url, headers)
+            retry_after = None
+            await self.limiter.acquire_async()
+            holding = True
+            start = time.monotonic()
+            latency = None
+            status = None
+            nbytes = 0
+            streaming = False
+            try:
+                async with session.request(method, url, headers=req_headers, proxy=self._proxy_for(url),
+                                           **kwargs) as response:
+                    status = response.status
+                    if status == 401 or (status in RETRY_STATUS and attempt < config.retry_times):
+                        retry_after = response.headers.get("Retry-After")
+                    else:
+                        response.raise_for_status()
+                        if on_response is None:
+                            body = await response.read()
+                            nbytes = len(body)
+                            return body
+                        # 响应头已到：记录延迟并归还限流名额，传输响应体期间不占用名额
+                        latency = time.monotonic() - start
+                        self.limiter.record(latency, status)
+                        self.limiter.release()
+                        holding = False
+                        streaming = True
+                        write = on_response(response)
+                        # 写磁盘在线程池中进行，不阻塞事件循环
+                        async for chunk in response.content.iter_chunked(config.download_chunk_size):
+                            await asyncio.to_thread(write, chunk)
+                            nbytes += len(chunk)
+                        return nbytes
+            except CONNECTION_ERRORS:
+                # 连接中断 / 超时（如复用的 keep-alive 连接已被服务器关闭）：按次数重试；
+                # 流式响应已开始写入时交给调用方从断点续传
+                if streaming or attempt >= config.retry_times:
+                    raise
+                status = None
+            finally:
+                if latency is None:
+                    latency = time.monotonic() - start
+                if holding:
+                    self.limiter.record(latency, status)
+                    self.limiter.release()
+                METRICS.observe_request(url, method, status, latency, nbytes, retry=attempt > 0 or token_retried)
+            if status == 401:
+                if req_headers is headers or token_retried:
+                    response.raise_for_status()
+                # token 失效：只刷新一次（其他协程已刷新时直接复用）
+                token_retried = True
+                stale = req_headers["Authorization"].removeprefix("Bearer ")
+                await asyncio.to_thread(self.token_manager.refresh, stale)
+                continue
+            await asyncio.sleep(retryDelay(attempt, retry_after))
+            attempt += 1
+
+    async def get(self, url: str, **kwargs: Any) -> bytes:
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url: str, **kwargs: Any) -> bytes:
+        return await self.request("POST", url, **kwargs)
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+
+def close_client(client: AsyncAconexClient):
+    """进程退出前关闭客户端连接池（仅在后台事件循环已启动时）"""
+    if _LOOP is not None and _LOOP.is_running():
+        run_sync(client.close())
@@ -0,0 +1,335 @@
+"""
+Aconex 查询结果的本地持久化缓存（SQLite）
+
+- mail_search: 以 (search_query, mail_box) 为键，保存解析后的 responseMailInfo 列表
+- 条目超过 TTL 视为失效；超过 max_entries 时按最近访问时间淘汰
+- mail_watermark: 增量同步模式下每个图号已见到的最新 SentDate；mail_watermark_result: 该图号去重择优后的邮件，
+  增量运行时与水位之后的新邮件合并，不必重新查询全部邮件
+- workflow_search: 以工作流编号为键，保存解析后的 WorkflowSearchResult；已结束的工作流永久保留
+- register_document / register_watermark: 登记册快照（按 search_query + document_id），以及已同步到的最新 DateModified
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import asdict
+from datetime import datetime
+from typing import Iterable, Iterator, Optional
+
+from config import config
+from dataclass import responseMailInfo, WorkflowSearchResult, Workflow, UserRef, DocumentInfo
+
+
+class SqliteStore:
+    """惰性打开的 SQLite 连接，跨线程共享，由一把锁串行化访问"""
+
+    SCHEMA: str = ""
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or config.cache_db_path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(self.SCHEMA)
+        return self._conn
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class MailSearchCache(SqliteStore):
+    """邮件搜索结果缓存"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS mail_search (
+            search_query TEXT NOT NULL,
+            mail_box     TEXT NOT NULL,
+            payload      TEXT NOT NULL,
+            created_at   REAL NOT NULL,
+            accessed_at  REAL NOT NULL,
+            PRIMARY KEY (search_query, mail_box)
+        );
+        CREATE INDEX IF NOT EXISTS idx_mail_search_accessed ON mail_search (accessed_at);
+    """
+
+    def __init__(self, path: Optional[str] = None, ttl: Optional[int] = None, max_entries: Optional[int] = None):
+        super().__init__(path)
+        self.ttl = config.mail_cache_ttl if ttl is None else ttl
+        self.max_entries = config.mail_cache_max_entries if max_entries is None else max_entries
+
+    @staticmethod
+    def _dumps(mails: list[responseMailInfo]) -> str:
+        return json.dumps([[_m.mailID, _m.MailNo, _m.SentDate.isoformat(), _m.subject, _m.AllAttachmentCount]
+                           for _m in mails], ensure_ascii=False)
+
+    @staticmethod
+    def _loads(payload: str) -> list[responseMailInfo]:
+        return [responseMailInfo(mailID=_id, MailNo=_no, SentDate=datetime.fromisoformat(_date), subject=_subject,
+                                 AllAttachmentCount=_count)
+                for _id, _no, _date, _subject, _count in json.loads(payload)]
+
+    def get(self, search_query: str, mail_box: str) -> Optional[list[responseMailInfo]]:
+        """命中且未过期时返回缓存的列表，否则返回 None；config.mail_cache_bypass 为 True 时总是 None"""
+        if config.mail_cache_bypass:
+            return None
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute("SELECT payload, created_at FROM mail_search WHERE search_query = ? AND mail_box = ?",
+                               (search_query, mail_box)).fetchone()
+            if row is None:
+                return None
+            if now - row[1] > self.ttl:
+                conn.execute("DELETE FROM mail_search WHERE search_query = ? AND mail_box = ?",
+                             (search_query, mail_box))
+                conn.commit()
+                return None
+            conn.execute("UPDATE mail_search SET accessed_at = ? WHERE search_query = ? AND mail_box = ?",
+                         (now, search_query, mail_box))
+            conn.commit()
+        return self._loads(row[0])
+
+    def put(self, search_query: str, mail_box: str, mails: list[responseMailInfo]):
+        """写入（覆盖）缓存，并淘汰超出 max_entries 的最久未访问条目"""
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute("INSERT OR REPLACE INTO mail_search VALUES (?, ?, ?, ?, ?)",
+                         (search_query, mail_box, self._dumps(mails), now, now))
+            conn.execute("DELETE FROM mail_search WHERE rowid IN "
+                         "(SELECT rowid FROM mail_search ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                         (self.max_entries,))
+            conn.commit()
+
+    def clear(self):
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM mail_search")
+            conn.commit()
+
+
+class SentDateWatermark(SqliteStore):
+    """增量同步水位：每个图号 (unit/step/discipline/drawing) 已见到的最新 SentDate，以及截至水位的邮件结果"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS mail_watermark (
+            drawing_key TEXT PRIMARY KEY,
+            sent_date   TEXT NOT NULL,
+            updated_at  REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS mail_watermark_result (
+            drawing_key TEXT PRIMARY KEY,
+            payload     TEXT NOT NULL,
+            updated_at  REAL NOT NULL
+        );
+    """
+
+    def get(self, drawing_key: str) -> Optional[datetime]:
+        with self._lock:
+            row = self._connect().execute("SELECT sent_date FROM mail_watermark WHERE drawing_key = ?",
+                                          (drawing_key,)).fetchone()
+        return datetime.fromisoformat(row[0]) if row else None
+
+    def mails(self, drawing_key: str) -> Optional[list[responseMailInfo]]:
+        """该图号截至水位的邮件结果（去重择优后）；没有记录时返回 None"""
+        with self._lock:
+            row = self._connect().execute("SELECT payload FROM mail_watermark_result WHERE drawing_key = ?",
+                                          (drawing_key,)).fetchone()
+        return MailSearchCache._loads(row[0]) if row else None
+
+    def update(self, watermarks: dict[str, datetime], results: Optional[dict[str, list[responseMailInfo]]] = None):
+        """批量写入水位（只会前移不会后退）和对应的邮件结果（覆盖）"""
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            for _key, _date in watermarks.items():
+                conn.execute("INSERT INTO mail_watermark VALUES (?, ?, ?) ON CONFLICT(drawing_key) DO UPDATE SET "
+                             "sent_date = MAX(sent_date, excluded.sent_date), updated_at = excluded.updated_at",
+                             (_key, _date.isoformat(), now))
+            conn.executemany("INSERT OR REPLACE INTO mail_watermark_result VALUES (?, ?, ?)",
+                             [(_key, MailSearchCache._dumps(_mails), now) for _key, _mails in (results or {}).items()])
+            conn.commit()
+
+
+class WorkflowCache(SqliteStore):
+    """工作流查询结果缓存：已结束（最终步骤已完成 / 已终止）的工作流永久有效，进行中的按 TTL 失效"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS workflow_search (
+            workflow_num TEXT PRIMARY KEY,
+            payload      TEXT NOT NULL,
+            terminal     INTEGER NOT NULL,
+            created_at   REAL NOT NULL
+        );
+    """
+
+    def __init__(self, path: Optional[str] = None, ttl: Optional[int] = None):
+        super().__init__(path)
+        self.ttl = config.workflow_cache_ttl if ttl is None else ttl
+
+    @staticmethod
+    def is_terminal(result: WorkflowSearchResult) -> bool:
+        """最终步骤已有结果，或任一步骤已终止，则该工作流不会再变化"""
+        return any((_wf.step_name == "最终" and _wf.step_outcome != "正等待处理") or _wf.step_status == "已终止"
+                   for _wf in result.workflows)
+
+    @staticmethod
+    def _dumps(result: WorkflowSearchResult) -> str:
+        return json.dumps(asdict(result), ensure_ascii=False, default=datetime.isoformat)
+
+    @staticmethod
+    def _loads(payload: str) -> WorkflowSearchResult:
+        def _date(value: Optional[str]) -> Optional[datetime]:
+            return datetime.fromisoformat(value) if value else None
+
+        data = json.loads(payload)
+        workflows = []
+        for _wf in data.pop("workflows"):
+            _wf.update(date_in=_date(_wf["date_in"]), date_completed=_date(_wf["date_completed"]),
+                       date_due=_date(_wf["date_due"]), initiator=UserRef(**_wf["initiator"]),
+                       reviewer=UserRef(**_wf["reviewer"]) if _wf["reviewer"] else None,
+                       assignees=[UserRef(**_a) for _a in _wf["assignees"]])
+            workflows.append(Workflow(**_wf))
+        return WorkflowSearchResult(workflows=workflows, **data)
+
+    def get(self, workflow_num: str) -> Optional[WorkflowSearchResult]:
+        if config.workflow_cache_bypass:
+            return None
+        with self._lock:
+            row = self._connect().execute("SELECT payload, terminal, created_at FROM workflow_search "
+                                          "WHERE workflow_num = ?", (workflow_num,)).fetchone()
+        if row is None or (not row[1] and time.time() - row[2] > self.ttl):
+            return None
+        return self._loads(row[0])
+
+    def put(self, workflow_num: str, result: WorkflowSearchResult):
+        with self._lock:
+            conn = self._connect()
+            conn.execute("INSERT OR REPLACE INTO workflow_search VALUES (?, ?, ?, ?)",
+                         (workflow_num, self._dumps(result), int(self.is_terminal(result)), time.time()))
+            conn.commit()
+
+
+class RegisterSnapshot(SqliteStore):
+    """登记册本地快照：每个 search_query 一份，以 document_id 为键；水位为已同步的最新 DateModified"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS register_document (
+            search_query    TEXT NOT NULL,
+            document_id     TEXT NOT NULL,
+            title           TEXT,
+            revision        TEXT,
+            discipline      TEXT,
+            document_number TEXT,
+            document_status TEXT,
+            date_modified   TEXT,
+            PRIMARY KEY (search_query, document_id)
+        );
+        CREATE INDEX IF NOT EXISTS idx_register_document_modified ON register_document (search_query, date_modified);
+        CREATE TABLE IF NOT EXISTS register_watermark (
+            search_query  TEXT PRIMARY KEY,
+            date_modified TEXT NOT NULL,
+            synced_at     REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS register_full_sync (
+            search_query TEXT PRIMARY KEY,
+            synced_at    REAL NOT NULL
+        );
+    """
+
+    _COLUMNS = ("title", "revision", "discipline", "document_id", "document_number", "document_status",
+                "date_modified")
+
+    def watermark(self, search_query: str) -> Optional[datetime]:
+        with self._lock:
+            row = self._connect().execute("SELECT date_modified FROM register_watermark WHERE search_query = ?",
+                                          (search_query,)).fetchone()
+        return datetime.fromisoformat(row[0]) if row else None
+
+    def upsert(self, search_query: str, docs: Iterable[DocumentInfo]):
+        rows = [(search_query, _d.document_id, _d.title, _d.revision, _d.discipline, _d.document_number,
+                 _d.document_status, _d.date_modified.isoformat() if _d.date_modified else None) for _d in docs]
+        if not rows:
+            return
+        with self._lock:
+            conn = self._connect()
+            conn.executemany("INSERT OR REPLACE INTO register_document VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            conn.commit()
+
+    def set_watermark(self, search_query: str, date_modified: datetime):
+        """只会前移不会后退"""
+        with self._lock:
+            conn = self._connect()
+            conn.execute("INSERT INTO register_watermark VALUES (?, ?, ?) ON CONFLICT(search_query) DO UPDATE SET "
+                         "date_modified = MAX(date_modified, excluded.date_modified), synced_at = excluded.synced_at",
+                         (search_query, date_modified.isoformat(), time.time()))
+            conn.commit()
+
+    def last_full_sync(self, search_query: str) -> Optional[float]:
+        """上次全量同步完成的时间（time.time()），从未全量同步时为 None"""
+        with self._lock:
+            row = self._connect().execute("SELECT synced_at FROM register_full_sync WHERE search_query = ?",
+                                          (search_query,)).fetchone()
+        return row[0] if row else None
+
+    def mark_full_sync(self, search_query: str):
+        with self._lock:
+            conn = self._connect()
+            conn.execute("INSERT OR REPLACE INTO register_full_sync VALUES (?, ?)", (search_query, time.time()))
+            conn.commit()
+
+    def retain(self, search_query: str, document_ids: set[str]) -> int:
+        """删除不在 document_ids 中的文档（已从登记册中移除），返回删除数"""
+        with self._lock:
+            conn = self._connect()
+            stale = [(search_query, _r[0]) for _r in conn.execute(
+                "SELECT document_id FROM register_document WHERE search_query = ?", (search_query,))
+                if _r[0] not in document_ids]
+            conn.executemany("DELETE FROM register_document WHERE search_query = ? AND document_id = ?", stale)
+            conn.commit()
+        return len(stale)
+
+    def clear(self, search_query: str):
+        """删除该 search_query 的快照、水位和全量同步记录"""
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM register_document WHERE search_query = ?", (search_query,))
+            conn.execute("DELETE FROM register_watermark WHERE search_query = ?", (search_query,))
+            conn.execute("DELETE FROM register_full_sync WHERE search_query = ?", (search_query,))
+            conn.commit()
+
+    def count(self, search_query: str) -> int:
+        with self._lock:
+            return self._connect().execute("SELECT COUNT(*) FROM register_document WHERE search_query = ?",
+                                           (search_query,)).fetchone()[0]
+
+    def iter_documents(self, search_query: str, chunk_size: int = 1000) -> Iterator[DocumentInfo]:
+        """按 DateModified 降序逐批读出（与 API 排序一致），每批读完即释放锁"""
+        # 以 (date_modified, document_id) 为游标分批读取；date_modified 为空的排在最后
+        last = ("\uffff", "")
+        while True:
+            with self._lock:
+                rows = self._connect().execute(
+                    "SELECT title, revision, discipline, document_id, document_number, document_status, "
+                    "date_modified, COALESCE(date_modified, '') AS k FROM register_document "
+                    "WHERE search_query = ? AND (k < ? OR (k = ? AND document_id > ?)) "
+                    "ORDER BY k DESC, document_id LIMIT ?",
+                    (search_query, last[0], last[0], last[1], chunk_size)).fetchall()
+            for _row in rows:
+                values = dict(zip(self._COLUMNS, _row[:7]))
+                if values["date_modified"]:
+                    values["date_modified"] = datetime.fromisoformat(values["date_modified"])
+                yield DocumentInfo(**values)
+            if len(rows) < chunk_size:
+                return
+            last = (rows[-1][7], rows[-1][3])
@@ -0,0 +1,169 @@
+"""
+自适应并发控制（AIMD）
+
+- 同一个限流器同时用于同步请求（get_with_retry / post_with_retry）和异步客户端
+- 加性增：请求占满当前并发上限且延迟平稳时，每完成约 limit 个请求上限 +1
+- 乘性减：收到 429/503，或窗口 p95 延迟超过基线（窗口 p50 的最小值）的 config.aimd_latency_tolerance 倍时，
+  上限乘以 config.aimd_decrease_factor；一个基线延迟内最多下调一次
+- 每次尝试（包括重试）都单独占用一个名额并记录结果，重试等待期间不占用名额
+- summary() 报告最终稳定的并发数
+"""
+import asyncio
+import threading
+import time
+from collections import deque
+from typing import Callable, Optional
+
+from config import config
+
+# 需要重试的状态码（与 urllib3 Retry 原 status_forcelist 一致）
+RETRY_STATUS = frozenset({429, 500, 502, 503, 504})
+# 服务器限流信号，触发乘性减
+THROTTLE_STATUS = frozenset({429, 503})
+
+
+def retryDelay(attempt: int, retry_after: Optional[str] = None) -> float:
+    """第 attempt 次重试前的等待时间：优先使用 Retry-After（秒），否则指数退避"""
+    if retry_after:
+        try:
+            return max(float(retry_after), 0.0)
+        except ValueError:
+            pass
+    return config.retry_delay * (2 ** attempt)
+
+
+def _percentile(sorted_values: list[float], q: float) -> float:
+    return sorted_values[min(int(len(sorted_values) * q), len(sorted_values) - 1)]
+
+
+class AdaptiveLimiter:
+    """线程安全的 AIMD 并发上限；同步代码用 `with limiter:`，协程用 `async with limiter:`"""
+
+    def __init__(self, initial: Optional[int] = None, min_limit: Optional[int] = None,
+                 max_limit: Optional[int] = None):
+        self.min_limit = min_limit or config.min_in_flight
+        self.max_limit = max_limit or config.max_in_flight
+        self.limit = float(min(max(initial or config.initial_in_flight, self.min_limit), self.max_limit))
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        # 等待者的唤醒函数，按先来先得分配名额
+        self._waiters: deque[Callable[[], None]] = deque()
+        self._latencies: list[float] = []
+        self._baseline: Optional[float] = None
+        self._cooldown_until = 0.0
+        # 统计
+        self.history: list[int] = []  # 每个采样窗口结束时的并发上限
+        self.peak = int(self.limit)
+        self.requests = 0
+        self.throttled = 0
+        self.decreases = 0
+        # 每次请求结束时以 (latency, status) 回调，供基准测试 / 统计使用
+        self.observers: list[Callable[[float, Optional[int]], None]] = []
+
+    # ---------------- 名额分配 ----------------
+    def _grant_locked(self):
+        while self._waiters and self._in_flight < int(self.limit):
+            self._in_flight += 1
+            self._waiters.popleft()()
+
+    def acquire(self):
+        with self._lock:
+            if not self._waiters and self._in_flight < int(self.limit):
+                self._in_flight += 1
+                return
+            event = threading.Event()
+            self._waiters.append(event.set)
+        event.wait()
+
+    async def acquire_async(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if not self._waiters and self._in_flight < int(self.limit):
+                self._in_flight += 1
+                return
+            future = loop.create_future()
+
+            def wake():
+                loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+            self._waiters.append(wake)
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self._lock:
+                if wake in self._waiters:  # 尚未分到名额
+                    self._waiters.remove(wake)
+                    raise
+            self.release()  # 名额已分配但协程被取消，归还
+            raise
+
+    def release(self):
+        with self._lock:
+            self._in_flight -= 1
+            self._grant_locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    async def __aenter__(self):
+        await self.acquire_async()
+        return self
+
+    async def __aexit__(self, *exc):
+        self.release()
+
+    # ---------------- AIMD ----------------
+    def record(self, latency: float, status: Optional[int] = None):
+        """记录一次请求（在 release 之前调用）；status 为 None 表示未拿到响应"""
+        for observer in self.observers:
+            observer(latency, status)
+        with self._lock:
+            self.requests += 1
+            now = time.monotonic()
+            if status in THROTTLE_STATUS:
+                self.throttled += 1
+                self._decrease_locked(now)
+                return
+            if status is None:
+                return
+            # 加性增：只有在并发已被占满时才说明上限是瓶颈
+            if self._in_flight >= int(self.limit):
+                self.limit = min(self.limit + 1 / self.limit, float(self.max_limit))
+                self.peak = max(self.peak, int(self.limit))
+                self._grant_locked()
+            self._latencies.append(latency)
+            if len(self._latencies) >= config.aimd_window:
+                self._close_window_locked(now)
+
+    def _close_window_locked(self, now: float):
+        latencies = sorted(self._latencies)
+        self._latencies.clear()
+        p50, p95 = _percentile(latencies, 0.5), _percentile(latencies, 0.95)
+        # 基线允许缓慢上浮，避免一次偶然的低延迟把基线永久压低
+        self._baseline = p50 if self._baseline is None else min(p50, self._baseline * 1.1)
+        if p95 > self._baseline * config.aimd_latency_tolerance:
+            self._decrease_locked(now)
+        self.history.append(int(self.limit))
+
+    def _decrease_locked(self, now: float):
+        if now < self._cooldown_until:
+            return
+        self.limit = max(self.limit * config.aimd_decrease_factor, float(self.min_limit))
+        self.decreases += 1
+        self._latencies.clear()  # 旧并发下的样本不再代表当前状态
+        self._cooldown_until = now + (self._baseline or 1.0)
+
+    # ---------------- 报告 ----------------
+    def settled(self) -> int:
+        """最近几个采样窗口的平均并发上限"""
+        recent = self.history[-5:]
+        return round(sum(recent) / len(recent)) if recent else int(self.limit)
+
+    def summary(self) -> str:
+        return (f"Adaptive concurrency settled at {self.settled()} "
+                f"(peak {self.peak}, range {self.min_limit}-{self.max_limit}, requests {self.requests}, "
+                f"throttled {self.throttled}, decreases {self.decreases})")
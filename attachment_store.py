@@ -0,0 +1,160 @@
+"""
+附件内容寻址存储（跨邮件去重）
+
+同一登记文件（document_id + revision）常作为附件出现在多封邮件中（传送、转发、工作流通知）：
+- 每个登记文件只下载一次；下载完成后按 SHA-256 存入 <存储目录>/<哈希前两位>/<哈希>，内容相同的不同文件也只存一份
+- 各主题目录中的文件是指向存储文件的硬链接（无法硬链接时复制，如跨文件系统）
+- manifest（SQLite）记录 登记文件 → 内容哈希，以及已放置的路径；是否需要下载 / 链接先查 manifest，
+  再确认记录的文件 / 存储文件仍在，丢失的记录删除后按未下载处理
+
+硬链接的文件共享同一份数据，修改其中一个会影响所有链接；附件应视为只读。
+"""
+import hashlib
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import Optional
+
+from aconex_cache import SqliteStore
+from config import config
+
+
+def fileSha256(path: Path, chunk_size: int = 1024 * 1024) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def linkFile(src: Path, dst: Path):
+    """dst 替换为指向 src 的硬链接，无法硬链接时复制；先写临时名再替换，中途失败不留半个文件"""
+    if dst.exists() and os.path.samefile(src, dst):
+        return
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    tmp = dst.with_name(dst.name + ".link")
+    tmp.unlink(missing_ok=True)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copy2(src, tmp)
+    os.replace(tmp, dst)
+
+
+class AttachmentStore(SqliteStore):
+    """附件存储及其 manifest"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS blob (
+            sha256     TEXT PRIMARY KEY,
+            size       INTEGER NOT NULL,
+            created_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS document (
+            document_id TEXT NOT NULL,
+            revision    TEXT NOT NULL,
+            sha256      TEXT NOT NULL,
+            PRIMARY KEY (document_id, revision)
+        );
+        CREATE TABLE IF NOT EXISTS placement (
+            path   TEXT PRIMARY KEY,
+            sha256 TEXT NOT NULL
+        );
+    """
+
+    def __init__(self, root: Optional[str] = None, path: Optional[str] = None):
+        self.root = Path(root or config.attachment_store_dir).resolve()
+        super().__init__(path or str(self.root / "manifest.sqlite3"))
+        self.linked = 0  # 本次运行从存储链接（未下载）的文件数
+
+    def blob_path(self, sha256: str) -> Path:
+        return self.root / sha256[:2] / sha256
+
+    def lookup(self, document_id: str, revision: str) -> Optional[str]:
+        """登记文件已入库时返回内容哈希"""
+        with self._lock:
+            row = self._connect().execute("SELECT sha256 FROM document WHERE document_id = ? AND revision = ?",
+                                          (document_id, revision or "")).fetchone()
+        return row[0] if row else None
+
+    def is_placed(self, path: Path) -> bool:
+        """
+        manifest 记录 path 已放置，且文件仍在：与存储文件是同一 inode，或（复制放置时）大小与存储文件一致
+
+        文件已被删除或替换时删除该记录并返回 False
+        """
+        key = str(path.resolve())
+        with self._lock:
+            row = self._connect().execute("SELECT p.sha256, b.size FROM placement p LEFT JOIN blob b "
+                                          "ON b.sha256 = p.sha256 WHERE p.path = ?", (key,)).fetchone()
+        if row is None:
+            return False
+        sha256, size = row
+        try:
+            st = path.stat()
+            placed = st.st_size == size or os.path.samestat(st, self.blob_path(sha256).stat())
+        except OSError:
+            placed = False
+        if not placed:
+            with self._lock:
+                conn = self._connect()
+                conn.execute("DELETE FROM placement WHERE path = ?", (key,))
+                conn.commit()
+        return placed
+
+    def place(self, sha256: str, path: Path) -> bool:
+        """
+        在 path 放置存储文件的链接
+
+        存储文件已丢失（如存储目录被清理）时删除该哈希的全部记录并返回 False，由调用方重新下载
+        """
+        try:
+            linkFile(self.blob_path(sha256), path)
+        except FileNotFoundError:
+            self._forget(sha256)
+            return False
+        with self._lock:
+            conn = self._connect()
+            conn.execute("INSERT OR REPLACE INTO placement VALUES (?, ?)", (str(path.resolve()), sha256))
+            conn.commit()
+        self.linked += 1
+        return True
+
+    def _forget(self, sha256: str):
+        with self._lock:
+            conn = self._connect()
+            for _table in ("placement", "document", "blob"):
+                conn.execute(f"DELETE FROM {_table} WHERE sha256 = ?", (sha256,))
+            conn.commit()
+
+    def ingest(self, path: Path, document_id: str, revision: str) -> str:
+        """
+        已下载的文件入库，返回内容哈希
+
+        内容已在存储中时 path 改为指向已有文件的链接，否则把 path 链接进存储（不复制数据）
+        """
+        sha256 = fileSha256(path)
+        blob = self.blob_path(sha256)
+        if blob.exists():
+            linkFile(blob, path)
+        else:
+            linkFile(path, blob)
+        with self._lock:
+            conn = self._connect()
+            conn.execute("INSERT OR IGNORE INTO blob VALUES (?, ?, ?)", (sha256, blob.stat().st_size, time.time()))
+            conn.execute("INSERT OR REPLACE INTO document VALUES (?, ?, ?)", (document_id, revision or "", sha256))
+            conn.execute("INSERT OR REPLACE INTO placement VALUES (?, ?)", (str(path.resolve()), sha256))
+            conn.commit()
+        return sha256
+
+    def stats(self) -> dict[str, int]:
+        """存储的文件数 / 字节数，以及各目录中放置的文件数 / 字节数（即不去重时占用的空间）"""
+        with self._lock:
+            conn = self._connect()
+            blobs, stored = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blob").fetchone()
+            placed, logical = conn.execute("SELECT COUNT(*), COALESCE(SUM(b.size), 0) FROM placement p "
+                                           "JOIN blob b ON b.sha256 = p.sha256").fetchone()
+            documents = conn.execute("SELECT COUNT(*) FROM document").fetchone()[0]
+        return {"documents": documents, "blobs": blobs, "stored_bytes": stored,
+                "placements": placed, "placed_bytes": logical}
@@ -14,11 +14,72 @@ class Config:
     aconex_user_id: str = "ACONEX_USER_ID"
     aconex_instance_url: str = "https://asia1.aconex.com"
     project_id: str = "PROJECT_ID"
+    token_refresh_margin: int = 300  # seconds, 在 token 过期前多久主动刷新
+    token_background_lead: int = 60  # seconds, 后台定时刷新比上面的刷新时间再提前多久，使请求不必同步等待刷新
 
     # request settings
     proxies: Optional[dict[str, str]] = None  # Example: {"http": "http://127.0.0.1:8000", "https": "http://127.0.0.1:8000"}
     retry_times: int = 3
     retry_delay: int = 5  # seconds
+    max_in_flight: int = 64  # 自适应并发上限
+    min_in_flight: int = 1  # 自适应并发下限
+    initial_in_flight: int = 8  # 初始并发数
+    aimd_decrease_factor: float = 0.7  # 收到 429/503 或延迟升高时并发数乘以该系数
+    aimd_latency_tolerance: float = 2.0  # 窗口 p95 超过基线延迟的倍数时视为拥塞
+    aimd_window: int = 20  # 每个延迟采样窗口的请求数
+
+    # mail search
+    mail_page_size: int = 250  # 分页查询每页条数
+    mail_page_prefetch: int = 4  # 提前结束模式下每轮并发预取的页数
+    mail_search_early_exit: bool = False  # True 时逐图号分页查询（不使用批量查询），找到最新版本的最终审核邮件后不再翻页
+    mail_batch_size: int = 40  # 批量查询每批合并的图号数，<= 1 时逐个图号查询
+    mail_batch_max_query_length: int = 1800  # URL 编码后 search_query 的最大长度，超出时拆分批次
+
+    # document register
+    register_page_size: int = 50  # 登记册分页查询每页条数
+    register_page_prefetch: int = 8  # 流式读取登记册时按页码顺序提前请求的页数
+    register_full_sync_days: Optional[float] = 7  # 距上次全量同步超过该天数时增量同步改为全量（对齐元数据变化和移除的文档），None 表示不自动全量
+
+    # local mail warehouse（mail_warehouse.py）
+    warehouse_db_path: str = "./cache/mail_warehouse.sqlite3"
+    warehouse_search_query: str = "subject:(SLDS AND BCEG)"  # 未指定跟踪表时整体同步的查询条件
+    offline: bool = False  # True 时邮件 / 工作流 / 邮件详情只查询本地仓库，不访问 API
+
+    # attachment download（main_download_attachments.py）
+    download_metadata_concurrency: int = 32  # 并发预取邮件元数据的上限
+    aria2_batch_size: int = 100  # 每次 system.multicall 提交 / 查询的下载数
+    aria2_flush_delay: Optional[float] = 0.5  # seconds, 排队最久的下载等待超过该时间即提交，不必凑满 aria2_batch_size；None 表示只按数量提交
+    aria2_poll_interval: float = 2.0  # seconds, 查询下载进度的间隔
+    download_max_attempts: int = 3  # 出错或文件大小不符时每个附件最多下载的次数
+    download_engine: str = "aria2"  # "aria2"：提交给 aria2c RPC；"builtin"：进程内分段下载（range_downloader.py）
+    download_split: int = 8  # 内置下载器每个文件最多同时请求的分段数
+    download_min_split_size: int = 1024 * 1024  # 内置下载器的最小分段（字节），也是第一次请求的范围
+    download_chunk_size: int = 256 * 1024  # 流式写入磁盘的块大小（字节）
+    download_concurrent_files: int = 16  # 内置下载器同时下载的文件数
+    attachment_dedup: bool = True  # True 时同一登记文件（document_id + revision）只下载一次，其他主题目录中为硬链接
+    attachment_store_dir: str = "./downloads/.store"  # 附件存储和 manifest 的目录，需与下载目录在同一文件系统才能硬链接
+
+    # local cache
+    cache_db_path: str = "./cache/aconex_cache.sqlite3"
+    mail_cache_ttl: int = 3600  # seconds
+    mail_cache_max_entries: int = 20000
+    mail_cache_bypass: bool = False  # True 时不读取缓存（仍写入最新结果）
+    workflow_cache_ttl: int = 600  # seconds, 仅对进行中的工作流生效
+    workflow_cache_bypass: bool = False
+    incremental_sync: bool = False  # True 时按 SentDate 水位只查询新邮件，无新邮件的行保持原值
+
+    # workbook save
+    checkpoint_interval: Optional[float] = None  # seconds, 后台保存中间结果的时间间隔，None 表示不按时间保存
+    checkpoint_rows: Optional[int] = None  # 每完成多少行后台保存一次中间结果，None 表示不按行数保存
+    low_memory: bool = False  # True 时只读扫描图号，全部完成后只把结果列写回工作簿
+
+    # metrics
+    metrics_dir: Optional[str] = "./cache/metrics"  # 退出时写出 <脚本名>.json / <脚本名>.prom 的目录，None 表示不导出
+
+    # profiling（--profile）
+    profile_dir: str = "./profile"  # 各阶段 .prof 及 <脚本名>.profile.txt / .json 报告的目录
+    profile_top: int = 25  # 每个阶段报告的函数 / 分配位置条数
+    profile_alloc_samples: int = 5  # 每个阶段对前几次调用做 tracemalloc 快照对比
 
     # fill colors
     finish_fill_color: str = "92D050"  # Green
@@ -1,7 +1,9 @@
-from dataclasses import dataclass, field
+from dataclasses import InitVar, dataclass, field
 from datetime import datetime
 from typing import Optional
 
+from subject_model import ParsedSubject, parseSubject
+
 
 @dataclass
 class responseMailInfo:
@@ -10,6 +12,10 @@ class responseMailInfo:
     SentDate: datetime
     subject: str
     AllAttachmentCount: int
+    parsed: Optional[ParsedSubject] = field(init=False, repr=False, compare=False)  # 主题解析结果，不满足 MAIN_RE 时为 None
+
+    def __post_init__(self):
+        self.parsed = parseSubject(self.subject)
 
 
 @dataclass
@@ -55,6 +61,15 @@ class Workflow:
     assignees: list[UserRef] = field(default_factory=list)
 
 
+@dataclass
+class PageInfo:
+    current_page: int
+    page_size: int
+    total_pages: int
+    total_results: int
+    total_results_on_page: int
+
+
 @dataclass
 class WorkflowSearchResult:
     current_page: int
@@ -74,6 +89,17 @@ class searchResult:
     max_col_used: int = field(default=9)
 
 
+@dataclass
+class DocumentInfo:
+    title: str
+    revision: str
+    discipline: str
+    document_id: str
+    document_number: str
+    document_status: str    # "无效"则表示作废
+    date_modified: datetime
+
+
 @dataclass
 class RegisteredDocumentAttachment:
     attachment_id: str          # XML 属性 attachmentId
@@ -102,8 +128,21 @@ class MailDetail:
     mail_id: str
     subject: str
     sent_date: datetime
-    mail_data: str
+    mail_data: InitVar[str]  # 传入 <MailData> 原文（富文本 HTML），保存在 mail_data_html；读取 mail_data 时才转换为纯文本
 
     from_user_details: FromUserDetails
     attachments: list[RegisteredDocumentAttachment] = field(default_factory=list)
     recipients: list[Recipient] = field(default_factory=list)
+    mail_data_html: str = field(init=False)
+
+    def __post_init__(self, mail_data: str):
+        self.mail_data_html = mail_data
+
+    def __getattr__(self, name: str):
+        # 只在实例上没有 mail_data 时调用：HTML 解析较慢，首次访问时才转换并缓存
+        if name != "mail_data":
+            raise AttributeError(f"{type(self).__name__!r} object has no attribute {name!r}")
+        from xml_parse import htmlToText
+
+        self.mail_data = htmlToText(self.mail_data_html)
+        return self.mail_data
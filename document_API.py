@@ -1,160 +1,211 @@
-"""使用 API 列出已注册文件，并根据专业分类写入 Excel。"""
-
-import os
-import threading
-from datetime import datetime, timezone, timedelta
-from typing import Optional
-from concurrent.futures import ThreadPoolExecutor, wait, ALL_COMPLETED
-
-from requests import Response
-
-from main import get_with_retry, requestToken
+"""
+使用 API 列出已注册文件，并根据专业分类写入 Excel。
+
+- iter_registered_pages_async() / iter_registered_documents(): 按页码顺序逐页产出 DocumentInfo，
+  同时最多提前请求 config.register_page_prefetch 页，内存只与预取页数有关
+- export_registered_documents(): write_only 工作簿，文档到达即追加到所属专业的 sheet
+- sync_registered_documents(): 增量同步到本地快照 REGISTER_SNAPSHOT，导出改为从快照生成。
+  结果按 revisiondate 降序，增量同步翻页到早于水位的文档即停止；只改了状态等元数据的文档
+  （revisiondate 不变）和已从登记册移除的文档由全量同步处理：距上次全量同步超过
+  config.register_full_sync_days 时自动全量同步，读完全部页并删除未出现的文档
+"""
+
+import argparse
+import asyncio
+import time
+from datetime import datetime
+from typing import AsyncIterator, Iterable, Iterator, Optional
+
+from main import ASYNC_CLIENT, requestToken
+from metrics import METRICS
+from profiling import PROFILER
+from aconex_async import run_sync
+from aconex_cache import RegisterSnapshot
 from config import config
-import xml.etree.ElementTree as ET
+from dataclass import DocumentInfo
+from workbook_io import saveWorkbookAtomic
+from xml_parse import parseRegisterPage
 
-from dataclasses import dataclass
 import openpyxl
 
+REGISTER_HEADERS = ["标题", "版本", "专业", "图号", "文件状态", "修改日期"]
+
+REGISTER_SNAPSHOT = RegisterSnapshot()
+
+
+async def _get_response(search_query: str, page_size: Optional[int] = None, page_number: int = 1) -> bytes:
+    print(f"Fetching page {page_number}...")
+    return await ASYNC_CLIENT.get(
+        url=f"{config.resource_url}/api/projects/{config.project_id}/register",
+        params={
+            "search_query": search_query,
+            "return_fields": "revision,discipline,docno,revisiondate,statusid,registered,title,doctype,reviewstatus,reviewSource",
+            "sort_field": "revisiondate",
+            "sort_direction": "DESC",
+            "search_type": "PAGED",
+            "page_size": page_size or config.register_page_size,
+            "page_number": page_number
+        })
+
+
+async def iter_registered_pages_async(search_query: str, page_size: Optional[int] = None,
+                                      prefetch: Optional[int] = None) -> AsyncIterator[list[DocumentInfo]]:
+    """按页码顺序逐页产出文档；后续页以 prefetch 页为窗口并发请求，已产出的页不再保留"""
+    prefetch = max(prefetch or config.register_page_prefetch, 1)
+
+    # 第 1 页只解析一次，同时得到分页信息和文档
+    first_page = await _get_response(search_query, page_size)
+    with METRICS.stage("parse"):
+        page_info, docs = parseRegisterPage(first_page)
+    del first_page
+    yield docs
+
+    pending: list[asyncio.Task] = []
+    next_page = 2
+    try:
+        while next_page <= page_info.total_pages or pending:
+            while next_page <= page_info.total_pages and len(pending) < prefetch:
+                pending.append(asyncio.create_task(_get_response(search_query, page_size, next_page)))
+                next_page += 1
+            content = await pending.pop(0)
+            with METRICS.stage("parse"):
+                docs = parseRegisterPage(content)[1]
+            del content
+            yield docs
+    finally:
+        # 调用方提前结束迭代时取消已预取的页
+        for _task in pending:
+            _task.cancel()
+
+
+def iter_registered_documents(search_query: str, page_size: Optional[int] = None,
+                              prefetch: Optional[int] = None) -> Iterator[DocumentInfo]:
+    """iter_registered_pages_async 的同步版本，逐个产出 DocumentInfo（顺序与 API 排序一致）"""
+    pages = iter_registered_pages_async(search_query, page_size, prefetch)
+    try:
+        while True:
+            try:
+                docs = run_sync(pages.__anext__())
+            except StopAsyncIteration:
+                return
+            yield from docs
+    finally:
+        run_sync(pages.aclose())
+
+
+async def list_registered_documents_async(search_query: str) -> list[DocumentInfo]:
+    all_docs: list[DocumentInfo] = []
+    async for docs in iter_registered_pages_async(search_query):
+        all_docs.extend(docs)
+    return all_docs
 
-LOCK_1 = threading.Lock()
-
-
-@dataclass
-class DocumentInfo:
-    title: str
-    revision: str
-    discipline: str
-    document_id: str
-    document_number: str
-    document_status: str    # "无效"则表示作废
-    date_modified: datetime
 
+def list_registered_documents(search_query: str) -> list[DocumentInfo]:
+    return run_sync(list_registered_documents_async(search_query=search_query))
 
-@dataclass
-class PageInfo:
-    current_page: int
-    page_size: int
-    total_pages: int
-    total_results: int
-    total_results_on_page: int
 
+async def sync_registered_documents_async(search_query: str, full: bool = False,
+                                          snapshot: Optional[RegisterSnapshot] = None) -> int:
+    """
+    把登记册同步到本地快照，返回新增 / 更新的文档数
 
-def parseDatetime(dt: str) -> Optional[datetime]:
+    增量时逐页请求（不预取），只写入 DateModified 不早于水位的文档，遇到早于水位的文档后停止翻页；
+    full=True 或到达全量周期时读完全部页、写入全部文档，并删除本次未出现的文档（作废、移除的文档在此对齐）。
+    全部页处理完再前移水位，中途失败时快照和水位保持不变
     """
-    把 RFC-3339 / ISO-8601 字符串转为 datetime，并转换到 UTC+8。
-    - 原始 API 字段形如 '2025-08-29T08:38:39.839Z'（Z 表示 UTC）
-    - 返回值例如 2025-08-29 16:38:39.839+08:00
+    snapshot = snapshot or REGISTER_SNAPSHOT
+    last_full = snapshot.last_full_sync(search_query)
+    if config.register_full_sync_days is not None and (
+            last_full is None or time.time() - last_full > config.register_full_sync_days * 86400):
+        full = True
+    watermark = None if full else snapshot.watermark(search_query)
+    newest: Optional[datetime] = None
+    synced = 0
+    seen: set[str] = set()
+    pages = iter_registered_pages_async(search_query, prefetch=1 if watermark else None)
+    try:
+        async for docs in pages:
+            seen.update(_d.document_id for _d in docs)
+            fresh = [_d for _d in docs
+                     if watermark is None or _d.date_modified is None or _d.date_modified >= watermark]
+            snapshot.upsert(search_query, fresh)
+            synced += len(fresh)
+            dates = [_d.date_modified for _d in fresh if _d.date_modified is not None]
+            if dates:
+                newest = max(dates) if newest is None else max(newest, *dates)
+            if len(fresh) < len(docs):
+                break
+    finally:
+        await pages.aclose()
+
+    if full:
+        removed = snapshot.retain(search_query, seen)
+        if removed:
+            print(f"Removed {removed} documents no longer in the register.")
+    if newest is not None:
+        snapshot.set_watermark(search_query, newest)
+    if full:
+        snapshot.mark_full_sync(search_query)
+    return synced
+
+
+def sync_registered_documents(search_query: str, full: bool = False,
+                              snapshot: Optional[RegisterSnapshot] = None) -> int:
+    return run_sync(sync_registered_documents_async(search_query=search_query, full=full, snapshot=snapshot))
+
+
+def export_registered_documents(docs: Iterable[DocumentInfo], path: str) -> dict[str, int]:
     """
+    按专业分 sheet 写入 write_only 工作簿（sheet 按专业首次出现的顺序创建），返回 {sheet 名: 文档数}
 
-    # 将 'Z' 替换为 '+00:00'，构造成可被 fromisoformat 解析的字符串
-    utc_dt = datetime.fromisoformat(dt.replace("Z", "+00:00"))
-    # 转换到东八区
-    return utc_dt.astimezone(timezone(timedelta(hours=8)))
-
-
-def list_registered_documents(search_query: str) -> list[DocumentInfo]:
-    def _postprocess(xml_text: bytes) -> list[DocumentInfo]:
-        _export_list: list[DocumentInfo] = []
-        root = ET.fromstring(xml_text.decode("utf-8"))
-        for _doc in root.find('SearchResults').iter('Document'):
-            _export_list.append(DocumentInfo(
-                title=_doc.findtext('Title'),
-                revision=_doc.findtext('Revision'),
-                document_id=_doc.attrib["DocumentId"],
-                document_number=_doc.findtext('DocumentNumber'),
-                document_status=_doc.findtext('DocumentStatus'),
-                date_modified=parseDatetime(_doc.findtext('DateModified')),
-                discipline=_doc.findtext('Discipline')
-            ))
-        return _export_list
-
-    def _get_page_info(xml_text: bytes) -> PageInfo:
-        root = ET.fromstring(xml_text.decode("utf-8"))
-        return PageInfo(
-            current_page=int(root.attrib["CurrentPage"]),
-            page_size=int(root.attrib["PageSize"]),
-            total_pages=int(root.attrib["TotalPages"]),
-            total_results=int(root.attrib["TotalResults"]),
-            total_results_on_page=int(root.attrib["TotalResultsOnPage"])
-        )
-
-    def _get_response(page_size: int = 50, page_number: int = 1) -> Response:
-        _response = get_with_retry(
-            url=f"{config.resource_url}/api/projects/{config.project_id}/register",
-            headers={"Authorization": f"Bearer {config.access_token}"},
-            params={
-                "search_query": search_query,
-                "return_fields": "revision,discipline,docno,revisiondate,statusid,registered,title,doctype,reviewstatus,reviewSource",
-                "sort_field": "revisiondate",
-                "sort_direction": "DESC",
-                "search_type": "PAGED",
-                "page_size": page_size,
-                "page_number": page_number
-            })
-
-        _response.raise_for_status()
-        return _response
-
-    def _thread_task(page_number: int):
-        global LOCK_1
-        print(f"Fetching page {page_number}...")
-        _response = _postprocess(_get_response(page_number=page_number).content)
-        with LOCK_1:
-            all_docs.extend(_response)
-
-    response = _get_response()
-
-    # support pagination
-    page_info = _get_page_info(response.content)
-    if page_info.total_pages > 1:
-        all_docs: list[DocumentInfo] = _postprocess(response.content)
-
-        # 构造线程池
-        pool = ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 5))
-        all_tasks = []
-
-        for page_num in range(2, page_info.total_pages + 1):
-            task = pool.submit(_thread_task, page_num)
-            all_tasks.append(task)
-
-        # 等待所有任务完成
-        wait(all_tasks, return_when=ALL_COMPLETED)
-        pool.shutdown()
-
-        return all_docs
-
-    return _postprocess(response.content)
-
-
-if __name__ == '__main__':
-    requestToken()
-    registered_doc_list = list_registered_documents(search_query="SDS")
-    print(len(registered_doc_list))
-
-    # 根据"discipline"字段进行聚类
-    clustered_docs: dict[str, list[DocumentInfo]] = {}
-    for doc in registered_doc_list:
-        if doc.discipline not in clustered_docs:
-            clustered_docs[doc.discipline] = []
-        clustered_docs[doc.discipline].append(doc)
-
-    # 分类写入sheet
-    wb = openpyxl.Workbook()
-    for discipline, docs in clustered_docs.items():
-        ws = wb.create_sheet(title=discipline[:30])  # sheet 名称不能超过 31 字符
-        ws.append(["标题", "版本", "专业", "图号", "文件状态", "修改日期"])
+    write_only 模式下行写入临时文件，不在内存中保留单元格对象
+    """
+    wb = openpyxl.Workbook(write_only=True)
+    sheets = {}
+    counts: dict[str, int] = {}
+    with METRICS.stage("cell_write"):
         for doc in docs:
+            title = doc.discipline[:30]  # sheet 名称不能超过 31 字符
+            ws = sheets.get(title)
+            if ws is None:
+                ws = sheets[title] = wb.create_sheet(title=title)
+                ws.append(REGISTER_HEADERS)
+                counts[title] = 0
             ws.append([
                 doc.title,
                 doc.revision,
                 doc.discipline,
                 doc.document_number,
                 doc.document_status,
-                doc.date_modified.isoformat()
+                doc.date_modified.isoformat() if doc.date_modified else None  # 没有修改日期时留空
             ])
+            counts[title] += 1
 
-    # 删除默认创建的sheet
-    wb.remove(wb["Sheet"])
-
-    wb.save("registered_documents.xlsx")
+    with METRICS.stage("save"):
+        saveWorkbookAtomic(wb, path)
     wb.close()
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="导出 Aconex 文档登记册，按专业分 sheet 写入 xlsx")
+    parser.add_argument("--search-query", default="SDS", help="登记册搜索条件")
+    parser.add_argument("--output", default="registered_documents.xlsx", help="输出的 xlsx 路径")
+    parser.add_argument("--incremental", action="store_true", help="增量同步到本地快照，再从快照导出")
+    parser.add_argument("--full", action="store_true", help="全量同步到本地快照（写入全部文档），再从快照导出")
+    parser.add_argument("--profile", action="store_true", help="分阶段 cProfile / tracemalloc 剖析，报告写入 config.profile_dir")
+    args = parser.parse_args()
+    if args.profile:
+        PROFILER.start()
+
+    requestToken()
+    if args.incremental or args.full:
+        synced_count = sync_registered_documents(search_query=args.search_query, full=args.full)
+        print(f"Synced {synced_count} documents, snapshot has {REGISTER_SNAPSHOT.count(args.search_query)}.")
+        documents = REGISTER_SNAPSHOT.iter_documents(args.search_query)
+    else:
+        documents = iter_registered_documents(search_query=args.search_query)
+    sheet_counts = export_registered_documents(documents, args.output)
+    print(sum(sheet_counts.values()))
+    for sheet_name, count in sheet_counts.items():
+        print(f"  {sheet_name}: {count}")
@@ -16,7 +16,7 @@ if __name__ == '__main__':
                 unit=matched_data["unit"], discipline=matched_data["discipline"],
                 drawing=matched_data["drawing"], step=matched_data["step"]
             ))[0]
-        matched_subject = MAIN_RE.match(response.subject).groupdict()
+        matched_subject = response.parsed.groupdict()
         print(f"matched subject: {matched_subject}")
         print(f"sentDate: {response.SentDate.date().isoformat()}")
         if matched_subject.get('wf'):
@@ -0,0 +1,415 @@
+"""
+本地邮件仓库（SQLite）
+
+- mail: 邮件头（responseMailInfo），按主题解析出的 unit / step / discipline / drawing / ver / wf 建索引，
+  同一封邮件在 SENTBOX / INBOX 中出现记为 boxes 位掩码
+- mail_drawing: 主题中出现的每个图号一行（主题可能同时列出多个图号），离线查询按它匹配，
+  与在线批量查询 demuxMails 按主题片段归属一致
+- mail_detail: 邮件详情（MailDetail，含附件）
+- workflow: 工作流查询结果（WorkflowSearchResult）
+- 只有 sync 命令访问 API；config.offline 为 True 时 searchMail / searchMailBatch / searchWorkflow /
+  viewMailMetadata 改为查询本仓库，结果与在线查询经过相同的去重择优和排序
+
+用法：
+    python mail_warehouse.py sync --tracker 图纸进度跟踪表.xlsx --workflows --details   # 按跟踪表中的图号同步
+    python mail_warehouse.py sync --query "subject:(SLDS AND BCEG)"                     # 按查询条件整体同步
+    python mail_warehouse.py stats
+"""
+import argparse
+import asyncio
+import json
+import time
+from dataclasses import asdict
+from datetime import datetime
+from typing import Iterable, Literal, Optional
+
+import openpyxl
+
+from aconex_cache import SqliteStore, WorkflowCache
+from config import config
+from dataclass import (FromUserDetails, MailDetail, Recipient, RegisteredDocumentAttachment, WorkflowSearchResult,
+                       patternInfo, responseMailInfo)
+from subject_model import MAIN_RE, subjectDrawings
+
+BOX_BITS = {"SENTBOX": 1, "INBOX": 2}
+
+
+def boxMask(mail_box: Literal["INBOX", "SENTBOX", "ALL"]) -> int:
+    return BOX_BITS.get(mail_box, BOX_BITS["SENTBOX"] | BOX_BITS["INBOX"])
+
+
+class MailWarehouse(SqliteStore):
+    """邮件头 / 邮件详情 / 工作流的本地仓库"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS mail (
+            mail_id          INTEGER PRIMARY KEY,
+            mail_no          TEXT,
+            sent_date        TEXT NOT NULL,
+            subject          TEXT NOT NULL,
+            attachment_count INTEGER,
+            boxes            INTEGER NOT NULL,
+            unit             TEXT,
+            step             TEXT,
+            discipline       TEXT,
+            drawing          TEXT,
+            ver              TEXT,
+            wf               TEXT,
+            synced_at        REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_mail_drawing ON mail (unit, discipline, drawing, ver);
+        CREATE INDEX IF NOT EXISTS idx_mail_wf ON mail (wf);
+        CREATE INDEX IF NOT EXISTS idx_mail_sent ON mail (sent_date);
+        CREATE TABLE IF NOT EXISTS mail_drawing (
+            mail_id    INTEGER NOT NULL,
+            unit       TEXT NOT NULL,
+            step       TEXT,
+            discipline TEXT NOT NULL,
+            drawing    TEXT NOT NULL,
+            ver        TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_mail_drawing_key ON mail_drawing (unit, discipline, drawing);
+        CREATE INDEX IF NOT EXISTS idx_mail_drawing_mail ON mail_drawing (mail_id);
+        CREATE TABLE IF NOT EXISTS mail_detail (
+            mail_id   INTEGER PRIMARY KEY,
+            payload   TEXT NOT NULL,
+            synced_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS workflow (
+            workflow_num TEXT PRIMARY KEY,
+            payload      TEXT NOT NULL,
+            terminal     INTEGER NOT NULL,
+            synced_at    REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS sync_state (
+            search_query TEXT NOT NULL,
+            mail_box     TEXT NOT NULL,
+            sent_date    TEXT NOT NULL,
+            synced_at    REAL NOT NULL,
+            PRIMARY KEY (search_query, mail_box)
+        );
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        super().__init__(path or config.warehouse_db_path)
+
+    def _connect(self):
+        opened = self._conn is None
+        conn = super()._connect()
+        if opened:
+            # 早于 mail_drawing 表入库的邮件：按主题补齐
+            rows = conn.execute("SELECT mail_id, subject FROM mail "
+                                "WHERE mail_id NOT IN (SELECT mail_id FROM mail_drawing)").fetchall()
+            if rows:
+                self._insert_drawings(conn, rows)
+                conn.commit()
+        return conn
+
+    @staticmethod
+    def _insert_drawings(conn, mails: list[tuple[int, str]]):
+        conn.executemany("DELETE FROM mail_drawing WHERE mail_id = ?", [(_id,) for _id, _ in mails])
+        conn.executemany("INSERT INTO mail_drawing VALUES (?, ?, ?, ?, ?, ?)",
+                         [(_id, *_d) for _id, _subject in mails for _d in subjectDrawings(_subject)])
+
+    # ---------------- 邮件头 ----------------
+    def upsert_mails(self, mails: Iterable[responseMailInfo], mail_box: Literal["INBOX", "SENTBOX"]):
+        now = time.time()
+        rows = []
+        for _m in mails:
+            _p = _m.parsed
+            rows.append((_m.mailID, _m.MailNo, _m.SentDate.isoformat(), _m.subject, _m.AllAttachmentCount,
+                         BOX_BITS[mail_box], _p and _p.unit, _p and _p.step, _p and _p.discipline,
+                         _p and _p.drawing, _p and _p.ver, _p and _p.wf, now))
+        if not rows:
+            return
+        with self._lock:
+            conn = self._connect()
+            conn.executemany("INSERT INTO mail VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(mail_id) "
+                             "DO UPDATE SET mail_no = excluded.mail_no, sent_date = excluded.sent_date, "
+                             "subject = excluded.subject, attachment_count = excluded.attachment_count, "
+                             "boxes = boxes | excluded.boxes, unit = excluded.unit, step = excluded.step, "
+                             "discipline = excluded.discipline, drawing = excluded.drawing, ver = excluded.ver, "
+                             "wf = excluded.wf, synced_at = excluded.synced_at", rows)
+            self._insert_drawings(conn, [(_r[0], _r[3]) for _r in rows])
+            conn.commit()
+
+    @staticmethod
+    def _drawing_filter(search_params: patternInfo, mail_box: Literal["INBOX", "SENTBOX", "ALL"]) -> tuple[str, list]:
+        """
+        图号条件（mail_drawing 别名 d、mail 别名 m）：主题中任一图号满足即可；图纸号按前缀匹配
+        （与 Lucene 的 drawing* 通配一致），step 精确匹配，只取出现在 mail_box 中的邮件；
+        candidates 与 latest_sent 共用，保证增量同步的下界与离线查询覆盖同一批邮件
+        """
+        return ("d.unit = ? AND d.discipline = ? AND d.drawing >= ? AND d.drawing < ? || '~' AND d.step IS ? "
+                "AND m.boxes & ?",
+                [search_params.unit, search_params.discipline, search_params.drawing, search_params.drawing,
+                 search_params.step or None, boxMask(mail_box)])
+
+    def candidates(self, search_params: patternInfo,
+                   mail_box: Literal["INBOX", "SENTBOX", "ALL"] = "ALL") -> list[responseMailInfo]:
+        """
+        与在线查询 searchQueryCreator(search_params) 对应的候选邮件（按 SentDate 降序）
+
+        指定版本号时按版本过滤；之后应与在线结果一样交给 postprocessMails 做主题片段过滤、去重择优和排序
+        """
+        where, params = self._drawing_filter(search_params, mail_box)
+        sql = ("SELECT DISTINCT m.mail_id, m.mail_no, m.sent_date, m.subject, m.attachment_count "
+               f"FROM mail_drawing d JOIN mail m ON m.mail_id = d.mail_id WHERE {where}")
+        ver = (search_params.ver or "").strip("*_")
+        if ver:
+            sql += " AND d.ver = ?"
+            params.append(ver)
+        with self._lock:
+            rows = self._connect().execute(sql + " ORDER BY m.sent_date DESC", params).fetchall()
+        return [responseMailInfo(mailID=_id, MailNo=_no, SentDate=datetime.fromisoformat(_date), subject=_subject,
+                                 AllAttachmentCount=_count)
+                for _id, _no, _date, _subject, _count in rows]
+
+    def latest_sent(self, search_params: patternInfo,
+                    mail_box: Literal["INBOX", "SENTBOX"]) -> Optional[datetime]:
+        """
+        该图号在 mail_box 中已入库邮件的最新 SentDate，用作该邮箱增量同步的下界
+
+        水位按邮箱分开：SENTBOX 中较新的邮件不能作为 INBOX 的下界，否则 INBOX 中更早的邮件永远不会被同步
+        """
+        where, params = self._drawing_filter(search_params, mail_box)
+        with self._lock:
+            row = self._connect().execute("SELECT MAX(m.sent_date) FROM mail_drawing d JOIN mail m "
+                                          f"ON m.mail_id = d.mail_id WHERE {where}", params).fetchone()
+        return datetime.fromisoformat(row[0]) if row and row[0] else None
+
+    def workflow_numbers(self) -> list[str]:
+        with self._lock:
+            return [_r[0] for _r in self._connect().execute(
+                "SELECT DISTINCT wf FROM mail WHERE wf IS NOT NULL ORDER BY wf")]
+
+    def mail_ids(self, without_detail: bool = False) -> list[int]:
+        sql = "SELECT mail_id FROM mail"
+        if without_detail:
+            sql += " WHERE mail_id NOT IN (SELECT mail_id FROM mail_detail)"
+        with self._lock:
+            return [_r[0] for _r in self._connect().execute(sql + " ORDER BY mail_id")]
+
+    # ---------------- 同步水位（按查询条件整体同步） ----------------
+    def sync_watermark(self, search_query: str, mail_box: str) -> Optional[datetime]:
+        with self._lock:
+            row = self._connect().execute("SELECT sent_date FROM sync_state WHERE search_query = ? AND mail_box = ?",
+                                          (search_query, mail_box)).fetchone()
+        return datetime.fromisoformat(row[0]) if row else None
+
+    def set_sync_watermark(self, search_query: str, mail_box: str, sent_date: datetime):
+        with self._lock:
+            conn = self._connect()
+            conn.execute("INSERT INTO sync_state VALUES (?, ?, ?, ?) ON CONFLICT(search_query, mail_box) DO UPDATE "
+                         "SET sent_date = MAX(sent_date, excluded.sent_date), synced_at = excluded.synced_at",
+                         (search_query, mail_box, sent_date.isoformat(), time.time()))
+            conn.commit()
+
+    # ---------------- 邮件详情 ----------------
+    @staticmethod
+    def _dumps_detail(detail: MailDetail) -> str:
+        return json.dumps(asdict(detail), ensure_ascii=False, default=datetime.isoformat)
+
+    @staticmethod
+    def _loads_detail(payload: str) -> MailDetail:
+        data = json.loads(payload)
+        return MailDetail(mail_id=data["mail_id"], subject=data["subject"],
+                          sent_date=datetime.fromisoformat(data["sent_date"]) if data["sent_date"] else None,
+                          mail_data=data.get("mail_data_html", data.get("mail_data", "")),  # 旧记录存的是纯文本
+                          from_user_details=FromUserDetails(**data["from_user_details"]),
+                          attachments=[RegisteredDocumentAttachment(**_a) for _a in data["attachments"]],
+                          recipients=[Recipient(**_r) for _r in data["recipients"]])
+
+    def put_detail(self, detail: MailDetail):
+        with self._lock:
+            conn = self._connect()
+            conn.execute("INSERT OR REPLACE INTO mail_detail VALUES (?, ?, ?)",
+                         (int(detail.mail_id), self._dumps_detail(detail), time.time()))
+            conn.commit()
+
+    def detail(self, mail_id) -> Optional[MailDetail]:
+        with self._lock:
+            row = self._connect().execute("SELECT payload FROM mail_detail WHERE mail_id = ?",
+                                          (int(mail_id),)).fetchone()
+        return self._loads_detail(row[0]) if row else None
+
+    # ---------------- 工作流 ----------------
+    def put_workflow(self, workflow_num: str, result: WorkflowSearchResult):
+        with self._lock:
+            conn = self._connect()
+            conn.execute("INSERT OR REPLACE INTO workflow VALUES (?, ?, ?, ?)",
+                         (workflow_num, WorkflowCache._dumps(result), int(WorkflowCache.is_terminal(result)),
+                          time.time()))
+            conn.commit()
+
+    def workflow(self, workflow_num: str) -> Optional[WorkflowSearchResult]:
+        with self._lock:
+            row = self._connect().execute("SELECT payload FROM workflow WHERE workflow_num = ?",
+                                          (workflow_num,)).fetchone()
+        return WorkflowCache._loads(row[0]) if row else None
+
+    def terminal_workflows(self) -> set[str]:
+        with self._lock:
+            return {_r[0] for _r in self._connect().execute("SELECT workflow_num FROM workflow WHERE terminal = 1")}
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            conn = self._connect()
+            return {_t: conn.execute(f"SELECT COUNT(*) FROM {_t}").fetchone()[0]
+                    for _t in ("mail", "mail_detail", "workflow")}
+
+
+# 进程内共享的仓库
+MAIL_WAREHOUSE = MailWarehouse()
+
+
+# ---------------- 同步（只有这里访问 API） ----------------
+def trackerDrawings(xlsx_path: str, max_col: int = 2) -> list[patternInfo]:
+    """读取跟踪表 / 图纸清单中前 max_col 列满足 MAIN_RE 的图号（去重，保持出现顺序）"""
+    seen: dict[tuple, patternInfo] = {}
+    wb = openpyxl.load_workbook(xlsx_path, read_only=True, data_only=True)
+    try:
+        for ws in wb.worksheets:
+            for values in ws.iter_rows(max_col=max_col, values_only=True):
+                for value in values:
+                    mo = MAIN_RE.match(str(value).strip()) if isinstance(value, str) else None
+                    if mo:
+                        params = patternInfo(unit=mo["unit"], discipline=mo["discipline"], drawing=mo["drawing"],
+                                             step=mo["step"])
+                        seen.setdefault((params.unit, params.step, params.discipline, params.drawing), params)
+    finally:
+        wb.close()
+    return list(seen.values())
+
+
+async def syncDrawingsAsync(drawings: list[patternInfo], full: bool = False,
+                            warehouse: Optional[MailWarehouse] = None) -> int:
+    """按图号批量同步邮件头（OR 合并查询）；非 full 时每个图号在每个邮箱中只查询该邮箱已入库最新邮件之后的邮件"""
+    # main 导入本模块用于离线查询，同步所需的在线函数在这里导入，避免循环导入
+    from main import searchMailBoxBatchAsync, splitMailBatches
+
+    warehouse = warehouse or MAIL_WAREHOUSE
+    synced = 0
+
+    async def _run(batch: list, box: Literal["INBOX", "SENTBOX"]):
+        nonlocal synced
+        for box_mail in await searchMailBoxBatchAsync(batch, box):
+            warehouse.upsert_mails(box_mail, box)
+            synced += len(box_mail)
+
+    jobs = []
+    for box in ("SENTBOX", "INBOX"):
+        # 增量下界按 (图号, 邮箱) 取
+        items = [(_d, None if full else warehouse.latest_sent(_d, box)) for _d in drawings]
+        jobs += [_run([items[i] for i in batch], box)
+                 for batch in splitMailBatches(items, config.mail_batch_size, config.mail_batch_max_query_length)]
+    await asyncio.gather(*jobs)
+    return synced
+
+
+async def syncQueryAsync(search_query: str, full: bool = False, warehouse: Optional[MailWarehouse] = None) -> int:
+    """按查询条件整体同步邮件头：逐页入库，非 full 时从上次同步到的 SentDate 当天开始"""
+    from main import ASYNC_CLIENT, MAIL_RETURN_FIELDS, parseMailSearchPage
+
+    warehouse = warehouse or MAIL_WAREHOUSE
+    synced = 0
+
+    async def _sync_box(box: Literal["INBOX", "SENTBOX"]):
+        watermark = None if full else warehouse.sync_watermark(search_query, box)
+        query = search_query if watermark is None else f"({search_query}) AND sentdate:[{watermark:%Y%m%d} TO *]"
+        newest = watermark
+
+        async def _page(page_number: int):
+            content = await ASYNC_CLIENT.get(url=f"{config.resource_url}/api/projects/{config.project_id}/mail",
+                                             params={"mail_box": box, "search_query": query,
+                                                     "return_fields": MAIL_RETURN_FIELDS,
+                                                     "sort_field": "sentdate", "sort_direction": "DESC",
+                                                     "search_type": "PAGED", "page_size": config.mail_page_size,
+                                                     "page_number": page_number})
+            return parseMailSearchPage(content)
+
+        def _store(mails: list[responseMailInfo]):
+            nonlocal newest, synced
+            warehouse.upsert_mails(mails, box)
+            synced += len(mails)
+            for _m in mails:
+                newest = _m.SentDate if newest is None else max(newest, _m.SentDate)
+
+        page_info, mails = await _page(1)
+        _store(mails)
+        window = max(config.mail_page_prefetch, 1)
+        for start in range(2, page_info.total_pages + 1, window):
+            pages = range(start, min(start + window, page_info.total_pages + 1))
+            for _, page_mails in await asyncio.gather(*(_page(_n) for _n in pages)):
+                _store(page_mails)
+        # 全部页入库后再前移水位
+        if newest is not None:
+            warehouse.set_sync_watermark(search_query, box, newest)
+
+    await asyncio.gather(_sync_box("SENTBOX"), _sync_box("INBOX"))
+    return synced
+
+
+async def syncWorkflowsAsync(warehouse: Optional[MailWarehouse] = None) -> int:
+    """同步邮件主题中出现的全部工作流（已结束的工作流不再请求）"""
+    from main import fetchWorkflowAsync
+
+    warehouse = warehouse or MAIL_WAREHOUSE
+    done = warehouse.terminal_workflows()
+    numbers = [_n for _n in warehouse.workflow_numbers() if _n not in done]
+
+    async def _sync(workflow_num: str):
+        warehouse.put_workflow(workflow_num, await fetchWorkflowAsync(workflow_num))
+
+    await asyncio.gather(*(_sync(_n) for _n in numbers))
+    return len(numbers)
+
+
+async def syncDetailsAsync(warehouse: Optional[MailWarehouse] = None) -> int:
+    """同步尚无详情的邮件的详情（含附件列表）"""
+    from main import ASYNC_CLIENT
+    from xml_parse import parseMailDetail
+
+    warehouse = warehouse or MAIL_WAREHOUSE
+    mail_ids = warehouse.mail_ids(without_detail=True)
+
+    async def _sync(mail_id: int):
+        content = await ASYNC_CLIENT.get(url=f"{config.resource_url}/api/projects/{config.project_id}/mail/{mail_id}")
+        warehouse.put_detail(parseMailDetail(content))
+
+    await asyncio.gather(*(_sync(_id) for _id in mail_ids))
+    return len(mail_ids)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="本地邮件仓库：从 Aconex 同步邮件头、邮件详情和工作流")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    sync_parser = subparsers.add_parser("sync", help="同步到本地仓库")
+    sync_parser.add_argument("--tracker", action="append", default=[], help="按该 xlsx 中的图号同步（可重复）")
+    sync_parser.add_argument("--query", default=None, help="按查询条件整体同步，默认 config.warehouse_search_query")
+    sync_parser.add_argument("--full", action="store_true", help="忽略已入库的水位，全量同步")
+    sync_parser.add_argument("--workflows", action="store_true", help="同时同步工作流")
+    sync_parser.add_argument("--details", action="store_true", help="同时同步邮件详情（附件列表）")
+    subparsers.add_parser("stats", help="打印仓库中的记录数")
+    args = parser.parse_args()
+
+    if args.command == "sync":
+        from aconex_async import run_sync
+        from main import requestToken
+
+        # 同步总是访问 API，且不读取邮件搜索缓存
+        config.offline = False
+        config.mail_cache_bypass = True
+        requestToken()
+        if args.tracker:
+            drawings = [_d for _path in args.tracker for _d in trackerDrawings(_path)]
+            print(f"Synced {run_sync(syncDrawingsAsync(drawings, full=args.full))} mails "
+                  f"for {len(drawings)} drawings.")
+        else:
+            query = args.query or config.warehouse_search_query
+            print(f"Synced {run_sync(syncQueryAsync(query, full=args.full))} mails for '{query}'.")
+        if args.workflows:
+            print(f"Synced {run_sync(syncWorkflowsAsync())} workflows.")
+        if args.details:
+            print(f"Synced {run_sync(syncDetailsAsync())} mail details.")
+    print(MAIL_WAREHOUSE.stats())
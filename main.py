@@ -1,54 +1,57 @@
-import base64
+import argparse
+import asyncio
+import atexit
 import os.path
 import re
 import threading
-import xml.etree.ElementTree as ET
-from datetime import datetime, timedelta, timezone
-from typing import Literal, Optional, List, Tuple
-from concurrent.futures import ThreadPoolExecutor, wait, ALL_COMPLETED
+import time
+from contextlib import nullcontext
+from datetime import datetime
+from typing import Callable, Iterable, Literal, Optional, List, Sequence, Tuple
+from urllib.parse import quote
 from urllib3.util import Retry
 
+import aiohttp
 import openpyxl
 import requests
 from requests.adapters import HTTPAdapter
 from openpyxl.cell import MergedCell, Cell
 from openpyxl.styles import PatternFill, Border, Side
+from openpyxl.worksheet.worksheet import Worksheet
 
+from adaptive_limiter import AdaptiveLimiter, RETRY_STATUS, retryDelay
+from aconex_async import AsyncAconexClient, run_sync, close_client
+from aconex_cache import MailSearchCache, SentDateWatermark, WorkflowCache
 from config import config
-from dataclass import responseMailInfo, patternInfo, UserRef, WorkflowSearchResult, Workflow, searchResult
+from mail_warehouse import MAIL_WAREHOUSE
+from metrics import METRICS
+from profiling import PROFILER
+from token_manager import TokenManager, BearerAuth
+from dataclass import responseMailInfo, patternInfo, WorkflowSearchResult, searchResult, PageInfo
+from workbook_io import saveWorkbookAtomic, CheckpointSaver, PendingRow, scanPendingRows, applyPendingRows
+from subject_model import MAIN_RE, verSortKey, mailQuality, selectBestMail
+from xml_parse import parseMailSearch, parseWorkflowSearch
 
 # XLSX_WRITE
 BASE_COL = 9
+MAX_COL = 50    # 处理 / 清理的最大列数
 
 # LOCK
-ACCESS_TOKEN_LOCK = threading.Lock()
 CELL_WRITE_LOCK = threading.Lock()
+CELL_WRITE_GATE = asyncio.Lock()    # sheet 收尾在工作线程中持有 CELL_WRITE_LOCK 期间占用，事件循环上的写入先异步等待它
 
 # PATH
 XLSX_PATH = r"./图纸进度跟踪表.xlsx"
 # EXPORT_PATH = rf"./{os.path.splitext(os.path.basename(XLSX_PATH))[0]}_out.xlsx"
 EXPORT_PATH = XLSX_PATH
 
+# API
+MAIL_RETURN_FIELDS = "docno,subject,sentdate,allAttachmentCount,totalAttachmentsSize"
+
 # GLOBAL VARS
 REQUEST_DATA: dict[str, searchResult] = dict()
-
-MAIN_RE = re.compile(
-    r'^[ \t]*'                                        # 行首半角空白
-    r'(?:.*?\((?P<wf>[A-Za-z]+-\d+)\)[ \t]*)?'        # 可选：(WF-001039)——前后可有任意文字
-    r'.*?'                                            # 仍可再出现任意前缀（“通知：回复: 最终 ”等）
-    r'SLDS-BCEG-'                                     # 固定文件名前缀
-    r'(?P<unit>\d{3})-'                               # 单体
-    r'(?:(?P<step>\d{4})-)?'                          # 支持新增的四位新施工阶段代码（可选）
-    r'SDS-'
-    r'(?P<discipline>[A-Z]+)-'                        # 专业
-    r'(?P<drawing>[A-Z0-9]+)'                         # 图纸号
-    r'(?:_*(?P<ver>[A-Z]|\d+\+[A-Z]|\d+[A-Z]|\d+))?'  # 版本号（可选）
-    r'(?:[ \t]+(?P<title>.+))?'                       # 图名（可选）
-    r'[ \t]*$'                                        # 行尾半角空白
-)
-
-VER_RE = re.compile(r'^(?:(?P<num>\d+)(?:\+(?P<plus_letter>[A-Z])|(?P<letter>[A-Z])?)'
-                    r'|(?P<pure_letter>[A-Z]))$')
+PENDING_WATERMARKS: dict[str, datetime] = dict()    # 本次运行得到的新水位，保存工作簿后再落盘
+PENDING_RESULTS: dict[str, list[responseMailInfo]] = dict()    # 与新水位对应的邮件结果，随水位一起落盘
 
 
 def clean_str(s: str) -> str:
@@ -75,70 +78,123 @@ def get_session() -> requests.Session:
         # 全局代理
         if config.proxies:
             session.proxies.update(config.proxies)
-        # 重试策略
+        # 连接级重试；429/5xx 的重试在 requestWithRetry 中进行，以便限流器观察到每次尝试
         retry = Retry(
             total=config.retry_times,
             backoff_factor=config.retry_delay,
-            status_forcelist=[429, 500, 502, 503, 504],
+            respect_retry_after_header=False,
             allowed_methods=["GET", "POST"],
         )
         adapter = HTTPAdapter(max_retries=retry)
         session.mount("http://", adapter)
         session.mount("https://", adapter)
+        # 资源 API 统一由 TOKEN_MANAGER 添加 Bearer token
+        session.auth = BearerAuth(TOKEN_MANAGER)
         _thread_local.session = session
     return _thread_local.session
 
 
+# 同步与异步请求共用的自适应并发限流器
+LIMITER = AdaptiveLimiter()
+
+
+def requestWithRetry(method: str, url: str, limited: bool = True, **kwargs) -> requests.Response:
+    """
+    发送请求；429/5xx 按 config.retry_times / retry_delay 指数退避重试（优先遵循 Retry-After）
+
+    limited 为 True 时每次尝试占用一个 LIMITER 名额并记录延迟 / 状态码，退避等待期间不占用名额；
+    每次尝试都记录到 METRICS
+    """
+    session = get_session()
+    attempt = 0
+    while True:
+        with LIMITER if limited else nullcontext():
+            start = time.monotonic()
+            status = None
+            nbytes = 0
+            try:
+                response = session.request(method, url, **kwargs)
+                status = response.status_code
+                # 流式下载不在这里读取响应体，按 Content-Length 统计
+                nbytes = int(response.headers.get("Content-Length") or 0) if kwargs.get("stream") \
+                    else len(response.content)
+            finally:
+                latency = time.monotonic() - start
+                if limited:
+                    LIMITER.record(latency, status)
+                METRICS.observe_request(url, method, status, latency, nbytes, retry=attempt > 0)
+        if status not in RETRY_STATUS or attempt >= config.retry_times:
+            return response
+        response.close()
+        time.sleep(retryDelay(attempt, response.headers.get("Retry-After")))
+        attempt += 1
+
+
 def get_with_retry(url, **kwargs):
-    return get_session().get(url, **kwargs)
+    return requestWithRetry("GET", url, **kwargs)
 
 
 def post_with_retry(url, **kwargs):
-    return get_session().post(url, **kwargs)
+    return requestWithRetry("POST", url, **kwargs)
 
 
-def sortMailsByVer(mails: list[responseMailInfo]) -> list[responseMailInfo]:
+def reportLimiter():
+    if LIMITER.requests:
+        print(LIMITER.summary())
+
+
+atexit.register(reportLimiter)
+# 退出时写出请求 / 阶段指标（config.metrics_dir）
+atexit.register(METRICS.export)
+
+
+def fetchAccessToken() -> dict:
     """
-    Sort the mails by version.
-
-    新优先级（同数字情况下）：
-        1) 数字+字母   例：12A
-        2) 纯数字       例：12
-        3) 数字+‘+字母’ 例：12+A
-        4) 纯字母       例：A
-        5) 异常 / 无版本
+    Request an OAuth2 token using client credentials grant type
+
+    https://help.aconex.com/zh/apis/implement-smart-construction-platform-oauth/#Implement-OAuth-in-a-User-Bound-Integration
     """
+    # 请求级 Basic Auth (https://en.wikipedia.org/wiki/Basic_access_authentication)，覆盖会话级的 BearerAuth
+    # 不占用限流名额：其他请求可能正持有名额等待新 token
+    response = post_with_retry(limited=False, url=f"{config.lobby_url}/auth/token",
+                               headers={"Content-Type": "application/x-www-form-urlencoded"},
+                               auth=(config.client_id, config.client_secret),
+                               data={"grant_type": "client_credentials", "user_id": config.aconex_user_id,
+                                     "user_site": config.aconex_instance_url})
+
+    response.raise_for_status()
+    return response.json()
+
 
-    def _ver_key(ver: str) -> tuple[int, int, int]:
-        _m = VER_RE.match(ver) if ver else None
-        if not _m:
-            return 0, 4, 0  # 异常值，永远最后
+# access token：单点刷新 + 到期前后台续期
+TOKEN_MANAGER = TokenManager(fetch=fetchAccessToken)
 
-        # ── 分类后再组合排序键 ──
-        # 第一位：数字降序（取负）
-        # 第二位：档位码（越小优先）
-        # 第三位：字母逆序（Z→A），无字母时置 0
-        num_rank = -int(_m.group('num')) if _m.group('num') else 0
 
-        if _m.group('letter'):                # 数字+字母 —— 档位 0（最高）
-            return num_rank, 0, -ord(_m.group('letter'))
-        if _m.group('num') and not any((_m.group('plus_letter'),
-                                        _m.group('letter'),
-                                        _m.group('pure_letter'))):  # 纯数字 —— 档位 1
-            return num_rank, 1, 0
-        if _m.group('plus_letter'):           # 数字+‘+字母’ —— 档位 2
-            return num_rank, 2, -ord(_m.group('plus_letter'))
-        if _m.group('pure_letter'):           # 纯字母 —— 档位 3
-            return 0, 3, -ord(_m.group('pure_letter'))
+def requestToken() -> dict:
+    """立即刷新 access token 并返回认证接口的响应（离线模式下不访问 API，返回空字典）"""
+    if config.offline:
+        return {}
+    return TOKEN_MANAGER.refresh()
 
-        return 0, 4, 0        # 理论兜底，不会触发
 
-    def _mail_ver_key(mail: responseMailInfo):
-        _m = MAIN_RE.match(mail.subject)
-        ver = _m.group('ver') if (_m and _m.group('ver')) else ''
-        return _ver_key(ver)
+# 异步客户端：全进程共享一个连接池，与同步请求共用 LIMITER
+ASYNC_CLIENT = AsyncAconexClient(token_manager=TOKEN_MANAGER, limiter=LIMITER)
+atexit.register(close_client, ASYNC_CLIENT)
 
-    return sorted(mails, key=_mail_ver_key)
+# 邮件搜索结果的本地持久化缓存
+MAIL_CACHE = MailSearchCache()
+# 增量同步水位
+WATERMARK = SentDateWatermark()
+# 工作流查询结果缓存，及同一工作流的在途请求（供并发调用方共享）
+WORKFLOW_CACHE = WorkflowCache()
+_WORKFLOW_IN_FLIGHT: dict[str, asyncio.Future] = dict()
+
+
+def sortMailsByVer(mails: list[responseMailInfo]) -> list[responseMailInfo]:
+    """
+    Sort the mails by version (see verSortKey).
+    """
+    return sorted(mails, key=lambda _m: _m.parsed.ver_key if _m.parsed else verSortKey(''))
 
 
 def filter_mails(mails: List[responseMailInfo]) -> List[responseMailInfo]:
@@ -148,238 +204,437 @@ def filter_mails(mails: List[responseMailInfo]) -> List[responseMailInfo]:
     unique = {_m.mailID: _m for _m in mails}.values()
 
     # ---------- ② 内部工具函数 ----------
-    def _parse_key(subj: str) -> Optional[Tuple[str, str, str, str, str]]:
-        mo = MAIN_RE.search(subj)
-        if not mo:
-            return None
-        return mo.group('unit'), mo.group('discipline'), mo.group('drawing'), mo.group('ver') or '', mo.group('step') or ''
-
-    def _quality(subj: str) -> int:
-        if '(WF-' in subj and subj.startswith('最终'):
-            return 2
-        elif '(WF-' in subj:
-            return 1
-        return 0
-
     def _better(prev: Optional[responseMailInfo], cand: responseMailInfo) -> responseMailInfo:
         """prev 允许为 None；返回质量更高 / 时间更新的邮件"""
         if prev is None:
             return cand
-        k_prev = (_quality(prev.subject), prev.SentDate)
-        k_cand = (_quality(cand.subject), cand.SentDate)
+        k_prev = (prev.parsed.quality, prev.SentDate)
+        k_cand = (cand.parsed.quality, cand.SentDate)
         return cand if k_cand > k_prev else prev
 
     # ---------- ③ 聚合并优选 ----------
     best: dict[Tuple[str, str, str, str, str], responseMailInfo] = {}
     for _m in unique:
-        key = _parse_key(_m.subject)
-        if key is None:  # subject 不满足规则可视需求忽略
+        if _m.parsed is None:  # subject 不满足规则可视需求忽略
             continue
+        key = _m.parsed.key
         best[key] = _better(best.get(key), _m)  # 用 .get()，首轮 prev=None
 
     return list(best.values())
 
 
-def responseClean(mail_response: list[responseMailInfo], search_params: patternInfo) -> list[responseMailInfo]:
+def drawingSubject(search_params: patternInfo) -> str:
+    """图号在邮件主题中的固定片段，如 SLDS-BCEG-001-0405-SDS-I-I001"""
+    return f"SLDS-BCEG-{search_params.unit}-{search_params.step}-SDS-{search_params.discipline}-{search_params.drawing}" if search_params.step else f"SLDS-BCEG-{search_params.unit}-SDS-{search_params.discipline}-{search_params.drawing}"
+
+
+def responseClean(mail_response: list[responseMailInfo], search_params: patternInfo,
+                  ordered: bool = True) -> list[responseMailInfo]:
     """
     Clean the mail response by filtering based title
+
+    ordered 为 False 时不按版本排序（只需用 selectBestMail 取最新版本时）
     """
-    subject = f"SLDS-BCEG-{search_params.unit}-{search_params.step}-SDS-{search_params.discipline}-{search_params.drawing}" if search_params.step else f"SLDS-BCEG-{search_params.unit}-SDS-{search_params.discipline}-{search_params.drawing}"
+    subject = drawingSubject(search_params)
     # return sortMailsByVer([mail for mail in mail_response if mail.subject.startswith(subject)])
-    return sortMailsByVer([mail for mail in mail_response if subject in mail.subject])
+    cleaned = [mail for mail in mail_response if subject in mail.subject]
+    return sortMailsByVer(cleaned) if ordered else cleaned
 
 
-def requestToken() -> dict:
+def drawingKey(search_params: patternInfo) -> str:
+    """增量同步水位的键：unit/step/discipline/drawing"""
+    return f"{search_params.unit}/{search_params.step or ''}/{search_params.discipline}/{search_params.drawing}"
+
+
+def searchQueryCreator(search_params: patternInfo, sent_after: Optional[datetime] = None) -> str:
     """
-    Request an OAuth2 token using client credentials grant type
+    根据深化图编号规则生成 search_query 字符串
+    unit     单体号, 3 位 (e.g. '001')
+    discipline     专业代码, 大写 (e.g. 'HV')
+    drawing  图号, 3 位 (e.g. '001')
+    ver      版本号, 形如 '_0', '_A'；默认为 '*' 通配全部版本
+    sent_after  增量同步时的发送日期下界（按天，精确比较在本地完成）
+    """
+    # Lucene 表达式：拆分词后用 AND 组合 + 通配符
+    tokens = [t for t in [search_params.unit, search_params.discipline, search_params.step,
+                          f"{search_params.drawing}{search_params.ver}"] if t]
+    subject_cond = " AND ".join(f"{tok}" for tok in tokens)
+    # query = rf"subject:({subject_cond}) AND corrtypeid:23"
+    query = rf"subject:({subject_cond})"
+    if sent_after is not None:
+        query += rf" AND sentdate:[{sent_after:%Y%m%d} TO *]"
+    return query
+
+
+def parseMailSearchPage(xml_text: bytes) -> Tuple[PageInfo, list[responseMailInfo]]:
+    """
+    处理返回的邮件数据，返回分页信息和 responseMailInfo 列表（非分页查询时按单页处理）
+    """
+    with METRICS.stage("parse"):
+        return parseMailSearch(xml_text)
 
-    https://help.aconex.com/zh/apis/implement-smart-construction-platform-oauth/#Implement-OAuth-in-a-User-Bound-Integration
+
+def responseMailInfoPostprocess(xml_text: bytes) -> list[responseMailInfo]:
     """
+    处理返回的邮件数据，转换为 responseMailInfo 列表
+    """
+    return parseMailSearchPage(xml_text)[1]
 
-    def basicAuthEncode(client_id: str, client_secret: str) -> str:
-        """
-        Encode client_id and client_secret in base64 for Basic Auth
 
-        https://en.wikipedia.org/wiki/Basic_access_authentication
-        """
-        auth_str = f"{client_id}:{client_secret}"
-        b64_encoded = base64.b64encode(auth_str.encode()).decode()
-        return b64_encoded
+def newestFinalFound(mails: list[responseMailInfo], search_params: patternInfo) -> bool:
+    """提前结束条件：该图号已出现的最新版本中，已经有最终审核结果邮件（最终 + (WF-)）"""
+    subject = drawingSubject(search_params)
+    newest_key, final_keys = None, set()
+    for _mail in mails:
+        if subject not in _mail.subject:
+            continue
+        key = _mail.parsed.ver_key if _mail.parsed else verSortKey('')
+        newest_key = key if newest_key is None else min(newest_key, key)
+        if mailQuality(_mail.subject) == 2:
+            final_keys.add(key)
+    return newest_key is not None and newest_key in final_keys
 
-    response = post_with_retry(url=f"{config.lobby_url}/auth/token",
-                               headers={"Content-Type": "application/x-www-form-urlencoded",
-                                        "Authorization": f"Basic {basicAuthEncode(config.client_id, config.client_secret)}"},
-                               data={"grant_type": "client_credentials", "user_id": config.aconex_user_id,
-                                     "user_site": config.aconex_instance_url})
 
-    response.raise_for_status()
+async def fetchMailPagesAsync(search_query: str, mail_box: Literal["INBOX", "SENTBOX"],
+                              stop: Optional[Callable[[list[responseMailInfo]], bool]] = None) -> list[responseMailInfo]:
+    """
+    分页搜索：先取第 1 页得到总页数，其余页并发预取，按页码顺序合并
 
-    config.access_token = response.json().get("access_token")
-    config.access_token_expires = datetime.now() + timedelta(seconds=response.json().get("expires_in") - 300)
-    return response.json()
+    stop 不为空时（结果按 sentdate DESC 排序），每 config.mail_page_prefetch 页检查一次，满足条件即不再请求后续页
+    """
+    async def _fetch_page(page_number: int) -> Tuple[PageInfo, list[responseMailInfo]]:
+        content = await ASYNC_CLIENT.get(url=f"{config.resource_url}/api/projects/{config.project_id}/mail",
+                                         params={"mail_box": mail_box, "search_query": search_query,
+                                                 "return_fields": MAIL_RETURN_FIELDS,
+                                                 "sort_field": "sentdate", "sort_direction": "DESC",
+                                                 "search_type": "PAGED", "page_size": config.mail_page_size,
+                                                 "page_number": page_number})
+        return parseMailSearchPage(content)
+
+    page_info, mail = await _fetch_page(1)
+    window = config.mail_page_prefetch if stop is not None else page_info.total_pages
+    for start in range(2, page_info.total_pages + 1, max(window, 1)):
+        if stop is not None and stop(mail):
+            break
+        pages = range(start, min(start + window, page_info.total_pages + 1))
+        for _, page_mail in await asyncio.gather(*(_fetch_page(_n) for _n in pages)):
+            mail += page_mail
+    return mail
+
+
+async def fetchMailBoxAsync(search_query: str, mail_box: Literal["INBOX", "SENTBOX"],
+                            stop: Optional[Callable[[list[responseMailInfo]], bool]] = None) -> list[responseMailInfo]:
+    """单个邮箱的分页搜索（优先读取本地缓存；提前结束的结果单独缓存）"""
+    cache_box = mail_box if stop is None else f"{mail_box}|early"
+    box_mail = MAIL_CACHE.get(search_query, cache_box)
+    if box_mail is None:
+        box_mail = await fetchMailPagesAsync(search_query, mail_box, stop=stop)
+        MAIL_CACHE.put(search_query, cache_box, box_mail)
+    return box_mail
 
 
-def searchMail(search_params: patternInfo, mail_box: Literal["INBOX", "SENTBOX", "ALL"] = "ALL") -> list[
-    responseMailInfo]:
+def postprocessMails(mail: list[responseMailInfo], search_params: patternInfo,
+                     sent_after: Optional[datetime] = None, ordered: bool = True) -> list[responseMailInfo]:
+    """按水位过滤、去重择优，ordered 为 True 时再按版本排序"""
+    if sent_after is not None:
+        mail = [_m for _m in mail if _m.SentDate > sent_after]
+
+    # 使用 filter_mails 去重和择优
+    mail = filter_mails(mail)
+
+    # mail 排序
+    return responseClean(mail_response=mail, search_params=search_params, ordered=ordered)
+
+
+async def searchMailAsync(search_params: patternInfo, mail_box: Literal["INBOX", "SENTBOX", "ALL"] = "ALL",
+                          sent_after: Optional[datetime] = None, early_exit: Optional[bool] = None,
+                          ordered: bool = True) -> list[responseMailInfo]:
     """
-    Search mails by subject
+    Search mails by subject (async)
+
+    sent_after 不为空时只返回 SentDate 晚于该时间的邮件
+    early_exit 为 True 时（默认取 config.mail_search_early_exit），找到最新版本的最终审核邮件后不再翻页，
+    此时只保证最新版本的邮件与完整查询一致
+    ordered 为 False 时结果不按版本排序
 
     https://help.aconex.com/zh/apis/mail-api-developer-guide/
     """
-    global ACCESS_TOKEN_LOCK
-
-    def searchQueryCreator() -> str:
-        """
-        根据深化图编号规则生成 search_query 字符串
-        unit     单体号, 3 位 (e.g. '001')
-        discipline     专业代码, 大写 (e.g. 'HV')
-        drawing  图号, 3 位 (e.g. '001')
-        ver      版本号, 形如 '_0', '_A'；默认为 '*' 通配全部版本
-        """
-        # Lucene 表达式：拆分词后用 AND 组合 + 通配符
-        tokens = [t for t in [search_params.unit, search_params.discipline, search_params.step,
-                              f"{search_params.drawing}{search_params.ver}"] if t]
-        subject_cond = " AND ".join(f"{tok}" for tok in tokens)
-        # query = rf"subject:({subject_cond}) AND corrtypeid:23"
-        query = rf"subject:({subject_cond})"
-        return query
-
-    def responseMailInfoPostprocess(xml_text: bytes) -> list[responseMailInfo]:
-        """
-        处理返回的邮件数据，转换为 responseMailInfo 列表
-        """
-        root = ET.fromstring(xml_text.decode("utf-8"))
-        export_list = []
-        for _mail in root.find('SearchResults').iter('Mail'):
-            # print(ET.tostring(m, encoding='utf-8').decode('utf-8'))
-            export_list.append(responseMailInfo(mailID=int(_mail.attrib['MailId']), MailNo=_mail.findtext('MailNo'),
-                                                SentDate=datetime.fromisoformat(_mail.findtext('SentDate').rstrip('Z')),
-                                                subject=_mail.findtext('Subject'),
-                                                AllAttachmentCount=int(_mail.findtext('AllAttachmentCount')), ))
-        return export_list
-
     # 检查输入变量
     print(f"Search params: {search_params.__dict__}, mail box: {mail_box}")
 
-    # 检查当前时间是否超过了config.access_token_expires，如果超过则调用requestToken()刷新token
-    if not config.access_token_expires or not config.access_token or datetime.now() >= config.access_token_expires:
-        with ACCESS_TOKEN_LOCK:
-            print("Access token expired, refreshing...")
-            requestToken()
+    if config.offline:
+        return postprocessMails(MAIL_WAREHOUSE.candidates(search_params, mail_box), search_params,
+                                sent_after=sent_after, ordered=ordered)
 
-    mail = []
+    search_query = searchQueryCreator(search_params, sent_after=sent_after)
+    early_exit = config.mail_search_early_exit if early_exit is None else early_exit
+    stop = (lambda _mails: newestFinalFound(_mails, search_params)) if early_exit else None
 
-    # SentBox
-    if mail_box == "SENTBOX" or mail_box == "ALL":
-        response = get_with_retry(url=f"{config.resource_url}/api/projects/{config.project_id}/mail",
-                                  headers={"Authorization": f"Bearer {config.access_token}"},
-                                  params={"mail_box": "SENTBOX", "search_query": searchQueryCreator(),
-                                          "return_fields": "docno,subject,sentdate,allAttachmentCount,totalAttachmentsSize",
-                                          "sort_field": "sentdate", "sort_direction": "DESC"})
+    # SentBox, InBox 并发查询（API 不支持单次查询两个邮箱）；按 SENTBOX、INBOX 的顺序合并后统一由 filter_mails 去重
+    boxes = [box for box in ("SENTBOX", "INBOX") if mail_box == box or mail_box == "ALL"]
+    mail = [_m for box_mail in await asyncio.gather(*(fetchMailBoxAsync(search_query, box, stop=stop) for box in boxes))
+            for _m in box_mail]
 
-        response.raise_for_status()
+    return postprocessMails(mail, search_params, sent_after=sent_after, ordered=ordered)
 
-        mail += responseMailInfoPostprocess(response.content)
 
-    # InBox
-    if mail_box == "INBOX" or mail_box == "ALL":
-        response = get_with_retry(url=f"{config.resource_url}/api/projects/{config.project_id}/mail",
-                                  headers={"Authorization": f"Bearer {config.access_token}"},
-                                  params={"mail_box": "INBOX", "search_query": searchQueryCreator(),
-                                          "return_fields": "docno,subject,sentdate,allAttachmentCount,totalAttachmentsSize",
-                                          "sort_field": "sentdate", "sort_direction": "DESC"},)
+def searchMail(search_params: patternInfo, mail_box: Literal["INBOX", "SENTBOX", "ALL"] = "ALL",
+               sent_after: Optional[datetime] = None, early_exit: Optional[bool] = None) -> list[responseMailInfo]:
+    """
+    Search mails by subject
 
-        response.raise_for_status()
-        mail += responseMailInfoPostprocess(response.content)
+    https://help.aconex.com/zh/apis/mail-api-developer-guide/
+    """
+    return run_sync(searchMailAsync(search_params=search_params, mail_box=mail_box, sent_after=sent_after,
+                                    early_exit=early_exit))
 
-    # 使用 filter_mails 去重和择优
-    mail = filter_mails(mail)
 
-    # mail 排序
-    mail = responseClean(mail_response=mail, search_params=search_params)
+MailSearchItem = Tuple[patternInfo, Optional[datetime]]    # (图号, 增量水位)
 
-    return mail
 
+def splitMailBatches(items: List[MailSearchItem], batch_size: int, max_query_length: int) -> List[List[int]]:
+    """按数量和 URL 编码后的查询长度把待查询图号切分为若干批，返回每批的下标"""
+    batches: List[List[int]] = []
+    current: List[int] = []
+    length = 0
+    for i, (_params, _sent_after) in enumerate(items):
+        add_length = len(quote(f"({searchQueryCreator(_params, sent_after=_sent_after)}) OR "))
+        if current and (len(current) >= batch_size or length + add_length > max_query_length):
+            batches.append(current)
+            current, length = [], 0
+        current.append(i)
+        length += add_length
+    if current:
+        batches.append(current)
+    return batches
+
+
+def demuxMails(mails: list[responseMailInfo], items: List[MailSearchItem]) -> list[list[responseMailInfo]]:
+    """
+    把批量查询结果拆回各图号：与 responseClean 相同，主题中含有某图号主题片段的邮件归入该图号；
+    不按解析出的图号归类，主题中列出多个图号的邮件归入其中每个被查询的图号，与逐个图号查询一致
+    """
+    subjects = [drawingSubject(_params) for _params, _ in items]
+    per_item: list[list[responseMailInfo]] = [[] for _ in items]
+    for _mail in mails:
+        if _mail.parsed is None:  # filter_mails 同样会丢弃
+            continue
+        for i, _subject in enumerate(subjects):
+            if _subject in _mail.subject:
+                per_item[i].append(_mail)
+    return per_item
+
+
+async def searchMailBoxBatchAsync(items: List[MailSearchItem], mail_box: Literal["INBOX", "SENTBOX"]) -> list[
+    list[responseMailInfo]]:
+    """单个邮箱的批量查询：各图号条件用 OR 合并为一个 Lucene 查询，分页取回后拆分"""
+    if len(items) == 1:
+        return [await fetchMailBoxAsync(searchQueryCreator(items[0][0], sent_after=items[0][1]), mail_box)]
+
+    search_query = " OR ".join(f"({searchQueryCreator(_p, sent_after=_s)})" for _p, _s in items)
+    try:
+        mails = await fetchMailPagesAsync(search_query, mail_box)
+    except aiohttp.ClientResponseError as e:
+        # 查询过长/无法解析时退回逐个图号查询
+        if e.status not in (400, 413, 414):
+            raise
+        print(f"Batch search rejected ({e.status}), falling back to per-drawing search for {len(items)} drawings")
+        return list(await asyncio.gather(*(searchMailBoxBatchAsync([_item], mail_box) for _item in items)))
+    return demuxMails(mails, items)
+
+
+async def searchMailBatchAsync(items: List[MailSearchItem], mail_box: Literal["INBOX", "SENTBOX", "ALL"] = "ALL",
+                               batch_size: Optional[int] = None, ordered: bool = True) -> list[list[responseMailInfo]]:
+    """
+    批量搜索多个图号，返回与 items 一一对应的结果，与逐个调用 searchMailAsync 的结果一致
+
+    已缓存的图号不再请求；其余图号按 batch_size / config.mail_batch_max_query_length 分批，
+    每批每个邮箱只发一次（分页）查询，拆分后的结果按单图号查询的键写入缓存
+    """
+    batch_size = batch_size or config.mail_batch_size
+    print(f"Batch search: {len(items)} drawings, mail box: {mail_box}")
+
+    if config.offline:
+        return [postprocessMails(MAIL_WAREHOUSE.candidates(_p, mail_box), _p, sent_after=_s, ordered=ordered)
+                for _p, _s in items]
+
+    queries = [searchQueryCreator(_p, sent_after=_s) for _p, _s in items]
+    per_item: list[list[responseMailInfo]] = [[] for _ in items]
+
+    async def _run_batch(indexes: List[int], box: Literal["INBOX", "SENTBOX"]):
+        box_lists = await searchMailBoxBatchAsync([items[i] for i in indexes], box)
+        for i, box_mail in zip(indexes, box_lists):
+            MAIL_CACHE.put(queries[i], box, box_mail)
+            per_item[i] += box_mail
+
+    jobs = []
+    for box in ("SENTBOX", "INBOX"):
+        if mail_box != box and mail_box != "ALL":
+            continue
+        missing = []
+        for i, query in enumerate(queries):
+            cached = MAIL_CACHE.get(query, box)
+            if cached is None:
+                missing.append(i)
+            else:
+                per_item[i] += cached
+        for batch in splitMailBatches([items[i] for i in missing], batch_size, config.mail_batch_max_query_length):
+            jobs.append(_run_batch([missing[j] for j in batch], box))
+    await asyncio.gather(*jobs)
+
+    return [postprocessMails(_mail, _p, sent_after=_s, ordered=ordered) for _mail, (_p, _s) in zip(per_item, items)]
 
-def parseWorkflowSearch(xml_text: bytes) -> WorkflowSearchResult:
-    def _parseDatetime(dt: str) -> Optional[datetime]:
-        """
-        把 RFC-3339 / ISO-8601 字符串转为 datetime，并转换到 UTC+8。
-        - 原始 API 字段形如 '2025-08-29T08:38:39.839Z'（Z 表示 UTC）
-        - 返回值例如 2025-08-29 16:38:39.839+08:00
-        """
-
-        # 将 'Z' 替换为 '+00:00'，构造成可被 fromisoformat 解析的字符串
-        utc_dt = datetime.fromisoformat(dt.replace("Z", "+00:00"))
-        # 转换到东八区
-        return utc_dt.astimezone(timezone(timedelta(hours=8)))
-
-    def _parseUser(elem: ET.Element) -> UserRef:
-        """解析 <Assignee> / <Initiator> / <Reviewer>"""
-        return UserRef(organization_id=int(elem.findtext("OrganizationId")),
-                       organization_name=elem.findtext("OrganizationName").strip(), name=elem.findtext("Name").strip(),
-                       user_id=int(elem.findtext("UserId")), )
-
-    root = ET.fromstring(xml_text.decode("utf-8"))
-
-    # ---- 顶层分页元数据 ----
-    meta = WorkflowSearchResult(current_page=int(root.attrib["CurrentPage"]), page_size=int(root.attrib["PageSize"]),
-                                total_pages=int(root.attrib["TotalPages"]),
-                                total_results=int(root.attrib["TotalResults"]),
-                                total_results_on_page=int(root.attrib["TotalResultsOnPage"]), workflows=[], )
-
-    # ---- 循环解析每条 <Workflow> ----
-    for wf_elem in root.find("SearchResults").findall("Workflow"):
-        # ─ Assignees (0-N) ─
-        assignees = [_parseUser(a) for a in wf_elem.find("Assignees").findall("Assignee")]
-
-        # ─ Initiator / Reviewer (可能缺省) ─
-        initiator = _parseUser(wf_elem.find("Initiator"))
-        reviewer_elem = wf_elem.find("Reviewer")
-        reviewer = _parseUser(reviewer_elem) if reviewer_elem is not None else None
-
-        wf = Workflow(workflow_id=int(wf_elem.attrib["WorkflowId"]), step_name=wf_elem.findtext("StepName").strip(),
-                      step_outcome=wf_elem.findtext("StepOutcome").strip(),
-                      step_status=wf_elem.findtext("StepStatus").strip(),
-
-                      date_in=_parseDatetime(wf_elem.findtext("DateIn")) if wf_elem.findtext("DateIn") else None,
-                      date_completed=_parseDatetime(wf_elem.findtext("DateCompleted")) if wf_elem.findtext(
-                          "DateCompleted") else None,
-                      date_due=_parseDatetime(wf_elem.findtext("DateDue")) if wf_elem.findtext("DateDue") else None,
-                      days_late=int(wf_elem.findtext("DaysLate")), duration=float(wf_elem.findtext("Duration")),
-
-                      document_number=wf_elem.findtext("DocumentNumber").strip(),
-                      document_revision=wf_elem.findtext("DocumentRevision").strip(),
-                      document_title=wf_elem.findtext("DocumentTitle").strip(),
-                      document_version=int(wf_elem.findtext("DocumentVersion")),
-                      file_name=wf_elem.findtext("FileName").strip(),
-                      file_size=int(wf_elem.findtext("FileSize")),
-
-                      initiator=initiator, reviewer=reviewer, assignees=assignees, )
-        meta.workflows.append(wf)
-    return meta
+
+def searchMailBatch(items: List[MailSearchItem], mail_box: Literal["INBOX", "SENTBOX", "ALL"] = "ALL",
+                    batch_size: Optional[int] = None) -> list[list[responseMailInfo]]:
+    return run_sync(searchMailBatchAsync(items=items, mail_box=mail_box, batch_size=batch_size))
+
+
+class MailSearchBatcher:
+    """
+    自动合并单图号搜索：同一轮事件循环内提交的 search() 请求按邮箱分组，
+    每 config.mail_batch_size 个图号作为一批交给 searchMailBatchAsync，各批完成即返回
+
+    config.mail_search_early_exit 时不合并：提前结束翻页只能按单个图号判断，逐图号分页查询
+    """
+
+    def __init__(self):
+        self._pending: List[Tuple[MailSearchItem, str, bool, asyncio.Future]] = []
+        self._flush_scheduled = False
+
+    async def search(self, search_params: patternInfo, mail_box: Literal["INBOX", "SENTBOX", "ALL"] = "ALL",
+                     sent_after: Optional[datetime] = None, ordered: bool = True) -> list[responseMailInfo]:
+        if config.mail_batch_size <= 1 or config.mail_search_early_exit:
+            return await searchMailAsync(search_params=search_params, mail_box=mail_box, sent_after=sent_after,
+                                         ordered=ordered)
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append(((search_params, sent_after), mail_box, ordered, future))
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            loop.call_soon(self._flush)
+        return await future
+
+    def _flush(self):
+        pending, self._pending, self._flush_scheduled = self._pending, [], False
+        groups: dict[Tuple[str, bool], List[Tuple[MailSearchItem, asyncio.Future]]] = {}
+        for item, box, ordered, future in pending:
+            groups.setdefault((box, ordered), []).append((item, future))
+        for (box, ordered), group in groups.items():
+            for start in range(0, len(group), config.mail_batch_size):
+                asyncio.ensure_future(self._run(group[start:start + config.mail_batch_size], box, ordered))
+
+    @staticmethod
+    async def _run(group: List[Tuple[MailSearchItem, asyncio.Future]], mail_box: str, ordered: bool):
+        try:
+            results = await searchMailBatchAsync([_item for _item, _ in group], mail_box, ordered=ordered)
+        except Exception as e:
+            for _, future in group:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(group, results):
+            if not future.done():
+                future.set_result(result)
+
+
+MAIL_BATCHER = MailSearchBatcher()
+
+
+async def fetchWorkflowAsync(workflow_num: str) -> WorkflowSearchResult:
+    content = await ASYNC_CLIENT.get(url=f"{config.resource_url}/api/projects/{config.project_id}/workflows/search",
+                                     headers={"Accept": "application/vnd.aconex.workflow.v1+xml"},
+                                     params={"workflow_number": workflow_num})
+    with METRICS.stage("parse"):
+        result = parseWorkflowSearch(content)
+    WORKFLOW_CACHE.put(workflow_num, result)
+    return result
+
+
+async def searchWorkflowAsync(workflow_num: str) -> WorkflowSearchResult:
+    """先查本地缓存；未命中时同一工作流编号只发一个请求，并发调用方共享结果；离线模式下只查本地仓库"""
+    if config.offline:
+        result = MAIL_WAREHOUSE.workflow(workflow_num)
+        if result is None:
+            raise LookupError(f"Workflow {workflow_num} is not in the local warehouse, "
+                              f"run 'python mail_warehouse.py sync --workflows' first")
+        return result
+
+    cached = WORKFLOW_CACHE.get(workflow_num)
+    if cached is not None:
+        return cached
+
+    future = _WORKFLOW_IN_FLIGHT.get(workflow_num)
+    if future is None:
+        future = asyncio.ensure_future(fetchWorkflowAsync(workflow_num))
+        _WORKFLOW_IN_FLIGHT[workflow_num] = future
+        future.add_done_callback(lambda _f: _WORKFLOW_IN_FLIGHT.pop(workflow_num, None))
+    # shield：单个调用方被取消时不影响共享的请求
+    return await asyncio.shield(future)
 
 
 def searchWorkflow(workflow_num: str) -> WorkflowSearchResult:
-    # 检查当前时间是否超过了config.access_token_expires，如果超过则调用requestToken()刷新token
-    if not config.access_token_expires or not config.access_token or datetime.now() >= config.access_token_expires:
-        with ACCESS_TOKEN_LOCK:
-            print("Access token expired, refreshing...")
-            requestToken()
+    return run_sync(searchWorkflowAsync(workflow_num=workflow_num))
 
-    response = get_with_retry(url=f"{config.resource_url}/api/projects/{config.project_id}/workflows/search",
-                              headers={"Authorization": f"Bearer {config.access_token}",
-                                       "Accept": "application/vnd.aconex.workflow.v1+xml", },
-                              params={"workflow_number": {workflow_num}})
 
-    response.raise_for_status()
-    return parseWorkflowSearch(response.content)
+def rowIsSettled(row: Tuple[Cell, ...]) -> bool:
+    """行内已有结果且没有进行中的工作流（已定版 / 已有最终审核状态 / 无工作流）"""
+    ver = str(row[4].value or '')
+    return bool(ver) and (ver.isdigit() or bool(row[6].value) or not row[7].value)
 
 
-def multiMissionMain(pattern_data: patternInfo, row: Tuple[Cell, ...]):
+async def waitCellWrite():
+    """等待工作线程中的 sheet 收尾结束；返回后到下一个 await 之前，事件循环上获取 CELL_WRITE_LOCK 不会阻塞"""
+    async with CELL_WRITE_GATE:
+        pass
+
+
+def recordUnchangedRow(pattern_data: patternInfo, row: Tuple[Cell, ...], sheet_name: str):
+    """增量模式下无新邮件的行：不写单元格，仅根据现有单元格值累计 REQUEST_DATA"""
     global REQUEST_DATA, CELL_WRITE_LOCK, BASE_COL
 
-    cleaned_response = searchMail(search_params=pattern_data, mail_box="ALL")
+    ver = str(row[4].value or '')
+    # 已写入的审核人列按 3 列一组向上取整
+    used = [i for i, _cell in enumerate(row[BASE_COL:]) if _cell.value not in (None, '')]
+    base_col = BASE_COL + (-(-(used[-1] + 1) // 3) * 3 if used else 0)
+
+    with CELL_WRITE_LOCK, METRICS.stage("cell_write"):
+        REQUEST_DATA[sheet_name].results.append(patternInfo(
+            unit=pattern_data.unit, discipline=pattern_data.discipline, drawing=pattern_data.drawing,
+            wf=row[7].value or None, ver=ver or "*", step=pattern_data.step,
+        ))
+        REQUEST_DATA[sheet_name].total += 1
+        REQUEST_DATA[sheet_name].unfinished += 1 if not ver.isdigit() else 0
+        REQUEST_DATA[sheet_name].max_col_used = max(base_col, REQUEST_DATA[sheet_name].max_col_used)
+
+
+async def multiMissionMainAsync(pattern_data: patternInfo, row: Tuple[Cell, ...], sheet_name: str):
+    global REQUEST_DATA, CELL_WRITE_LOCK, BASE_COL, PENDING_WATERMARKS, PENDING_RESULTS
+
+    # 增量模式：只查询水位之后的新邮件，与上次保存的结果合并；没有新邮件且行已稳定则保持原值，
+    # 工作流仍在进行的行用合并后的结果刷新工作流
+    key = drawingKey(pattern_data)
+    new_mails: list[responseMailInfo] = []
+    stored = None
+    if config.incremental_sync:
+        watermark = WATERMARK.get(key)
+        stored = WATERMARK.mails(key) if watermark is not None else None
+        if stored is not None:
+            with METRICS.stage("search"):
+                new_mails = await MAIL_BATCHER.search(search_params=pattern_data, mail_box="ALL",
+                                                      sent_after=watermark, ordered=False)
+            if not new_mails and rowIsSettled(row):
+                print("无新邮件, 跳过:", row[1].value)
+                await waitCellWrite()
+                recordUnchangedRow(pattern_data, row, sheet_name)
+                return None
+
+    if stored is not None:
+        cleaned_response = postprocessMails(stored + new_mails, pattern_data, ordered=False)
+    else:
+        with METRICS.stage("search"):
+            cleaned_response = await MAIL_BATCHER.search(search_params=pattern_data, mail_box="ALL", ordered=False)
 
     print([mail.subject for mail in cleaned_response])
 
@@ -387,9 +642,13 @@ def multiMissionMain(pattern_data: patternInfo, row: Tuple[Cell, ...]):
         print("未找到:", row[1].value)
         return None
 
-    # 从邮件中提取最新版本信息
-    newest_mail = cleaned_response[0] if cleaned_response else None
-    newest_matched_data = MAIN_RE.match(newest_mail.subject).groupdict() if newest_mail else None
+    # 记录新水位和结果（工作簿保存成功后再写入本地）
+    PENDING_WATERMARKS[key] = max(_m.SentDate for _m in cleaned_response + new_mails)
+    PENDING_RESULTS[key] = cleaned_response
+
+    # 从邮件中提取最新版本信息（主题已在构造 responseMailInfo 时解析）
+    newest_mail = selectBestMail(cleaned_response)
+    newest_matched_data = newest_mail.parsed.groupdict() if newest_mail else None
     print(newest_matched_data)
 
     # 写入数据缓存
@@ -408,7 +667,8 @@ def multiMissionMain(pattern_data: patternInfo, row: Tuple[Cell, ...]):
         # 工作流编号
         write_data['wf'] = newest_matched_data['wf'] if newest_matched_data else ''
 
-        workflows_data = searchWorkflow(workflow_num=newest_matched_data['wf'])
+        with METRICS.stage("workflow"):
+            workflows_data = await searchWorkflowAsync(workflow_num=newest_matched_data['wf'])
         for workflow in workflows_data.workflows:
             # print(
             #     f"Workflow ID: {workflow.workflow_id}, Step Status: {workflow.step_status}, Step Name: {workflow.step_name}, "
@@ -437,7 +697,8 @@ def multiMissionMain(pattern_data: patternInfo, row: Tuple[Cell, ...]):
         step=newest_matched_data['step'] if newest_matched_data and newest_matched_data['step'] else None,
     )
 
-    with CELL_WRITE_LOCK:
+    await waitCellWrite()
+    with CELL_WRITE_LOCK, METRICS.stage("cell_write"):
         # 清理审批结果、工作流编号、审批进度信息
         for a in row[6:]:
             a.value = None
@@ -470,107 +731,247 @@ def multiMissionMain(pattern_data: patternInfo, row: Tuple[Cell, ...]):
                 b.fill = PatternFill()  # no fill
 
         # 写入全局变量
-        REQUEST_DATA[sheet.title].results.append(response_data)
-        REQUEST_DATA[sheet.title].total += 1
-        REQUEST_DATA[sheet.title].unfinished += 1 if newest_matched_data and not newest_matched_data['ver'].isdigit() else 0
-        REQUEST_DATA[sheet.title].max_col_used = base_col if base_col > REQUEST_DATA[sheet.title].max_col_used else REQUEST_DATA[sheet.title].max_col_used
+        REQUEST_DATA[sheet_name].results.append(response_data)
+        REQUEST_DATA[sheet_name].total += 1
+        REQUEST_DATA[sheet_name].unfinished += 1 if newest_matched_data and not newest_matched_data['ver'].isdigit() else 0
+        REQUEST_DATA[sheet_name].max_col_used = base_col if base_col > REQUEST_DATA[sheet_name].max_col_used else REQUEST_DATA[sheet_name].max_col_used
 
     return None
 
 
-if __name__ == '__main__':
-    # check input/export path
-    if not os.path.isfile(XLSX_PATH):
-        raise FileNotFoundError(f"Input file '{XLSX_PATH}' not found.")
-    if os.path.isfile(EXPORT_PATH) and not EXPORT_PATH == XLSX_PATH:
-        print(f"Warning: Output file '{EXPORT_PATH}' already exists and will be overwritten.")
-        os.remove(EXPORT_PATH)
+def multiMissionMain(pattern_data: patternInfo, row: Tuple[Cell, ...], sheet_name: str):
+    return run_sync(multiMissionMainAsync(pattern_data=pattern_data, row=row, sheet_name=sheet_name))
 
-    # ensure access token is valid
-    requestToken()
 
-    # open and process xlsx
-    wb = openpyxl.load_workbook(XLSX_PATH)
-    for sheet in wb.worksheets:
-        if sheet.title in ["汇总"]:  # 跳过汇总表
+def collectRowTasks(rows: Iterable[Sequence]) -> List[Tuple[patternInfo, Sequence]]:
+    """解析每行的图号（第 2 列），返回待查询的 (patternInfo, row) 列表；row 可以是单元格元组或 PendingRow"""
+    tasks = []
+    for _row in rows:
+        if _row[1].value is None:
             continue
+        m = MAIN_RE.match(clean_str(_row[1].value))
+        if not m:
+            print("无法匹配:", _row[1].value)
+            continue
+
+        matched_data = m.groupdict()
+        tasks.append((patternInfo(
+            unit=matched_data["unit"], discipline=matched_data["discipline"],
+            drawing=matched_data["drawing"], step=matched_data["step"]
+        ), _row))
+    return tasks
+
+
+def finalizeSheet(sheet: Worksheet):
+    """sheet 全部行完成后：按 max_col_used 添加边框、清理多余列、动态调整表头"""
+    max_col_used = REQUEST_DATA[sheet.title].max_col_used
+
+    # 只处理已存在的列（不存在的单元格无需清理），低内存模式下不会为每行创建 MAX_COL 个单元格
+    last_col = min(max(sheet.max_column, max_col_used), MAX_COL)
 
-        # 初始化REQUEST_DATA
-        REQUEST_DATA[sheet.title] = searchResult(sheet_name=sheet.title)
-
-        # 构造线程池
-        pool = ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 5))
-        all_tasks = []
-
-        # 遍历行，跳过表头
-        for _row in sheet.iter_rows(min_row=2, max_col=50):
-            if _row[1].value is None:
-                continue
-            m = MAIN_RE.match(clean_str(_row[1].value))
-            if not m:
-                print("无法匹配:", _row[1].value)
-                continue
-
-            matched_data = m.groupdict()
-            # multiMissionMain(pattern_data=patternInfo(unit=m["unit"], discipline=m["discipline"], drawing=m["drawing"]), row=_row)
-            all_tasks.append(pool.submit(multiMissionMain, patternInfo(
-                unit=matched_data["unit"], discipline=matched_data["discipline"],
-                drawing=matched_data["drawing"], step=matched_data["step"]
-            ), _row))
-
-        # 等待所有任务完成
-        wait(all_tasks, return_when=ALL_COMPLETED)
-        pool.shutdown()
-
-        # 计算使用过的单元格最大数值，添加边框
-        thin_side = Side(border_style="thin", color="000000")
-        for _row in sheet.iter_rows(min_row=1, max_col=50):
-            for _cell in _row[:REQUEST_DATA[sheet.title].max_col_used]:
+    # 计算使用过的单元格最大数值，添加边框
+    thin_side = Side(border_style="thin", color="000000")
+    with METRICS.stage("border"):
+        for _row in sheet.iter_rows(min_row=1, max_col=last_col):
+            for _cell in _row[:max_col_used]:
                 if type(_cell) is not MergedCell:
                     _cell.border = Border(top=thin_side, left=thin_side, right=thin_side, bottom=thin_side)
-            for _cell in _row[REQUEST_DATA[sheet.title].max_col_used:]:
+            for _cell in _row[max_col_used:]:
                 if type(_cell) is not MergedCell:
                     _cell.border = Border()
                     _cell.value = None
                     _cell.fill = PatternFill()
 
-        # 动态调整表头
-        headers_group = ["待审批单位", "审批人", "审批状态"]
+    # 动态调整表头
+    headers_group = ["待审批单位", "审批人", "审批状态"]
+
+    # 从第 9 列开始，写入直到 sheet 的 max_col_used
+    for col in range(BASE_COL + 1, max_col_used + 1, 3):
+        for offset, title in enumerate(headers_group):
+            sheet.cell(row=1, column=col + offset, value=title)
+
+    # 清理超出  sheet 的 max_col_used 的表头
+    for col in range(max_col_used + 1, last_col + 1):
+        sheet.cell(row=1, column=col, value=None)
+
+
+async def gatherRowTasks(row_tasks: List[asyncio.Task]):
+    """等待所有行完成，单行失败只打印不中断"""
+    results = await asyncio.gather(*row_tasks, return_exceptions=True)
+    for _task, _res in zip(row_tasks, results):
+        if isinstance(_res, BaseException):
+            print(f"处理失败: {_task.get_name()}, {_res!r}")
+
+
+def lockedFinalizeSheet(sheet: Worksheet, pending_rows: Optional[Sequence[PendingRow]] = None):
+    """持有 CELL_WRITE_LOCK 执行 sheet 收尾（供 asyncio.to_thread 调用）；pending_rows 不为空时先写回低内存模式记录的行"""
+    with CELL_WRITE_LOCK:
+        if pending_rows is not None:
+            applyPendingRows(sheet, pending_rows)
+        finalizeSheet(sheet)
+
+
+def createRowTasks(sheet_name: str, rows: Iterable[Sequence],
+                   on_row_done: Optional[Callable[[Sequence], None]] = None) -> List[asyncio.Task]:
+    """每个图号行一个任务；on_row_done 不为空时在该行任务结束后以 row 调用"""
+    # 初始化REQUEST_DATA
+    REQUEST_DATA[sheet_name] = searchResult(sheet_name=sheet_name)
+    tasks = []
+    for _p, _r in collectRowTasks(rows):
+        _task = asyncio.create_task(multiMissionMainAsync(pattern_data=_p, row=_r, sheet_name=sheet_name),
+                                    name=str(_r[1].value))
+        if on_row_done is not None:
+            _task.add_done_callback(lambda _, row=_r: on_row_done(row))
+        tasks.append(_task)
+    return tasks
+
 
-        # 从第 9 列开始，写入直到 sheet 的 max_col_used
-        for col in range(BASE_COL + 1, REQUEST_DATA[sheet.title].max_col_used + 1, 3):
-            for offset, title in enumerate(headers_group):
-                sheet.cell(row=1, column=col + offset, value=title)
+def printSheetDone(sheet_name: str):
+    print(rf"Sheet '{sheet_name}' processed, total: {REQUEST_DATA[sheet_name].total}, unfinished: {REQUEST_DATA[sheet_name].unfinished}.")
 
-        # 清理超出  sheet 的 max_col_used 的表头
-        for col in range(REQUEST_DATA[sheet.title].max_col_used + 1, 51):
-            sheet.cell(row=1, column=col, value=None)
 
-        wb.save(EXPORT_PATH)
+async def processSheetAsync(sheet: Worksheet, row_tasks: List[asyncio.Task],
+                            checkpoint: Optional[CheckpointSaver] = None):
+    """等待某个 sheet 的所有行完成后立即收尾，不阻塞其他 sheet 的请求；工作簿只在全部完成后保存一次"""
+    await gatherRowTasks(row_tasks)
 
-        print(rf"Sheet '{sheet.title}' processed, total: {REQUEST_DATA[sheet.title].total}, unfinished: {REQUEST_DATA[sheet.title].unfinished}.")
+    # 收尾（边框、清理多余列）在工作线程中执行，其他 sheet 的请求和解析继续进行
+    async with CELL_WRITE_GATE:
+        with METRICS.stage("cell_write"):
+            await asyncio.to_thread(lockedFinalizeSheet, sheet)
+    if checkpoint is not None:
+        checkpoint.sheetDone(sheet)
 
-    # 读取各子表审核进度，写入汇总sheet
+    printSheetDone(sheet.title)
+
+
+async def processWorkbookAsync(wb: openpyxl.Workbook, skip_sheets: Tuple[str, ...] = ("汇总",),
+                               checkpoint: Optional[CheckpointSaver] = None):
+    """
+    全局调度：开始时一次性提交所有 sheet 的行，在途请求数由 ASYNC_CLIENT 统一限制，
+    sheet 边界处不再等待；每个 sheet 的最后一行完成后立即执行该 sheet 的收尾。
+    checkpoint 不为空时每行完成 / 每个 sheet 收尾后记录改动并检查是否需要保存中间快照。
+    """
+    sheet_jobs = []
+    for sheet in wb.worksheets:
+        if sheet.title in skip_sheets:  # 跳过汇总表
+            continue
+
+        row_tasks = createRowTasks(sheet.title, sheet.iter_rows(min_row=2, max_col=MAX_COL),
+                                   checkpoint.rowDone if checkpoint is not None and checkpoint.enabled else None)
+        sheet_jobs.append(processSheetAsync(sheet, row_tasks, checkpoint))
+
+    await asyncio.gather(*sheet_jobs)
+
+
+async def processWorkbookLowMemoryAsync(xlsx_path: str, skip_sheets: Tuple[str, ...] = ("汇总",)) -> openpyxl.Workbook:
+    """
+    低内存两阶段模式：
+    1) read_only 只读扫描各 sheet 的单元格值，行的写入先记录在 PendingRow 中
+    2) 所有行完成后再加载完整工作簿（避免与第一阶段的请求、解析结果同时占用内存），
+       只把记录的值 / 填充写回，再执行各 sheet 的收尾
+
+    返回写回后的完整工作簿（尚未保存）
+    """
+    with METRICS.stage("load"):
+        sheet_rows = scanPendingRows(xlsx_path, skip_sheets=skip_sheets, width=MAX_COL)
+
+    row_tasks = [createRowTasks(_title, _rows) for _title, _rows in sheet_rows.items()]
+    await asyncio.gather(*(gatherRowTasks(_tasks) for _tasks in row_tasks))
+    del row_tasks
+
+    # 在工作线程中加载，不阻塞事件循环（其他协程，如后台 token 刷新）
+    with METRICS.stage("load"):
+        wb = await asyncio.to_thread(openpyxl.load_workbook, xlsx_path)
+    for _title, _rows in sheet_rows.items():
+        with METRICS.stage("cell_write"):
+            await asyncio.to_thread(lockedFinalizeSheet, wb[_title], _rows)
+        printSheetDone(_title)
+    return wb
+
+
+def updateSummarySheet(wb: openpyxl.Workbook):
+    """读取各子表审核进度，写入汇总sheet"""
     if "汇总" not in wb.sheetnames:
         print("Warning: '汇总' sheet not found, skipping summary update.")
-    else:
-        summary_sheet = wb["汇总"]
-        for _row in summary_sheet.iter_rows(min_row=2, max_col=5):
-            # 写入汇总表
-            if _row[1].value is None:
-                continue
-            sheet_name = clean_str(_row[1].value)
-            if sheet_name not in REQUEST_DATA:
-                print(f"Warning: Sheet '{sheet_name}' not found in processed data.")
-                continue
-            _row[2].value = REQUEST_DATA[sheet_name].total
-            _row[4].value = REQUEST_DATA[sheet_name].unfinished
-
-            # sheet tab 添加颜色
-            if REQUEST_DATA[sheet_name].unfinished == 0:
-                wb[sheet_name].sheet_properties.tabColor = config.finish_fill_color
-            else:
-                wb[sheet_name].sheet_properties.tabColor = None
+        return
+    summary_sheet = wb["汇总"]
+    for _row in summary_sheet.iter_rows(min_row=2, max_col=5):
+        # 写入汇总表
+        if _row[1].value is None:
+            continue
+        sheet_name = clean_str(_row[1].value)
+        if sheet_name not in REQUEST_DATA:
+            print(f"Warning: Sheet '{sheet_name}' not found in processed data.")
+            continue
+        _row[2].value = REQUEST_DATA[sheet_name].total
+        _row[4].value = REQUEST_DATA[sheet_name].unfinished
 
-    wb.save(EXPORT_PATH)
+        # sheet tab 添加颜色
+        if REQUEST_DATA[sheet_name].unfinished == 0:
+            wb[sheet_name].sheet_properties.tabColor = config.finish_fill_color
+        else:
+            wb[sheet_name].sheet_properties.tabColor = None
+
+
+def processTracker(xlsx_path: str = XLSX_PATH, export_path: str = EXPORT_PATH):
+    """完整流程：处理各子表 → 更新汇总表 → 原子保存 → 提交增量同步水位（调用前需已获取 token）"""
+    # open and process xlsx
+    if config.low_memory:
+        # 第一阶段没有可保存的完整工作簿，不做检查点
+        checkpoint = None
+        wb = run_sync(processWorkbookLowMemoryAsync(xlsx_path))
+    else:
+        with METRICS.stage("load"):
+            wb = openpyxl.load_workbook(xlsx_path)
+        checkpoint = CheckpointSaver(wb, export_path, interval=config.checkpoint_interval, rows=config.checkpoint_rows)
+        run_sync(processWorkbookAsync(wb, checkpoint=checkpoint))
+
+    updateSummarySheet(wb)
+
+    # 等待在写的检查点完成后一次性原子保存
+    if checkpoint is not None:
+        checkpoint.close()
+    with METRICS.stage("save"):
+        saveWorkbookAtomic(wb, export_path)
     wb.close()
+
+    # 工作簿已保存，提交增量同步水位
+    WATERMARK.update(PENDING_WATERMARKS, PENDING_RESULTS)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="查询 Aconex 邮件与工作流，更新图纸进度跟踪表")
+    parser.add_argument("--no-cache", action="store_true", help="不读取本地邮件搜索 / 工作流缓存，强制请求 API")
+    parser.add_argument("--incremental", action="store_true", help="增量同步：只查询上次运行之后的新邮件")
+    parser.add_argument("--early-exit", action="store_true",
+                        help="逐图号分页查询（不合并批量查询），找到最新版本的最终审核邮件后不再翻页")
+    parser.add_argument("--checkpoint-interval", type=float, default=None, help="每隔多少秒在后台保存一次中间结果")
+    parser.add_argument("--checkpoint-rows", type=int, default=None, help="每完成多少行在后台保存一次中间结果")
+    parser.add_argument("--low-memory", action="store_true", help="低内存模式：只读扫描图号，完成后只写回结果列")
+    parser.add_argument("--profile", action="store_true", help="分阶段 cProfile / tracemalloc 剖析，报告写入 config.profile_dir")
+    parser.add_argument("--offline", action="store_true", help="只查询本地邮件仓库（先运行 mail_warehouse.py sync）")
+    args = parser.parse_args()
+    if args.profile:
+        PROFILER.start()
+    config.offline = config.offline or args.offline
+    config.mail_cache_bypass = config.mail_cache_bypass or args.no_cache
+    config.workflow_cache_bypass = config.workflow_cache_bypass or args.no_cache
+    config.incremental_sync = config.incremental_sync or args.incremental
+    config.mail_search_early_exit = config.mail_search_early_exit or args.early_exit
+    config.checkpoint_interval = args.checkpoint_interval or config.checkpoint_interval
+    config.checkpoint_rows = args.checkpoint_rows or config.checkpoint_rows
+    config.low_memory = config.low_memory or args.low_memory
+
+    # check input/export path
+    if not os.path.isfile(XLSX_PATH):
+        raise FileNotFoundError(f"Input file '{XLSX_PATH}' not found.")
+    if os.path.isfile(EXPORT_PATH) and not EXPORT_PATH == XLSX_PATH:
+        print(f"Warning: Output file '{EXPORT_PATH}' already exists and will be overwritten.")
+        os.remove(EXPORT_PATH)
+
+    # ensure access token is valid
+    requestToken()
+
+    # open and process xlsx
+    processTracker(XLSX_PATH, EXPORT_PATH)
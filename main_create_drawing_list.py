@@ -7,6 +7,7 @@ used to create the drawing list with business requirements
       ├─ 2.图纸审核证明
       └─ 建筑重计量图纸目录.xlsx
 """
+import argparse
 import base64
 import json
 import os.path
@@ -31,6 +32,8 @@ from config import config
 from dataclass import patternInfo
 from main import requestToken, searchMail, MAIN_RE
 from main_download_attachments import viewMailMetadata
+from metrics import METRICS
+from profiling import PROFILER
 
 XLSX_PATH: str = r"./图纸进度跟踪表.xlsx"
 EXPORT_PATH: str = r"./建筑重计量图纸目录/建筑重计量图纸目录.xlsx"
@@ -66,7 +69,7 @@ def get_drawing_list() -> list[DrawingItem]:
             attachments=[],
         )
 
-        mail_response = viewMailMetadata(mail_id=drawing_item.first_mail_id)
+        mail_response = viewMailMetadata(mail_id=drawing_item.first_mail_id, include=("attachments",))
         print(f"邮件: {mail_response.subject} ({mail_response.mail_id})")
         for _att in mail_response.attachments:
             drawing_item.attachments.append(os.path.splitext(_att.file_name)[0])
@@ -84,12 +87,13 @@ def get_drawing_list() -> list[DrawingItem]:
     for row in ws.iter_rows(min_row=24):
         if row[1].value is not None:
             matched = MAIN_RE.match(row[1].value).groupdict()
-            _data = get_row_data(search_params=patternInfo(
-                unit=matched.get("unit"),
-                discipline=matched.get("discipline"),
-                drawing=matched.get("drawing"),
-                step=matched.get("step"),
-            ))
+            with METRICS.stage("fetch"):
+                _data = get_row_data(search_params=patternInfo(
+                    unit=matched.get("unit"),
+                    discipline=matched.get("discipline"),
+                    drawing=matched.get("drawing"),
+                    step=matched.get("step"),
+                ))
             _info_list.append(_data)
             # write to local json
             with open(rf"{MAIL_CACHE_PATH}/{_data.first_mail_id}.json", "w", encoding="utf-8") as _f:
@@ -107,22 +111,25 @@ def get_drawing_list() -> list[DrawingItem]:
         ws.title = "建筑重计量图纸目录"
     ws.append(["序号", "图名", "图号"])  # 表头
     idx = 1
-    for _item in _info_list:
-        for att in _item.attachments:
-            ws.append([idx, att, _item.first_subject])
-            idx += 1
-        # 合并图号列
-        if len(_item.attachments) > 1:
-            ws.merge_cells("C{}:C{}".format(idx - len(_item.attachments) + 1, idx))
+    with METRICS.stage("cell_write"):
+        for _item in _info_list:
+            for att in _item.attachments:
+                ws.append([idx, att, _item.first_subject])
+                idx += 1
+            # 合并图号列
+            if len(_item.attachments) > 1:
+                ws.merge_cells("C{}:C{}".format(idx - len(_item.attachments) + 1, idx))
 
     # 为所有活动单元格增加边框
     thin_side = Side(border_style="thin", color="000000")
     thin_border = Border(left=thin_side, right=thin_side, top=thin_side, bottom=thin_side)
-    for row in ws.iter_rows(min_row=1, max_row=ws.max_row, min_col=1, max_col=3):
-        for cell in row:
-            cell.border = thin_border
+    with METRICS.stage("border"):
+        for row in ws.iter_rows(min_row=1, max_row=ws.max_row, min_col=1, max_col=3):
+            for cell in row:
+                cell.border = thin_border
 
-    wb.save(EXPORT_PATH)
+    with METRICS.stage("save"):
+        wb.save(EXPORT_PATH)
     wb.close()
     return _info_list
 
@@ -210,6 +217,12 @@ def get_mail_pdf(web_driver: WebDriver, mail_id: int) -> bytes:
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="生成重计量图纸目录并打印邮件 PDF")
+    parser.add_argument("--profile", action="store_true", help="分阶段 cProfile / tracemalloc 剖析，报告写入 config.profile_dir")
+    args = parser.parse_args()
+    if args.profile:
+        PROFILER.start()
+
     requestToken()
 
     # 构造输出结构
@@ -1,26 +1,43 @@
 """
 对于main函数测试新增函数功能
 
+- 默认处理工作簿中除汇总表外的全部 sheet，--sheet 指定要处理的 sheet（可重复）
+- 附件通过 ARIA2_BATCHER 以 system.multicall 批量提交给 aria2，全部提交后批量轮询进度，
+  完成后按附件 FileSize 校验文件大小，出错或大小不符的下载自动重新提交
+- 附件存储（attachment_store.py）：同一登记文件（document_id + revision）只下载一次，其他主题目录中放置硬链接，
+  是否已下载只查 manifest
+- --engine builtin 时不需要 aria2c：用 range_downloader.RangeDownloader 在进程内分段下载（RangeDownloadBatcher）
+- 邮件元数据在后台事件循环中以 config.download_metadata_concurrency 为上限并发预取，
+  每封邮件的元数据一到就把附件交给 aria2，不再逐行串行请求
+
 手动启动aria2c RPC服务端：
 ./aria2c.exe --enable-rpc --rpc-listen-all=false --rpc-listen-port=12768 --rpc-allow-origin-all --continue --save-session=./downloads/aria2.session --file-allocation=falloc
 """
-import html
-import re
-import xml.etree.ElementTree as ET
-from datetime import datetime, timezone, timedelta
-from typing import Optional, Union
+import argparse
+import asyncio
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Callable, Iterable, Iterator, Optional, Union
 
 import openpyxl
-from bs4 import BeautifulSoup
 import aria2p
 
 from pathlib import Path
 
+from aconex_async import get_loop, run_sync
+from attachment_store import AttachmentStore
 from config import config
-from dataclass import MailDetail, RegisteredDocumentAttachment, FromUserDetails, Recipient
-from main import requestToken, clean_str, get_with_retry
+from dataclass import MailDetail, RegisteredDocumentAttachment
+from mail_warehouse import MAIL_WAREHOUSE
+from main import requestToken, clean_str, ASYNC_CLIENT, TOKEN_MANAGER
+from metrics import METRICS
+from profiling import PROFILER
+from range_downloader import RangeDownloader, controlPath
+from xml_parse import parseMailDetail
 
 XLSX_PATH = r"./图纸进度跟踪表_download.xlsx"
+SKIP_SHEETS = ("汇总",)
 
 # aria2p
 DOWNLOAD_PATH = Path("./downloads").resolve()   # 下载目录
@@ -30,122 +47,453 @@ RPC_SECRET = ""     # aria2c RPC 密钥（留空则不使用密钥）
 ARIA2P_API = aria2p.API(aria2p.Client(host="http://localhost", port=RPC_PORT, secret=RPC_SECRET))
 
 
-def viewMailMetadata(mail_id: Union[str, int]) -> MailDetail:
+async def viewMailMetadataAsync(mail_id: Union[str, int], include: Optional[Iterable[str]] = None) -> MailDetail:
+    """
+    获取邮件元数据 (async)；离线模式下只查本地仓库
+
+    include 指定要解析的部分（xml_parse.MAIL_DETAIL_FIELDS 的子集），默认全部；mail_data 只在访问时才转换为纯文本
+    """
+    if config.offline:
+        detail = MAIL_WAREHOUSE.detail(mail_id)
+        if detail is None:
+            raise LookupError(f"Mail {mail_id} is not in the local warehouse, "
+                              f"run 'python mail_warehouse.py sync --details' first")
+        return detail
+    content = await ASYNC_CLIENT.get(url=f"{config.resource_url}/api/projects/{config.project_id}/mail/{mail_id}")
+    with METRICS.stage("parse"):
+        return parseMailDetail(content, include=include)
+
+
+def viewMailMetadata(mail_id: Union[str, int], include: Optional[Iterable[str]] = None) -> MailDetail:
     """获取邮件元数据"""
-    def _parse_datetime(dt: str) -> Optional[datetime]:
-        """UTC ↔ +08:00 转换（保留毫秒）"""
-        _TZ_CN = timezone(timedelta(hours=8))  # 东八区
-
-        if not dt:
-            return None
-        utc_dt = datetime.fromisoformat(dt.replace("Z", "+00:00"))
-        return utc_dt.astimezone(_TZ_CN)
-
-    def _get_text(node, tag: str, default: str = "") -> str:
-        """安全读取子节点文本，避免 .text 为 None 报错"""
-        child = node.find(tag) if node is not None else None
-        return child.text.strip() if child is not None and child.text else default
-
-    def _html_to_text(raw: str) -> str:
-        """
-        使用 BeautifulSoup 把 MailData 里的富文本 HTML ➟ 纯文本。
-        - <p>、<br> 等标签自动转换为换行
-        - &lt; &gt; 实体自动解码
-        """
-        if not raw:
-            return ""
-        decoded = html.unescape(raw)  # 把 &lt; 之类实体转回 <
-        soup = BeautifulSoup(decoded, "lxml")  # 速度更快；缺省回退 html.parser
-        text = soup.get_text(strip=True)  # 保留换行
-        text = re.sub(r"\s*\n\s*", "\n", text)  # 压缩相邻空行
-        text = re.sub(r"[ \t]{2,}", " ", text)  # 连续空格→单空格
-        return text.strip()
-
-    def postprocess(xml_text: bytes) -> MailDetail:
-        root = ET.fromstring(xml_text.decode("utf-8"))
-
-        # ----- 附件列表 -----
-        attachments = [RegisteredDocumentAttachment(attachment_id=a.attrib.get("attachmentId"),
-                                                    document_no=_get_text(a, "DocumentNo"),
-                                                    file_name=_get_text(a, "FileName"),
-                                                    file_size=_get_text(a, "FileSize"),
-                                                    title=_get_text(a, "Title"),
-                                                    revision=_get_text(a, "Revision"),
-                                                    document_id=_get_text(a, "DocumentId"),
-                                                    ) for a in
-                       (root.find("Attachments") or [])]
-
-        # ----- 收件人列表 -----
-        recipients = [Recipient(name=_get_text(r, "Name"), organization_name=_get_text(r, "OrganizationName"), ) for r
-                      in (root.find("ToUsers") or [])]
-
-        # ----- 发件人 -----
-        fu = root.find("FromUserDetails")
-        from_user_details = FromUserDetails(name=_get_text(fu, "Name"),
-                                            organization_name=_get_text(fu, "OrganizationName"), )
-
-        # ----- 组装 MailDetail -----
-        return MailDetail(mail_id=root.attrib.get("MailId"), subject=_get_text(root, "Subject"),
-                          sent_date=_parse_datetime(_get_text(root, "SentDate")),
-                          mail_data=_html_to_text(_get_text(root, "MailData")), from_user_details=from_user_details,
-                          attachments=attachments, recipients=recipients, )
-
-    response = get_with_retry(url=f"{config.resource_url}/api/projects/{config.project_id}/mail/{mail_id}",
-                              headers={"Authorization": f"Bearer {config.access_token}"})
-    response.raise_for_status()
-    return postprocess(xml_text=response.content)
+    return run_sync(viewMailMetadataAsync(mail_id=mail_id, include=include))
+
+
+@dataclass
+class AttachmentDownload:
+    """一个附件下载（aria2 与内置下载器共用）"""
+    url: str
+    options: dict
+    expected_size: Optional[int]  # 附件 FileSize，未知时为 None（只检查文件存在）
+    gid: Optional[str] = None
+    attempts: int = 0
+    document_key: Optional[tuple[str, str]] = None  # (document_id, revision)，用于附件存储去重
+    links: list[Path] = field(default_factory=list)  # 同一登记文件的其他放置位置，下载完成后链接
+    on_complete: Optional[Callable[["AttachmentDownload"], None]] = None
+
+    @property
+    def path(self) -> Path:
+        return Path(self.options["dir"]) / self.options["out"]
+
+    @property
+    def control_files(self) -> list[Path]:
+        """断点续传控制文件（aria2 的 .aria2、内置下载器的 .download），存在表示下载未完成"""
+        return [self.path.with_name(self.path.name + ".aria2"), controlPath(self.path)]
+
+    def is_complete(self) -> bool:
+        if not self.path.is_file() or any(_f.exists() for _f in self.control_files):
+            return False
+        return self.expected_size is None or self.path.stat().st_size == self.expected_size
+
+    def finish(self):
+        """下载完成（或文件已存在）后执行 on_complete；失败只打印，不影响下载结果"""
+        if self.on_complete is None:
+            return
+        try:
+            self.on_complete(self)
+        except Exception as e:
+            print(f"下载后处理失败: {self.path}, {e!r}")
+
+
+class Aria2Batcher:
+    """
+    批量提交和监控 aria2 下载：
+    - add() 排队，每 config.aria2_batch_size 个通过一次 system.multicall 提交 aria2.addUri；
+      不足一批时，排队最久的下载等待 config.aria2_flush_delay 秒后由定时器提交，不必等到 wait()
+    - poll() 用一次 multicall 查询全部在途下载的状态，完成的下载校验文件大小是否等于附件 FileSize
+    - 出错或大小不符的下载自动重新提交，最多 config.download_max_attempts 次；大小不符的文件先删除再下载
+    """
+
+    STATUS_KEYS = ["gid", "status", "totalLength", "completedLength", "errorMessage"]
+
+    def __init__(self, client: Optional[aria2p.Client] = None):
+        self.client = client or ARIA2P_API.client
+        self._queue: list[AttachmentDownload] = []
+        self._active: dict[str, AttachmentDownload] = {}
+        self._lock = threading.RLock()  # add() / 定时提交 / wait() 可能在不同线程
+        self._timer: Optional[threading.Timer] = None
+        self.completed = self.skipped = self.resubmitted = 0
+        self.failures: list[tuple[AttachmentDownload, str]] = []
+        self.rpc_calls = 0
+
+    def _multicall(self, calls: list[tuple[str, list]]) -> list:
+        start = time.perf_counter()
+        try:
+            results = self.client.multicall2(calls)
+        except Exception:
+            METRICS.observe_request(self.client.server, "POST", None, time.perf_counter() - start)
+            raise
+        METRICS.observe_request(self.client.server, "POST", 200, time.perf_counter() - start)
+        self.rpc_calls += 1
+        return results
+
+    def add(self, download: AttachmentDownload):
+        if download.is_complete():
+            self.skipped += 1
+            print(f"文件已存在，跳过下载: {download.path}")
+            download.finish()
+            return
+        with self._lock:
+            self._queue.append(download)
+            if len(self._queue) < config.aria2_batch_size:
+                if self._timer is None and config.aria2_flush_delay is not None:
+                    self._timer = threading.Timer(config.aria2_flush_delay, self._flush_later)
+                    self._timer.daemon = True
+                    self._timer.start()
+                return
+        self.flush()
+
+    def _flush_later(self):
+        """定时器线程中提交；aria2 RPC 失败时下载留在队列中，由下一次提交或 wait() 重试"""
+        try:
+            self.flush()
+        except Exception as e:
+            print(f"提交下载失败，稍后重试: {e!r}")
+
+    def flush(self):
+        """提交排队中的下载"""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            queue, self._queue = self._queue, []
+            for start in range(0, len(queue), config.aria2_batch_size):
+                chunk = queue[start:start + config.aria2_batch_size]
+                for _d in chunk:
+                    _d.attempts += 1
+                    # 重新提交时 token 可能已刷新
+                    _d.options["header"] = [f"Authorization: Bearer {TOKEN_MANAGER.get_token()}"]
+                try:
+                    results = self._multicall([(self.client.ADD_URI, [[_d.url], _d.options]) for _d in chunk])
+                except Exception:
+                    for _d in chunk:
+                        _d.attempts -= 1
+                    self._queue[:0] = queue[start:]  # 未提交的下载放回队列
+                    raise
+                for _d, _res in zip(chunk, results):
+                    if isinstance(_res, dict):  # 单个调用失败时返回 fault
+                        self._retry(_d, _res.get("faultString", "addUri failed"))
+                        continue
+                    _d.gid = _res[0]
+                    self._active[_d.gid] = _d
+                    print(f"gid: {_d.gid}, 保存到 {_d.options['dir']}/{_d.options['out']}")
+
+    def poll(self) -> tuple[int, int]:
+        """查询在途下载的状态并处理已结束的下载，返回在途下载的 (已下载字节数, 总字节数)"""
+        done_bytes = total_bytes = 0
+        finished = []
+        gids = list(self._active)
+        for start in range(0, len(gids), config.aria2_batch_size):
+            chunk = gids[start:start + config.aria2_batch_size]
+            results = self._multicall([(self.client.TELL_STATUS, [_g, self.STATUS_KEYS]) for _g in chunk])
+            for gid, _res in zip(chunk, results):
+                if isinstance(_res, dict):  # aria2 已不认识该 gid（如 aria2 重启）
+                    self._retry(self._active.pop(gid), _res.get("faultString", "tellStatus failed"))
+                    continue
+                status = _res[0]
+                if status["status"] in ("active", "waiting", "paused"):
+                    done_bytes += int(status.get("completedLength", 0))
+                    total_bytes += int(status.get("totalLength", 0))
+                    continue
+                download = self._active.pop(gid)
+                finished.append(gid)
+                if status["status"] == "complete":
+                    self._verify(download)
+                else:
+                    self._retry(download, status.get("errorMessage") or status["status"])
+        # 清理 aria2 中已结束的下载记录
+        for start in range(0, len(finished), config.aria2_batch_size):
+            self._multicall([(self.client.REMOVE_DOWNLOAD_RESULT, [_g])
+                             for _g in finished[start:start + config.aria2_batch_size]])
+        return done_bytes, total_bytes
+
+    def _verify(self, download: AttachmentDownload):
+        if download.is_complete():
+            self.completed += 1
+            download.finish()
+            return
+        size = download.path.stat().st_size if download.path.is_file() else None
+        download.path.unlink(missing_ok=True)
+        for _control in download.control_files:
+            _control.unlink(missing_ok=True)
+        self._retry(download, f"文件大小 {size} 与附件大小 {download.expected_size} 不符")
+
+    def _retry(self, download: AttachmentDownload, reason: str):
+        download.gid = None
+        if download.attempts < config.download_max_attempts:
+            self.resubmitted += 1
+            print(f"重新提交下载（{reason}）: {download.path}")
+            with self._lock:
+                self._queue.append(download)
+        else:
+            self.failures.append((download, reason))
+            print(f"下载失败（{reason}），已尝试 {download.attempts} 次: {download.path}")
+
+    def wait(self) -> dict:
+        """提交剩余的下载，轮询直到全部完成或重试用尽，返回统计"""
+        self.flush()
+        while self._active or self._queue:
+            time.sleep(config.aria2_poll_interval)
+            done_bytes, total_bytes = self.poll()
+            self.flush()
+            print(f"下载进度: 完成 {self.completed}, 进行中 {len(self._active)} "
+                  f"({done_bytes / 1024 / 1024:.1f}/{total_bytes / 1024 / 1024:.1f} MiB), "
+                  f"重试 {self.resubmitted}, 失败 {len(self.failures)}")
+        return {"completed": self.completed, "skipped": self.skipped, "resubmitted": self.resubmitted,
+                "failed": len(self.failures), "rpc_calls": self.rpc_calls}
+
+
+# 进程内共享的 aria2 批量提交器
+ARIA2_BATCHER = Aria2Batcher()
+
+
+class RangeDownloadBatcher:
+    """
+    与 Aria2Batcher 接口相同的进程内下载（config.download_engine = "builtin"，不需要 aria2c RPC 服务）：
+    add() 后立即在后台事件循环中用 RangeDownloader 分段下载，同时下载的文件数不超过 config.download_concurrent_files；
+    失败的下载从断点重新下载，最多 config.download_max_attempts 次
+    """
+
+    def __init__(self, downloader: Optional[RangeDownloader] = None):
+        self.downloader = downloader or RangeDownloader(ASYNC_CLIENT)
+        self._futures = []
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self.completed = self.skipped = self.resubmitted = 0
+        self.failures: list[tuple[AttachmentDownload, str]] = []
+        self.rpc_calls = 0  # 不使用 RPC，保持与 Aria2Batcher 相同的统计项
+
+    def add(self, download: AttachmentDownload):
+        if download.is_complete():
+            self.skipped += 1
+            print(f"文件已存在，跳过下载: {download.path}")
+            download.finish()
+            return
+        self._futures.append(asyncio.run_coroutine_threadsafe(self._download(download), get_loop()))
+
+    async def _download(self, download: AttachmentDownload):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(max(config.download_concurrent_files, 1))
+        async with self._semaphore:
+            while True:
+                download.attempts += 1
+                try:
+                    await self.downloader.download_async(download.url, download.path, download.expected_size)
+                except Exception as e:
+                    if download.attempts >= config.download_max_attempts:
+                        self.failures.append((download, repr(e)))
+                        print(f"下载失败（{e!r}），已尝试 {download.attempts} 次: {download.path}")
+                        return
+                    self.resubmitted += 1
+                    print(f"重新下载（{e!r}）: {download.path}")
+                    continue
+                self.completed += 1
+                print(f"下载完成: {download.path}")
+                await asyncio.to_thread(download.finish)
+                return
+
+    def wait(self) -> dict:
+        """等待全部下载结束，返回统计"""
+        for _future in self._futures:
+            _future.result()
+        self._futures.clear()
+        return {"completed": self.completed, "skipped": self.skipped, "resubmitted": self.resubmitted,
+                "failed": len(self.failures), "rpc_calls": self.rpc_calls}
+
+
+RANGE_BATCHER = RangeDownloadBatcher()
+
+
+def downloadBatcher():
+    """按 config.download_engine 选择下载器"""
+    return RANGE_BATCHER if config.download_engine == "builtin" else ARIA2_BATCHER
+
+
+# 附件存储：同一登记文件只下载一次（config.attachment_dedup）
+ATTACHMENT_STORE = AttachmentStore()
+PENDING_DOCUMENTS: dict[tuple[str, str], AttachmentDownload] = {}  # 本次运行中正在下载的登记文件
+_PENDING_LOCK = threading.Lock()
+
+
+def storeDownload(download: AttachmentDownload):
+    """下载完成后存入附件存储，并在同一登记文件的其他位置放置链接"""
+    sha256 = ATTACHMENT_STORE.ingest(download.path, *download.document_key)
+    # 先入库再移出等待表：之后提交的同一文件直接从存储链接，之前提交的都在 links 中
+    with _PENDING_LOCK:
+        if PENDING_DOCUMENTS.get(download.document_key) is download:
+            del PENDING_DOCUMENTS[download.document_key]
+        links = list(download.links)
+    for _path in links:
+        ATTACHMENT_STORE.place(sha256, _path)
 
 
 def download_attachment_aria2c(attachment: RegisteredDocumentAttachment, subject: str, mail_id: str, sub_path: Optional[str] = None):
-    """下载邮件附件"""
-    global ARIA2P_API
-
-    def build_options(sub_dir, file_name: str):
-        target_path = DOWNLOAD_PATH / sub_dir if sub_path is None else DOWNLOAD_PATH / sub_path / sub_dir
-        target_path.mkdir(parents=True, exist_ok=True)
-        return {
-            "dir": str(target_path),  # 下载目录
-            "out": file_name,  # 保存的文件名
-            "continue": "true",  # 断点续传
-            "max-connection-per-server": "16",  # 每个服务器的最大连接数
-            "split": 16,  # 文件分片数
-            "min-split-size": "1M",  # 最小分片大小
-            "file-allocation": "falloc",  # 文件预分配方式
-            "header": [f"Authorization: Bearer {config.access_token}"],  # Aconex 附件需要
-        }
+    """
+    下载邮件附件：交给 downloadBatcher()（aria2 批量提交或内置分段下载），调用其 wait() 等待完成并校验
+
+    config.attachment_dedup 时先查附件存储的 manifest：已放置且文件仍在的路径直接跳过，已下载过的登记文件改为链接
+    （存储文件丢失时重新下载），本次运行中正在下载的登记文件在其下载完成后链接
+    """
+    target_path = DOWNLOAD_PATH / clean_str(subject) if sub_path is None else DOWNLOAD_PATH / sub_path / clean_str(subject)
+    target = target_path / attachment.file_name
+    document_key = (attachment.document_id, attachment.revision or "") if attachment.document_id else None
+    if config.attachment_dedup and document_key is not None:
+        if ATTACHMENT_STORE.is_placed(target):
+            return
+        with _PENDING_LOCK:
+            sha256 = ATTACHMENT_STORE.lookup(*document_key)
+            pending = PENDING_DOCUMENTS.get(document_key) if sha256 is None else None
+            if pending is not None:
+                pending.links.append(target)
+                return
+        # 存储文件丢失时 place() 删除记录并返回 False，改为重新下载
+        if sha256 is not None and ATTACHMENT_STORE.place(sha256, target):
+            return
+
+    target_path.mkdir(parents=True, exist_ok=True)
+    options = {
+        "dir": str(target_path),  # 下载目录
+        "out": attachment.file_name,  # 保存的文件名
+        "continue": "true",  # 断点续传
+        "max-connection-per-server": "16",  # 每个服务器的最大连接数
+        "split": "16",  # 文件分片数
+        "min-split-size": "1M",  # 最小分片大小
+        "file-allocation": "falloc",  # 文件预分配方式
+    }  # Authorization 头（Aconex 附件需要）在提交时添加
 
     # 构造下载链接
     url = f"{config.resource_url}/api/projects/{config.project_id}/mail/{mail_id}/attachments/{attachment.attachment_id}"
-    options = build_options(clean_str(subject), attachment.file_name)
+    expected_size = int(attachment.file_size) if str(attachment.file_size).isdigit() else None
+    download = AttachmentDownload(url=url, options=options, expected_size=expected_size)
+    if config.attachment_dedup and document_key is not None:
+        download.document_key = document_key
+        download.on_complete = storeDownload
+        with _PENDING_LOCK:
+            PENDING_DOCUMENTS[document_key] = download
+    downloadBatcher().add(download)
 
-    # 检查预期文件是否已经存在
-    expected_file = Path(options['dir']) / options['out']
-    if expected_file.exists():
-        print(f"文件已存在，跳过下载: {expected_file}")
-        return
 
-    download = ARIA2P_API.add(url, options=options)[0]
-    print(f"gid: {download.gid}, 保存到 {options['dir']}/{options['out']}")
-    # return gid
+def iterDownloadRows(sheet) -> Iterator[dict]:
+    """读取 sheet 中需要下载附件的行（有图号且版本为数字）"""
+    for row in sheet.iter_rows(min_row=2, max_col=50, values_only=True):
+        if row[1] is not None and str(row[4]).isdigit():
+            yield {"id": row[1], "name": row[2], "ver": row[4], "mail_ID": row[8], "sheet": sheet.title}
+
+
+async def prefetchMailMetadataAsync(rows: Iterable[dict], concurrency: Optional[int] = None
+                                    ) -> AsyncIterator[tuple[dict, Union[MailDetail, Exception]]]:
+    """
+    并发获取每行邮件的元数据（只解析主题和附件），按完成顺序产出 (行, MailDetail 或异常)
+
+    同时等待的请求数不超过 concurrency（实际在途数仍由 ASYNC_CLIENT 的自适应并发限制）；
+    同一封邮件出现在多行时只请求一次
+    """
+    semaphore = asyncio.Semaphore(max(concurrency or config.download_metadata_concurrency, 1))
+    fetched: dict[str, asyncio.Task] = {}
+
+    async def _fetch(mail_id: str) -> MailDetail:
+        async with semaphore:
+            return await viewMailMetadataAsync(mail_id=mail_id, include=("attachments",))
+
+    async def _row(data: dict):
+        mail_id = str(data["mail_ID"])
+        if mail_id not in fetched:
+            fetched[mail_id] = asyncio.create_task(_fetch(mail_id))
+        try:
+            return data, await asyncio.shield(fetched[mail_id])
+        except Exception as e:
+            return data, e
+
+    row_tasks = [asyncio.create_task(_row(_d)) for _d in rows]
+    try:
+        for _next in asyncio.as_completed(row_tasks):
+            yield await _next
+    finally:
+        # 调用方提前结束时取消尚未完成的请求
+        for _task in [*row_tasks, *fetched.values()]:
+            _task.cancel()
+
+
+def iterMailMetadata(rows: Iterable[dict], concurrency: Optional[int] = None
+                     ) -> Iterator[tuple[dict, Union[MailDetail, Exception]]]:
+    """prefetchMailMetadataAsync 的同步版本；请求在后台事件循环中进行，调用方处理当前结果时预取不中断"""
+    results = prefetchMailMetadataAsync(rows, concurrency)
+    try:
+        while True:
+            try:
+                yield run_sync(results.__anext__())
+            except StopAsyncIteration:
+                return
+    finally:
+        run_sync(results.aclose())
+
+
+def downloadMailAttachments(data: dict, mail_response: MailDetail) -> int:
+    """把一封邮件的附件交给 aria2，返回提交的附件数（作废 / 转发邮件跳过）"""
+    if "作废" in mail_response.subject:
+        print("跳过作废邮件:", mail_response.subject)
+        return 0
+    if "转发" in mail_response.subject:
+        print("跳过转发邮件:", mail_response.subject)
+        return 0
+    for att in mail_response.attachments:
+        print(f"{mail_response.subject} 附件: {att.file_name} ({att.attachment_id})")
+        download_attachment_aria2c(att, subject=mail_response.subject, mail_id=data.get('mail_ID'), sub_path=data["sheet"])
+    return len(mail_response.attachments)
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="按图纸进度跟踪表下载邮件附件（aria2c RPC）")
+    parser.add_argument("--xlsx", default=XLSX_PATH, help="图纸进度跟踪表路径")
+    parser.add_argument("--sheet", action="append", default=[], help="要处理的 sheet（可重复），默认除汇总表外的全部 sheet")
+    parser.add_argument("--concurrency", type=int, default=None, help="并发预取邮件元数据的上限，默认 config.download_metadata_concurrency")
+    parser.add_argument("--engine", choices=["aria2", "builtin"], default=None,
+                        help="下载方式：aria2c RPC 或进程内分段下载，默认 config.download_engine")
+    parser.add_argument("--no-dedup", action="store_true", help="不使用附件存储，每个附件都下载到各自的主题目录")
+    parser.add_argument("--offline", action="store_true", help="只从本地邮件仓库读取邮件元数据（先运行 mail_warehouse.py sync --details）")
+    parser.add_argument("--profile", action="store_true", help="分阶段 cProfile / tracemalloc 剖析，报告写入 config.profile_dir")
+    args = parser.parse_args()
+    if args.profile:
+        PROFILER.start()
+    config.offline = config.offline or args.offline
+    config.download_engine = args.engine or config.download_engine
+    config.attachment_dedup = config.attachment_dedup and not args.no_dedup
+
     requestToken()
 
-    wb = openpyxl.load_workbook(XLSX_PATH)
-    sheet_list = ["建筑", "结构", "防水", "粗装", "1#楼精装", "泛光照明"]
-    sheet = wb[sheet_list[5]]
+    wb = openpyxl.load_workbook(args.xlsx, read_only=True)
+    sheet_names = args.sheet or [_n for _n in wb.sheetnames if _n not in SKIP_SHEETS]
+    missing = [_n for _n in sheet_names if _n not in wb.sheetnames]
+    if missing:
+        raise KeyError(f"Sheets not found in '{args.xlsx}': {missing}")
+    with METRICS.stage("load"):
+        download_rows = [_d for _n in sheet_names for _d in iterDownloadRows(wb[_n])]
+    wb.close()
 
-    for row in sheet.iter_rows(min_row=2, max_col=50, values_only=True):
-        if row[1] is not None and row[4].isdigit():
-            data = {"id": row[1], "name": row[2], "ver": row[4], "mail_ID": row[8]}
-            mail_response = viewMailMetadata(mail_id=data.get("mail_ID"))
-            if "作废" in mail_response.subject:
-                print("跳过作废邮件:", mail_response.subject)
-                continue
-            if "转发" in mail_response.subject:
-                print("跳过转发邮件:", mail_response.subject)
-                continue
-            for att in mail_response.attachments:
-                print(f"{mail_response.subject} 附件: {att.file_name} ({att.attachment_id})")
-                download_attachment_aria2c(att, subject=mail_response.subject, mail_id=data.get('mail_ID'), sub_path=sheet.title)
+    queued = failed = 0
+    for data, mail_response in iterMailMetadata(download_rows, args.concurrency):
+        if isinstance(mail_response, Exception):
+            failed += 1
+            print(f"获取邮件元数据失败: {data['sheet']} {data['id']} ({data['mail_ID']}), {mail_response!r}")
+            continue
+        queued += downloadMailAttachments(data, mail_response)
+    print(f"{len(download_rows)} rows in {len(sheet_names)} sheets, {queued} attachments queued, {failed} failed.")
+    summary = downloadBatcher().wait()
+    print(f"Downloads: {summary['completed']} completed, {summary['skipped']} skipped, {summary['resubmitted']} resubmitted, "
+          f"{summary['failed']} failed" + (f", {summary['rpc_calls']} aria2 RPC calls." if config.download_engine == "aria2" else "."))
+    for _download, _reason in downloadBatcher().failures:
+        print(f"  {_download.path}: {_reason}" + (f"（另有 {len(_download.links)} 处链接未放置）" if _download.links else ""))
+    if config.attachment_dedup:
+        store_stats = ATTACHMENT_STORE.stats()
+        print(f"Attachment store: {ATTACHMENT_STORE.linked} linked this run, {store_stats['documents']} documents, "
+              f"{store_stats['blobs']} files / {store_stats['stored_bytes'] / 1024 / 1024:.1f} MiB stored for "
+              f"{store_stats['placements']} placements / {store_stats['placed_bytes'] / 1024 / 1024:.1f} MiB.")
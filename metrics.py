@@ -0,0 +1,207 @@
+"""
+运行指标
+
+- 请求级：按接口（endpoint）统计请求数 / 状态码、重试次数、响应字节数、延迟直方图
+- 阶段计时：fetch / parse / cell_write / border / load / save 等串行阶段的耗时直方图，汇总中给出总耗时
+- 并发步骤：search / workflow 在各行的协程中同时进行，总和会远超运行时间，单独记为每次调用的延迟直方图
+  （aconex_call_duration_seconds），汇总中只给出调用次数和平均延迟
+- 退出时写出 JSON 和 Prometheus textfile（供 node_exporter textfile collector 采集），并打印简要汇总
+"""
+import json
+import os
+import re
+import sys
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+from typing import Callable, ContextManager, Iterator, Optional
+from urllib.parse import urlsplit
+
+from config import config
+
+# 延迟直方图的桶上界（秒）
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# 在多个协程中同时进行的步骤：按每次调用的延迟统计，不作为阶段累计耗时
+CONCURRENT_STAGES = frozenset({"search", "workflow"})
+
+_PROJECT_RE = re.compile(r"^/api/projects/[^/]+")
+_ID_RE = re.compile(r"/(?:\d+|[0-9a-fA-F-]{16,})(?=/|$)")
+
+
+def endpointOf(url: str) -> str:
+    """URL → 接口名：去掉项目前缀，数字 / UUID 路径段替换为 :id，如 /mail/:id/attachments/:id"""
+    path = _PROJECT_RE.sub("", urlsplit(str(url)).path)
+    path = re.sub(r"(/attachments)/[^/]+$", r"\1/:id", path)
+    return _ID_RE.sub("/:id", path) or "/"
+
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)  # 最后一个为 +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> list[tuple[str, int]]:
+        result, total = [], 0
+        for bound, n in zip([*map(str, BUCKETS), "+Inf"], self.counts):
+            total += n
+            result.append((bound, total))
+        return result
+
+    def to_dict(self) -> dict:
+        return {"count": self.count, "sum": round(self.sum, 6),
+                "mean": round(self.sum / self.count, 6) if self.count else None,
+                "buckets": dict(self.cumulative())}
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(**labels: str) -> str:
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + "}"
+
+
+class Metrics:
+    """线程安全的进程内指标"""
+
+    def __init__(self, script: Optional[str] = None):
+        self.script = script or os.path.splitext(os.path.basename(sys.argv[0] or "python"))[0] or "python"
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self.requests: dict[tuple[str, str, str], int] = {}  # (endpoint, method, status) → 次数
+        self.retries: dict[str, int] = {}
+        self.bytes: dict[str, int] = {}
+        self.latency: dict[str, Histogram] = {}
+        self.stages: dict[str, Histogram] = {}
+        self.calls: dict[str, Histogram] = {}  # CONCURRENT_STAGES 的每次调用延迟
+        # 进入每个阶段时额外进入的上下文（如 profiling.PROFILER.stage），不计入阶段耗时
+        self.stage_hooks: list[Callable[[str], ContextManager]] = []
+
+    def observe_request(self, url: str, method: str, status: Optional[int], latency: float, nbytes: int = 0,
+                        retry: bool = False):
+        """记录一次请求尝试；status 为 None 表示连接失败等未拿到响应"""
+        endpoint = endpointOf(url)
+        key = (endpoint, method.upper(), str(status) if status is not None else "error")
+        with self._lock:
+            self.requests[key] = self.requests.get(key, 0) + 1
+            if retry:
+                self.retries[endpoint] = self.retries.get(endpoint, 0) + 1
+            self.bytes[endpoint] = self.bytes.get(endpoint, 0) + nbytes
+            self.latency.setdefault(endpoint, Histogram()).observe(latency)
+
+    def observe_stage(self, name: str, seconds: float):
+        histograms = self.calls if name in CONCURRENT_STAGES else self.stages
+        with self._lock:
+            histograms.setdefault(name, Histogram()).observe(seconds)
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """阶段计时；可用于同步代码和协程（协程中为包含等待时间的墙钟时间，CONCURRENT_STAGES 记为每次调用的延迟）"""
+        with ExitStack() as hooks:
+            for hook in self.stage_hooks:
+                hooks.enter_context(hook(name))
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                self.observe_stage(name, time.perf_counter() - start)
+
+    # ---------------- 导出 ----------------
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                "script": self.script,
+                "started": self.started,
+                "duration": round(time.time() - self.started, 3),
+                "requests": [{"endpoint": e, "method": m, "status": s, "count": n}
+                             for (e, m, s), n in sorted(self.requests.items())],
+                "retries": dict(self.retries),
+                "bytes": dict(self.bytes),
+                "latency": {e: h.to_dict() for e, h in self.latency.items()},
+                "stages": {s: h.to_dict() for s, h in self.stages.items()},
+                "calls": {c: h.to_dict() for c, h in self.calls.items()},
+            }
+
+    def to_prometheus(self) -> str:
+        script = self.script
+        lines = []
+
+        def _header(name: str, kind: str, help_text: str):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        def _histogram(name: str, label: str, histograms: dict[str, Histogram]):
+            for key, h in sorted(histograms.items()):
+                for bound, n in h.cumulative():
+                    lines.append(f"{name}_bucket{_labels(script=script, **{label: key}, le=bound)} {n}")
+                lines.append(f"{name}_sum{_labels(script=script, **{label: key})} {h.sum:.6f}")
+                lines.append(f"{name}_count{_labels(script=script, **{label: key})} {h.count}")
+
+        with self._lock:
+            _header("aconex_requests_total", "counter", "Aconex API requests by endpoint, method and status.")
+            for (endpoint, method, status), n in sorted(self.requests.items()):
+                lines.append(f"aconex_requests_total"
+                             f"{_labels(script=script, endpoint=endpoint, method=method, status=status)} {n}")
+            _header("aconex_request_retries_total", "counter", "Retried Aconex API requests by endpoint.")
+            for endpoint, n in sorted(self.retries.items()):
+                lines.append(f"aconex_request_retries_total{_labels(script=script, endpoint=endpoint)} {n}")
+            _header("aconex_response_bytes_total", "counter", "Aconex API response bytes by endpoint.")
+            for endpoint, n in sorted(self.bytes.items()):
+                lines.append(f"aconex_response_bytes_total{_labels(script=script, endpoint=endpoint)} {n}")
+            _header("aconex_request_duration_seconds", "histogram", "Aconex API request latency by endpoint.")
+            _histogram("aconex_request_duration_seconds", "endpoint", self.latency)
+            _header("aconex_stage_duration_seconds", "histogram", "Time spent per pipeline stage.")
+            _histogram("aconex_stage_duration_seconds", "stage", self.stages)
+            _header("aconex_call_duration_seconds", "histogram",
+                    "Per-call latency of steps run concurrently across rows (calls overlap, the sum is not wall time).")
+            _histogram("aconex_call_duration_seconds", "call", self.calls)
+        _header("aconex_run_start_timestamp_seconds", "gauge", "Unix time the run started.")
+        lines.append(f"aconex_run_start_timestamp_seconds{_labels(script=script)} {self.started:.3f}")
+        _header("aconex_run_duration_seconds", "gauge", "Wall time of the run.")
+        lines.append(f"aconex_run_duration_seconds{_labels(script=script)} {time.time() - self.started:.3f}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        data = self.to_dict()
+        lines = [f"Run metrics ({data['duration']:.1f}s):"]
+        for endpoint, h in sorted(data["latency"].items()):
+            total = sum(r["count"] for r in data["requests"] if r["endpoint"] == endpoint)
+            lines.append(f"  {endpoint:<28} {total:>6} requests, mean {h['mean'] * 1000:.0f} ms, "
+                         f"{data['retries'].get(endpoint, 0)} retries, {data['bytes'].get(endpoint, 0) / 1024:.0f} KiB")
+        for stage, h in sorted(data["stages"].items()):
+            lines.append(f"  stage {stage:<22} {h['count']:>6} calls, total {h['sum']:.2f}s")
+        for call, h in sorted(data["calls"].items()):
+            lines.append(f"  call {call:<23} {h['count']:>6} calls, mean {h['mean'] * 1000:.0f} ms (concurrent)")
+        return "\n".join(lines)
+
+    def export(self, directory: Optional[str] = None):
+        """写出 <script>.json 和 <script>.prom（先写临时文件再替换，避免采集到不完整的文件）"""
+        directory = directory or config.metrics_dir
+        if not directory or (not self.requests and not self.stages and not self.calls):
+            return
+        os.makedirs(directory, exist_ok=True)
+        for ext, content in (("json", json.dumps(self.to_dict(), ensure_ascii=False, indent=2)),
+                             ("prom", self.to_prometheus())):
+            path = os.path.join(directory, f"{self.script}.{ext}")
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                f.write(content)
+            os.replace(path + ".tmp", path)
+        print(self.summary())
+
+
+# 进程内共享的指标
+METRICS = Metrics()
@@ -0,0 +1,260 @@
+"""
+分阶段性能剖析（--profile）
+
+- 挂在 METRICS.stage() 上：每个阶段（fetch / parse / cell_write / border / load / save 等）各用一个 cProfile，
+  同一线程上阶段嵌套时切换到内层阶段的 profile，退出后切回外层，因此每个阶段只统计自身（不含内层阶段）的函数
+- fetch 阶段由 run_sync() 在后台事件循环线程的协程中进入，统计事件循环线程上除其他阶段以外的全部工作
+- search / workflow 阶段内部有 await，会与其他协程交错，不单独剖析（其时间计入 fetch）
+- tracemalloc：每个阶段的前 config.profile_alloc_samples 次调用在进入 / 退出时各取一次快照，累计按行的分配差值
+- 退出时写出：
+    <脚本名>.<阶段>.prof     pstats 格式，可用 snakeviz / pstats 查看
+    <脚本名>.profile.txt     每个阶段按累计时间排序的函数和分配位置
+    <脚本名>.profile.json    同上的结构化数据；文件路径已去掉机器相关前缀，可在不同运行之间对比
+
+对比两次运行：
+    python profiling.py profile/main.profile.json new/main.profile.json
+"""
+import atexit
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from config import config
+from metrics import CONCURRENT_STAGES, METRICS
+
+# 内部有 await、会与其他协程交错执行的阶段
+INTERLEAVED_STAGES = CONCURRENT_STAGES
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# 剖析自身的分配不计入报告（不用 Snapshot.filter_traces，它逐条匹配，快照大时很慢）
+_IGNORED_ALLOC_FILES = frozenset({tracemalloc.__file__, __file__, "<frozen importlib._bootstrap>",
+                                  "<frozen importlib._bootstrap_external>"})
+
+
+def shortPath(path: str) -> str:
+    """去掉仓库目录 / site-packages / 标准库前缀，使报告在不同机器、虚拟环境之间可比"""
+    path = str(path)
+    if path.startswith(ROOT + os.sep):
+        return os.path.relpath(path, ROOT).replace(os.sep, "/")
+    for marker in ("site-packages", "dist-packages"):
+        idx = path.find(os.sep + marker + os.sep)
+        if idx != -1:
+            return path[idx + len(marker) + 2:].replace(os.sep, "/")
+    lib = os.path.dirname(os.__file__)
+    if path.startswith(lib + os.sep):
+        return "<stdlib>/" + os.path.relpath(path, lib).replace(os.sep, "/")
+    return path
+
+
+def funcName(key: tuple) -> str:
+    filename, lineno, name = key
+    if filename == "~":  # 内置函数
+        return name
+    return f"{shortPath(filename)}:{lineno}({name})"
+
+
+class StageProfiler:
+    """按阶段分别统计 cProfile 和 tracemalloc；enabled 之前 stage() 不做任何事"""
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.profiles: dict[tuple[str, int], cProfile.Profile] = {}  # (阶段, 线程 id) → profile
+        self.calls: dict[str, int] = {}
+        self.skipped: dict[str, int] = {}  # 其他线程的 profile 已启用而无法剖析的次数（Python 3.12+）
+        self.allocs: dict[str, dict[str, list[int]]] = {}  # 阶段 → {分配位置: [字节数, 块数]}
+        self.alloc_samples: dict[str, int] = {}
+
+    def start(self):
+        """开启剖析，并在退出时写出报告"""
+        if self.enabled:
+            return
+        self.enabled = True
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        METRICS.stage_hooks.append(self.stage)
+        atexit.register(self.report)
+
+    def _stack(self) -> list:
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _profile(self, name: str) -> cProfile.Profile:
+        key = (name, threading.get_ident())
+        with self._lock:
+            if key not in self.profiles:
+                self.profiles[key] = cProfile.Profile()
+            return self.profiles[key]
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        if not self.enabled or name in INTERLEAVED_STAGES:
+            yield
+            return
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+            sample = self.alloc_samples.get(name, 0) < config.profile_alloc_samples
+            if sample:
+                self.alloc_samples[name] = self.alloc_samples.get(name, 0) + 1
+
+        # 先停掉外层阶段的 profile，快照本身的开销不计入任何阶段
+        stack = self._stack()
+        profile = self._profile(name)
+        if stack and stack[-1][0] is not None:
+            stack[-1][0].disable()
+        before = tracemalloc.take_snapshot() if sample else None
+        try:
+            profile.enable()
+        except ValueError:  # Python 3.12+ 同一时间只能有一个 profiler
+            profile = None
+            with self._lock:
+                self.skipped[name] = self.skipped.get(name, 0) + 1
+        entry = [profile]
+        stack.append(entry)
+        try:
+            yield
+        finally:
+            is_top = stack[-1] is entry
+            del stack[next(_i for _i, _e in enumerate(stack) if _e is entry)]
+            if is_top and profile is not None:
+                profile.disable()
+            if before is not None:
+                self._record_allocs(name, before)
+            if is_top and stack and stack[-1][0] is not None:
+                stack[-1][0].enable()
+
+    def _record_allocs(self, name: str, before: tracemalloc.Snapshot):
+        diff = tracemalloc.take_snapshot().compare_to(before, "lineno")
+        with self._lock:
+            sites = self.allocs.setdefault(name, {})
+            for stat in diff:
+                frame = stat.traceback[0]
+                if stat.size_diff <= 0 or frame.filename in _IGNORED_ALLOC_FILES:
+                    continue
+                site = sites.setdefault(f"{shortPath(frame.filename)}:{frame.lineno}", [0, 0])
+                site[0] += stat.size_diff
+                site[1] += max(stat.count_diff, 0)
+
+    # ---------------- 报告 ----------------
+    def stats(self) -> dict[str, pstats.Stats]:
+        """合并每个阶段各线程的 profile"""
+        merged: dict[str, pstats.Stats] = {}
+        for (name, _), profile in list(self.profiles.items()):
+            profile.disable()
+            try:
+                stats = pstats.Stats(profile)
+            except TypeError:  # 从未采到数据
+                continue
+            if name in merged:
+                merged[name].add(stats)
+            else:
+                merged[name] = stats
+        return merged
+
+    def to_dict(self, stats: Optional[dict[str, pstats.Stats]] = None) -> dict:
+        stats = self.stats() if stats is None else stats
+        top = config.profile_top
+        traced, peak = tracemalloc.get_traced_memory() if tracemalloc.is_tracing() else (0, 0)
+        stages = {}
+        for name in sorted(set(self.calls) | set(stats)):
+            entry: dict = {"calls": self.calls.get(name, 0), "skipped": self.skipped.get(name, 0)}
+            if name in stats:
+                rows = sorted(stats[name].stats.items(), key=lambda _i: _i[1][3], reverse=True)[:top]
+                entry["total_time"] = round(stats[name].total_tt, 6)
+                entry["functions"] = {funcName(_k): {"ncalls": _v[1], "tottime": round(_v[2], 6),
+                                                     "cumtime": round(_v[3], 6)} for _k, _v in rows}
+            sites = sorted(self.allocs.get(name, {}).items(), key=lambda _i: _i[1][0], reverse=True)[:top]
+            entry["alloc_samples"] = self.alloc_samples.get(name, 0)
+            entry["allocations"] = {_s: {"bytes": _v[0], "blocks": _v[1]} for _s, _v in sites}
+            stages[name] = entry
+        return {"script": METRICS.script, "python": sys.version.split()[0],
+                "traced_peak_bytes": peak, "traced_bytes": traced, "stages": stages}
+
+    def to_text(self, stats: dict[str, pstats.Stats], data: dict) -> str:
+        out = io.StringIO()
+        out.write(f"Profile of {data['script']} (Python {data['python']}), "
+                  f"traced memory peak {data['traced_peak_bytes'] / 1024 / 1024:.1f} MiB\n")
+        for name, entry in data["stages"].items():
+            out.write(f"\n{'=' * 30} stage {name}: {entry['calls']} calls, "
+                      f"{entry.get('total_time', 0):.3f}s profiled")
+            if entry["skipped"]:
+                out.write(f", {entry['skipped']} not profiled")
+            out.write(f" {'=' * 30}\n")
+            if name in stats:
+                stats[name].stream = out
+                stats[name].sort_stats(pstats.SortKey.CUMULATIVE).print_stats(config.profile_top)
+            if entry["allocations"]:
+                out.write(f"Top allocation sites (net, first {entry['alloc_samples']} calls):\n")
+                for site, alloc in entry["allocations"].items():
+                    out.write(f"  {alloc['bytes'] / 1024:>10.1f} KiB {alloc['blocks']:>8} blocks  {site}\n")
+        return out.getvalue()
+
+    def report(self, directory: Optional[str] = None):
+        directory = directory or config.profile_dir
+        stats = self.stats()
+        if not stats and not self.allocs:
+            return
+        os.makedirs(directory, exist_ok=True)
+        script = METRICS.script
+        for name, stage_stats in stats.items():
+            stage_stats.dump_stats(os.path.join(directory, f"{script}.{name}.prof"))
+        data = self.to_dict(stats)
+        with open(os.path.join(directory, f"{script}.profile.json"), "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        with open(os.path.join(directory, f"{script}.profile.txt"), "w", encoding="utf-8") as f:
+            f.write(self.to_text(stats, data))
+        print(f"Profile written to '{directory}': "
+              + ", ".join(f"{_n} {_e.get('total_time', 0):.2f}s" for _n, _e in data["stages"].items()))
+
+
+def compareProfiles(old: dict, new: dict, top: int = 10) -> str:
+    """两次 profile.json 的对比：每个阶段的总时间，以及累计时间变化最大的函数和分配位置"""
+    lines = []
+    for name in sorted(set(old["stages"]) | set(new["stages"])):
+        o, n = old["stages"].get(name, {}), new["stages"].get(name, {})
+        ot, nt = o.get("total_time", 0.0), n.get("total_time", 0.0)
+        change = f"{(nt - ot) / ot:+.1%}" if ot else "new"
+        lines.append(f"stage {name}: {ot:.3f}s -> {nt:.3f}s ({change}), "
+                     f"calls {o.get('calls', 0)} -> {n.get('calls', 0)}")
+        of, nf = o.get("functions", {}), n.get("functions", {})
+        deltas = sorted(((nf.get(_f, {}).get("cumtime", 0.0) - of.get(_f, {}).get("cumtime", 0.0), _f)
+                         for _f in set(of) | set(nf)), key=lambda _i: abs(_i[0]), reverse=True)[:top]
+        for delta, func in deltas:
+            lines.append(f"  {delta:+9.3f}s  {func}")
+        oa, na = o.get("allocations", {}), n.get("allocations", {})
+        deltas = sorted(((na.get(_s, {}).get("bytes", 0) - oa.get(_s, {}).get("bytes", 0), _s)
+                         for _s in set(oa) | set(na)), key=lambda _i: abs(_i[0]), reverse=True)[:top]
+        for delta, site in deltas:
+            if delta:
+                lines.append(f"  {delta / 1024:+9.1f} KiB  {site}")
+    return "\n".join(lines)
+
+
+# 进程内共享的剖析器
+PROFILER = StageProfiler()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="对比两次 --profile 运行生成的 <脚本名>.profile.json")
+    parser.add_argument("old")
+    parser.add_argument("new")
+    parser.add_argument("--top", type=int, default=10)
+    _args = parser.parse_args()
+    with open(_args.old, encoding="utf-8") as _f:
+        _old = json.load(_f)
+    with open(_args.new, encoding="utf-8") as _f:
+        _new = json.load(_f)
+    print(compareProfiles(_old, _new, _args.top))
@@ -0,0 +1,166 @@
+"""
+进程内分段下载器（不需要单独启动 aria2c RPC 服务）
+
+- 请求经 AsyncAconexClient.stream() 发出：共用连接池、token 和自适应并发上限（只占用到响应头），
+  响应体边收边在线程池中写入磁盘
+- 第一次请求 Range: bytes=0-<config.download_min_split_size - 1>，从 Content-Range 得到文件大小，同时写入第一段；
+  服务器不支持 Range（返回 200）时直接写入整个文件
+- 文件较大时预分配到完整大小，剩余部分分成最多 config.download_split 段并发请求，各段写到自己的偏移
+- 进度记录在 <文件名>.download 控制文件（JSON：文件大小和每段已写入的字节数），中断或失败后再次下载同一文件
+  只请求未写入的部分；完成后删除控制文件
+"""
+import asyncio
+import json
+import os
+import re
+from pathlib import Path
+from typing import Optional
+
+import aiohttp
+
+from aconex_async import AsyncAconexClient
+from adaptive_limiter import retryDelay
+from config import config
+
+CONTROL_SUFFIX = ".download"
+
+_CONTENT_RANGE_RE = re.compile(r"bytes (\d+)-(\d+)/(\d+)")
+
+# 传输中断类错误：从断点重新请求该段
+_RESUMABLE_ERRORS = (aiohttp.ClientPayloadError, aiohttp.ClientConnectionError, asyncio.TimeoutError)
+
+
+def controlPath(path: Path) -> Path:
+    return path.with_name(path.name + CONTROL_SUFFIX)
+
+
+class RangeDownloader:
+    """单个文件的分段下载；一个实例可同时下载多个文件"""
+
+    def __init__(self, client: AsyncAconexClient, split: Optional[int] = None, min_split_size: Optional[int] = None):
+        self.client = client
+        self.split = max(split or config.download_split, 1)
+        self.min_split_size = max(min_split_size or config.download_min_split_size, 1)
+
+    # ---------------- 控制文件 ----------------
+    @staticmethod
+    def _load_state(path: Path) -> Optional[dict]:
+        control = controlPath(path)
+        if not control.is_file() or not path.is_file():
+            return None
+        try:
+            state = json.loads(control.read_text(encoding="utf-8"))
+        except ValueError:
+            return None
+        if not isinstance(state.get("size"), int) or not isinstance(state.get("pieces"), list):
+            return None
+        return state
+
+    @staticmethod
+    def _save_state(path: Path, state: dict):
+        control = controlPath(path)
+        tmp = control.with_name(control.name + ".tmp")
+        tmp.write_text(json.dumps(state), encoding="utf-8")
+        os.replace(tmp, control)
+
+    @staticmethod
+    def _preallocate(path: Path, size: int):
+        with open(path, "r+b") as f:
+            try:
+                os.posix_fallocate(f.fileno(), 0, size)
+            except (AttributeError, OSError):  # Windows 或文件系统不支持
+                f.truncate(size)
+
+    # ---------------- 下载 ----------------
+    def _split(self, start: int, end: int) -> list[list[int]]:
+        """[start, end) 分成最多 self.split 段，每段不小于 min_split_size；每段为 [起点, 终点, 已写入字节数]"""
+        if start >= end:
+            return []
+        count = min(self.split, max(1, (end - start) // self.min_split_size))
+        size = -(-(end - start) // count)
+        return [[_s, min(_s + size, end), 0] for _s in range(start, end, size)]
+
+    async def _probe(self, url: str, path: Path) -> dict:
+        """请求第一段：得到文件大小并写入第一段；服务器忽略 Range 时写入整个文件"""
+        info = {}
+
+        with open(path, "wb") as f:
+            def _on_response(response: aiohttp.ClientResponse):
+                match = _CONTENT_RANGE_RE.match(response.headers.get("Content-Range", ""))
+                if response.status == 206 and match is None:
+                    raise ValueError(f"Unexpected Content-Range for {url}: {response.headers.get('Content-Range')!r}")
+                info["size"] = int(match.group(3)) if response.status == 206 else None
+                return f.write
+
+            written = await self.client.stream(url, _on_response, headers={"Range": f"bytes=0-{self.min_split_size - 1}"})
+
+        if info["size"] is None:
+            return {"size": written, "pieces": []}
+        size = info["size"]
+        first_end = min(self.min_split_size, size)
+        if size > first_end:
+            self._preallocate(path, size)
+        return {"size": size, "pieces": [[0, first_end, written], *self._split(first_end, size)]}
+
+    async def _fetch_piece(self, url: str, path: Path, piece: list[int]):
+        """下载一段中尚未写入的部分，piece[2] 随写入前移；传输中断或短读时按 config.retry_times 退避后从断点重试"""
+        attempt = 0
+        while piece[0] + piece[2] < piece[1]:
+            with open(path, "r+b") as f:
+                f.seek(piece[0] + piece[2])
+
+                def _on_response(response: aiohttp.ClientResponse):
+                    if response.status != 206:
+                        raise ValueError(f"Server ignored the Range request for {url} (HTTP {response.status})")
+
+                    def _write(chunk: bytes):
+                        chunk = chunk[:piece[1] - piece[0] - piece[2]]
+                        f.write(chunk)
+                        piece[2] += len(chunk)
+                    return _write
+
+                try:
+                    await self.client.stream(url, _on_response,
+                                             headers={"Range": f"bytes={piece[0] + piece[2]}-{piece[1] - 1}"})
+                except _RESUMABLE_ERRORS:
+                    if attempt >= config.retry_times:
+                        raise
+            if piece[0] + piece[2] >= piece[1]:
+                return
+            # 传输中断或响应提前结束（短读）：都计入重试次数并退避后从断点继续
+            if attempt >= config.retry_times:
+                raise aiohttp.ClientPayloadError(f"Response for {url} ended at byte {piece[0] + piece[2]}, "
+                                                 f"expected {piece[1]}")
+            await asyncio.sleep(retryDelay(attempt))
+            attempt += 1
+
+    async def download_async(self, url: str, path: Path, expected_size: Optional[int] = None) -> int:
+        """
+        下载到 path 并返回文件大小
+
+        失败时保留已写入的部分和控制文件，再次调用从断点继续；
+        最终大小与 expected_size 不符时删除文件并抛出 ValueError
+        """
+        path.parent.mkdir(parents=True, exist_ok=True)
+        state = self._load_state(path)
+        if state is None:
+            state = await self._probe(url, path)
+        unfinished = [_p for _p in state["pieces"] if _p[0] + _p[2] < _p[1]]
+        if unfinished:
+            self._save_state(path, state)
+            tasks = [asyncio.ensure_future(self._fetch_piece(url, path, _p)) for _p in unfinished]
+            try:
+                await asyncio.gather(*tasks)
+            finally:
+                for _task in tasks:
+                    _task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                # 记录各段已写入的位置
+                self._save_state(path, state)
+
+        if expected_size is not None and state["size"] != expected_size:
+            path.unlink(missing_ok=True)
+            controlPath(path).unlink(missing_ok=True)
+            raise ValueError(f"Downloaded {state['size']} bytes for {path.name}, expected {expected_size}")
+        controlPath(path).unlink(missing_ok=True)
+        return state["size"]
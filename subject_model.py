@@ -0,0 +1,137 @@
+"""
+邮件主题解析
+
+- MAIN_RE / VER_RE: 图纸邮件主题与版本号的正则
+- subjectDrawings(): 主题中出现的全部图号（一封邮件可能同时列出多个图号）
+- ParsedSubject: 主题解析结果（__slots__），同时预先计算版本排序键和邮件质量
+- parseSubject(): 按主题字符串缓存，同一主题只做一次正则匹配
+"""
+import re
+from functools import lru_cache
+from typing import Iterable, Optional, Tuple, TypeVar
+
+MAIN_RE = re.compile(
+    r'^[ \t]*'                                        # 行首半角空白
+    r'(?:.*?\((?P<wf>[A-Za-z]+-\d+)\)[ \t]*)?'        # 可选：(WF-001039)——前后可有任意文字
+    r'.*?'                                            # 仍可再出现任意前缀（“通知：回复: 最终 ”等）
+    r'SLDS-BCEG-'                                     # 固定文件名前缀
+    r'(?P<unit>\d{3})-'                               # 单体
+    r'(?:(?P<step>\d{4})-)?'                          # 支持新增的四位新施工阶段代码（可选）
+    r'SDS-'
+    r'(?P<discipline>[A-Z]+)-'                        # 专业
+    r'(?P<drawing>[A-Z0-9]+)'                         # 图纸号
+    r'(?:_*(?P<ver>[A-Z]|\d+\+[A-Z]|\d+[A-Z]|\d+))?'  # 版本号（可选）
+    r'(?:[ \t]+(?P<title>.+))?'                       # 图名（可选）
+    r'[ \t]*$'                                        # 行尾半角空白
+)
+
+# 主题中任意位置的图号（含可选版本号），与 MAIN_RE 中对应部分相同
+DRAWING_RE = re.compile(
+    r'SLDS-BCEG-(?P<unit>\d{3})-(?:(?P<step>\d{4})-)?SDS-(?P<discipline>[A-Z]+)-(?P<drawing>[A-Z0-9]+)'
+    r'(?:_*(?P<ver>[A-Z]|\d+\+[A-Z]|\d+[A-Z]|\d+))?'
+)
+
+VER_RE = re.compile(r'^(?:(?P<num>\d+)(?:\+(?P<plus_letter>[A-Z])|(?P<letter>[A-Z])?)'
+                    r'|(?P<pure_letter>[A-Z]))$')
+
+T = TypeVar("T")
+
+
+def subjectDrawings(subject: str) -> list[Tuple[str, Optional[str], str, str, Optional[str]]]:
+    """主题中出现的全部图号 (unit, step, discipline, drawing, ver)，按出现顺序去重"""
+    return list(dict.fromkeys(_m.group("unit", "step", "discipline", "drawing", "ver")
+                              for _m in DRAWING_RE.finditer(subject)))
+
+
+@lru_cache(maxsize=4096)
+def verSortKey(ver: str) -> tuple[int, int, int]:
+    """
+    版本号排序键，越小越新。
+
+    新优先级（同数字情况下）：
+        1) 数字+字母   例：12A
+        2) 纯数字       例：12
+        3) 数字+‘+字母’ 例：12+A
+        4) 纯字母       例：A
+        5) 异常 / 无版本
+    """
+    _m = VER_RE.match(ver) if ver else None
+    if not _m:
+        return 0, 4, 0  # 异常值，永远最后
+
+    # ── 分类后再组合排序键 ──
+    # 第一位：数字降序（取负）
+    # 第二位：档位码（越小优先）
+    # 第三位：字母逆序（Z→A），无字母时置 0
+    num_rank = -int(_m.group('num')) if _m.group('num') else 0
+
+    if _m.group('letter'):                # 数字+字母 —— 档位 0（最高）
+        return num_rank, 0, -ord(_m.group('letter'))
+    if _m.group('num') and not any((_m.group('plus_letter'),
+                                    _m.group('letter'),
+                                    _m.group('pure_letter'))):  # 纯数字 —— 档位 1
+        return num_rank, 1, 0
+    if _m.group('plus_letter'):           # 数字+‘+字母’ —— 档位 2
+        return num_rank, 2, -ord(_m.group('plus_letter'))
+    if _m.group('pure_letter'):           # 纯字母 —— 档位 3
+        return 0, 3, -ord(_m.group('pure_letter'))
+
+    return 0, 4, 0        # 理论兜底，不会触发
+
+
+def mailQuality(subj: str) -> int:
+    """邮件质量：2 = 最终审核结果 (最终 + WF)，1 = 工作流邮件，0 = 其他"""
+    if '(WF-' in subj and subj.startswith('最终'):
+        return 2
+    elif '(WF-' in subj:
+        return 1
+    return 0
+
+
+class ParsedSubject:
+    """MAIN_RE 的匹配结果；实例按主题缓存共享，视为只读"""
+
+    __slots__ = ("wf", "unit", "step", "discipline", "drawing", "ver", "title", "ver_key", "quality")
+
+    def __init__(self, subject: str, groups: dict[str, Optional[str]]):
+        self.wf = groups["wf"]
+        self.unit = groups["unit"]
+        self.step = groups["step"]
+        self.discipline = groups["discipline"]
+        self.drawing = groups["drawing"]
+        self.ver = groups["ver"]
+        self.title = groups["title"]
+        self.ver_key = verSortKey(self.ver or '')
+        self.quality = mailQuality(subject)
+
+    @property
+    def key(self) -> Tuple[str, str, str, str, str]:
+        """filter_mails 的聚合键：(unit, discipline, drawing, ver, step)"""
+        return self.unit, self.discipline, self.drawing, self.ver or '', self.step or ''
+
+    def groupdict(self) -> dict[str, Optional[str]]:
+        """与 MAIN_RE.match(...).groupdict() 相同的字典"""
+        return {"wf": self.wf, "unit": self.unit, "step": self.step, "discipline": self.discipline,
+                "drawing": self.drawing, "ver": self.ver, "title": self.title}
+
+    def __repr__(self):
+        return f"ParsedSubject({self.groupdict()!r})"
+
+
+@lru_cache(maxsize=65536)
+def parseSubject(subject: str) -> Optional[ParsedSubject]:
+    """解析邮件主题；不满足 MAIN_RE 时返回 None"""
+    mo = MAIN_RE.match(subject)
+    return ParsedSubject(subject, mo.groupdict()) if mo else None
+
+
+def _verKeyOf(mail) -> tuple[int, int, int]:
+    return mail.parsed.ver_key if mail.parsed else (0, 4, 0)
+
+
+def selectBestMail(mails: Iterable[T]) -> Optional[T]:
+    """
+    最新版本的邮件（与 sortMailsByVer(mails)[0] 相同，版本相同时取先出现的一封），
+    单次遍历，无需完整排序；mails 为空时返回 None
+    """
+    return min(mails, key=_verKeyOf, default=None)
@@ -0,0 +1,128 @@
+"""
+Aconex access token 管理
+
+- get_token(): double-checked locking，token 失效时只有一个线程刷新，其余线程等待后直接复用
+- 刷新成功后启动后台定时器，在 access_token_expires（过期前 config.token_refresh_margin 秒）之前
+  config.token_background_lead 秒主动刷新；token 已被其他线程换掉时不重复刷新
+- BearerAuth: 挂在 requests.Session 上统一添加 Authorization 头，401 时单次刷新并重发
+"""
+import asyncio
+import threading
+from datetime import datetime, timedelta
+from typing import Callable, Optional
+
+import requests
+
+from config import config
+
+
+class TokenManager:
+    """access token 的单点刷新与后台续期"""
+
+    def __init__(self, fetch: Callable[[], dict]):
+        self._fetch = fetch  # 请求新 token，返回 {"access_token": ..., "expires_in": ...}
+        self._lock = threading.Lock()
+        self._timer: Optional[threading.Timer] = None
+
+    @staticmethod
+    def valid() -> bool:
+        return bool(config.access_token and config.access_token_expires
+                    and datetime.now() < config.access_token_expires)
+
+    def get_token(self) -> str:
+        """返回有效的 token，必要时（仅一个线程）同步刷新"""
+        if not self.valid():
+            with self._lock:
+                if not self.valid():
+                    self._refresh_locked()
+        return config.access_token
+
+    async def get_token_async(self) -> str:
+        """异步版本：需要刷新时放到工作线程，避免阻塞事件循环"""
+        if self.valid():
+            return config.access_token
+        return await asyncio.to_thread(self.get_token)
+
+    def refresh(self, stale_token: Optional[str] = None) -> Optional[dict]:
+        """
+        强制刷新 token；stale_token 不为空时，若当前 token 已不是它（其他线程已刷新）则直接返回
+        """
+        with self._lock:
+            if stale_token is not None and config.access_token != stale_token and self.valid():
+                return None
+            return self._refresh_locked()
+
+    def _refresh_locked(self) -> dict:
+        print("Refreshing access token...")
+        data = self._fetch()
+        config.access_token = data.get("access_token")
+        config.access_token_expires = datetime.now() + timedelta(
+            seconds=data.get("expires_in") - config.token_refresh_margin)
+        self._schedule()
+        return data
+
+    @staticmethod
+    def _remaining() -> float:
+        """距离 access_token_expires 的秒数"""
+        return (config.access_token_expires - datetime.now()).total_seconds()
+
+    def _schedule(self):
+        """在 access_token_expires 之前 token_background_lead 秒后台刷新，赶在请求发现 token 失效之前"""
+        if self._timer is not None:
+            self._timer.cancel()
+        delay = max(self._remaining() - config.token_background_lead, 0)
+        self._timer = threading.Timer(delay, self._background_refresh, args=(config.access_token,))
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _background_refresh(self, scheduled_token: str):
+        try:
+            with self._lock:
+                # 定时器已被取消但仍触发：token 已被其他线程刷新（并已重新定时），不重复刷新
+                if config.access_token != scheduled_token:
+                    return
+                # 时钟偏差导致提前触发：token 离刷新时间还远，重新定时
+                if self.valid() and self._remaining() > config.token_background_lead:
+                    self._schedule()
+                    return
+                self._refresh_locked()
+        except Exception as e:  # 失败时由下一次 get_token() 同步重试
+            print(f"Background token refresh failed: {e!r}")
+
+    def authorization_header(self) -> dict[str, str]:
+        return {"Authorization": f"Bearer {self.get_token()}"}
+
+
+def needs_bearer(url: str) -> bool:
+    """只有资源 API 需要 Bearer token（认证接口使用 Basic）"""
+    return str(url).startswith(config.resource_url)
+
+
+class BearerAuth(requests.auth.AuthBase):
+    """requests 会话级认证：自动添加 Bearer token，401 时刷新一次并重发"""
+
+    def __init__(self, manager: TokenManager):
+        self.manager = manager
+
+    def __call__(self, r: requests.PreparedRequest) -> requests.PreparedRequest:
+        if needs_bearer(r.url):
+            r.headers["Authorization"] = f"Bearer {self.manager.get_token()}"
+            r.register_hook("response", self.handle_401)
+        return r
+
+    def handle_401(self, r: requests.Response, **kwargs) -> requests.Response:
+        if r.status_code != 401 or getattr(r.request, "_token_retried", False):
+            return r
+        stale = r.request.headers.get("Authorization", "").removeprefix("Bearer ")
+        self.manager.refresh(stale_token=stale)
+
+        # 释放连接后用新 token 重发（与 requests.auth.HTTPDigestAuth.handle_401 相同的方式）
+        r.content
+        r.close()
+        prep = r.request.copy()
+        prep._token_retried = True
+        prep.headers["Authorization"] = f"Bearer {self.manager.get_token()}"
+        _r = r.connection.send(prep, **kwargs)
+        _r.history.append(r)
+        _r.request = prep
+        return _r
@@ -2,6 +2,7 @@
 
 import openpyxl
 from main import MAIN_RE, searchMail, requestToken, searchWorkflow, clean_str
+from subject_model import parseSubject
 from dataclass import patternInfo
 
 if __name__ == '__main__':
@@ -26,7 +27,7 @@ if __name__ == '__main__':
         ), "ALL")
 
         if mailResponse:
-            matched_new = MAIN_RE.match(clean_str(mailResponse[0].subject)).groupdict()
+            matched_new = parseSubject(clean_str(mailResponse[0].subject)).groupdict()
             print(matched_new)
             row[2].value = rf"SLDS-BCEG-{matched_new['unit']}-SDS-{matched_new['discipline']}-{matched_new['drawing']}"    # 图纸编号
             row[3].value = matched_new['title']    # 图纸名称
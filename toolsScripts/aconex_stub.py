@@ -0,0 +1,338 @@
+"""
+本地 Aconex 替身服务器，用于基准测试和离线调试（不访问生产环境）
+
+支持的接口（与 main.py / document_API.py / main_download_attachments.py 使用的接口一致）：
+- POST /auth/token
+- GET  /api/projects/{project}/mail                       邮件搜索，支持 search_type=PAGED 分页、OR 批量查询、sentdate 下界
+- GET  /api/projects/{project}/mail/{mail_id}             邮件详情
+- GET  /api/projects/{project}/mail/{mail_id}/attachments/{attachment_id}   附件下载，支持 Range
+- GET  /api/projects/{project}/workflows/search           工作流查询
+- GET  /api/projects/{project}/register                   文档注册表，分页
+- GET  /__stats                                           服务端统计（JSON）
+
+数据默认按图号 / 工作流编号确定性地合成；--replay 目录中存在录制的 XML 时优先回放：
+    mail_search.xml       录制的邮件搜索结果，按查询条件过滤后重新分页
+    register.xml          录制的注册表结果，重新分页
+    mail/<mail_id>.xml    录制的邮件详情
+    workflows/<num>.xml   录制的工作流查询结果
+
+用法：
+    python toolsScripts/aconex_stub.py --port 8765 --latency 0.05 --jitter 0.02 --throttle-rate 0.01 --error-rate 0.005
+"""
+import argparse
+import json
+import os
+import random
+import re
+import threading
+import time
+import xml.etree.ElementTree as ET
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import parse_qs, urlsplit
+from xml.sax.saxutils import escape
+
+SUBJECT_RE = re.compile(r'subject:\(([^()]*)\)(?:\s+AND\s+sentdate:\[(\d{8}) TO \*\])?')
+VERSIONS = ["A", "B", "C", "0", "1", "2"]
+BASE_DATE = datetime(2025, 1, 1, 8, 0, 0)
+
+
+# ---------------- 合成数据 ----------------
+def _seed(*parts: str) -> int:
+    return sum((i + 1) * ord(c) for i, c in enumerate("|".join(p or "" for p in parts)))
+
+
+def synthetic_mails(unit: str, step: Optional[str], discipline: str, drawing: str) -> list[tuple[int, str, datetime]]:
+    """某个图号的全部邮件 (mail_id, subject, sent_date)：每个版本一封提交邮件 + 一封最终审核邮件"""
+    seed = _seed(unit, step, discipline, drawing)
+    base = f"SLDS-BCEG-{unit}-{step + '-' if step else ''}SDS-{discipline}-{drawing}"
+    workflow = f"WF-{seed % 1000000:06d}"
+    mails = []
+    for i, ver in enumerate(VERSIONS[:seed % 4 + 1]):
+        mail_id = seed * 100 + i * 2
+        sent = BASE_DATE + timedelta(days=30 * i + seed % 9)
+        mails.append((mail_id, f"({workflow}) {base}_{ver} 图名{drawing}", sent))
+        mails.append((mail_id + 1, f"最终 ({workflow}) {base}_{ver} 图名{drawing}", sent + timedelta(days=7)))
+    return mails
+
+
+def _user(name: str) -> str:
+    return (f"<OrganizationId>1</OrganizationId><OrganizationName>ORG {name}</OrganizationName>"
+            f"<Name>User {name}</Name><UserId>{_seed(name) % 1000}</UserId>")
+
+
+def synthetic_workflows(workflow_number: str) -> str:
+    """工作流编号尾数为奇数时仍在审核中，否则最终步骤已完成"""
+    in_progress = workflow_number[-1:] in "13579"
+    outcome = "正等待处理" if in_progress else "1-通过"
+    completed = "" if in_progress else "<DateCompleted>2025-01-02T00:00:00.000Z</DateCompleted>"
+    step = "审核" if in_progress else "最终"
+    workflow = (f'<Workflow WorkflowId="{_seed(workflow_number)}"><StepName>{step}</StepName>'
+                f'<StepOutcome>{outcome}</StepOutcome><StepStatus>{"进行中" if in_progress else "已完成"}</StepStatus>'
+                f'<DateIn>2025-01-01T00:00:00.000Z</DateIn>{completed}<DateDue>2025-01-03T00:00:00.000Z</DateDue>'
+                f'<DaysLate>0</DaysLate><Duration>1.0</Duration><DocumentNumber>{workflow_number}</DocumentNumber>'
+                f'<DocumentRevision>A</DocumentRevision><DocumentTitle>T</DocumentTitle>'
+                f'<DocumentVersion>1</DocumentVersion><FileName>f.pdf</FileName><FileSize>10</FileSize>'
+                f'<Assignees><Assignee>{_user("A")}</Assignee></Assignees><Initiator>{_user("I")}</Initiator>'
+                f'</Workflow>')
+    return (f'<WorkflowSearch CurrentPage="1" PageSize="25" TotalPages="1" TotalResults="1" TotalResultsOnPage="1">'
+            f'<SearchResults>{workflow}</SearchResults></WorkflowSearch>')
+
+
+def synthetic_documents(total: int) -> list[str]:
+    """按 DateModified 降序（与 sort_field=revisiondate DESC 一致）；增大 total 相当于在最前面新增文档"""
+    return [f'<Document DocumentId="d{i}"><Title>T{i}</Title><Revision>A</Revision>'
+            f'<DocumentNumber>N{i}</DocumentNumber><DocumentStatus>有效</DocumentStatus>'
+            f'<DateModified>{(BASE_DATE + timedelta(hours=i)).isoformat()}.000Z</DateModified>'
+            f'<Discipline>{"ASMIE"[i % 5]}</Discipline></Document>' for i in reversed(range(total))]
+
+
+def attachment_bytes(attachment_id: str, size: int) -> bytes:
+    return (attachment_id.encode() * (size // max(len(attachment_id), 1) + 1))[:size]
+
+
+def synthetic_mail_detail(mail_id: str, attachments: int, attachment_size: int) -> str:
+    files = "".join(f'<RegisteredDocumentAttachment attachmentId="{mail_id}-{i}"><DocumentNo>N{mail_id}-{i}</DocumentNo>'
+                    f'<FileName>{mail_id}-{i}.pdf</FileName><FileSize>{attachment_size}</FileSize><Title>T</Title>'
+                    f'<Revision>A</Revision><DocumentId>d{mail_id}-{i}</DocumentId></RegisteredDocumentAttachment>'
+                    for i in range(attachments))
+    return (f'<Mail MailId="{mail_id}"><Subject>S{mail_id}</Subject><SentDate>2025-01-01T00:00:00.000Z</SentDate>'
+            f'<MailData>&lt;p&gt;mail {mail_id}&lt;/p&gt;</MailData>'
+            f'<FromUserDetails><Name>From</Name><OrganizationName>ORG</OrganizationName></FromUserDetails>'
+            f'<ToUsers><Recipient><Name>To</Name><OrganizationName>ORG</OrganizationName></Recipient></ToUsers>'
+            f'<Attachments>{files}</Attachments></Mail>')
+
+
+# ---------------- 服务器 ----------------
+class StubState:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.lock = threading.Lock()
+        self.active = 0
+        self.stats: dict[str, int] = {"requests": 0, "throttled": 0, "errors": 0}
+        self.by_endpoint: dict[str, int] = {}
+        self.replay_mails: Optional[list[tuple[int, str, datetime, str]]] = None
+        self.replay_documents: Optional[list[str]] = None
+        if args.replay:
+            self._load_replay(args.replay)
+        self.documents = self.replay_documents or synthetic_documents(args.register_size)
+
+    def _load_replay(self, directory: str):
+        path = os.path.join(directory, "mail_search.xml")
+        if os.path.isfile(path):
+            self.replay_mails = [(int(m.attrib["MailId"]), m.findtext("Subject"),
+                                  datetime.fromisoformat(m.findtext("SentDate").rstrip("Z")),
+                                  ET.tostring(m, encoding="unicode"))
+                                 for m in ET.parse(path).getroot().iter("Mail")]
+        path = os.path.join(directory, "register.xml")
+        if os.path.isfile(path):
+            self.replay_documents = [ET.tostring(d, encoding="unicode") for d in ET.parse(path).getroot().iter("Document")]
+
+    def replay_file(self, *parts: str) -> Optional[bytes]:
+        if not self.args.replay:
+            return None
+        path = os.path.join(self.args.replay, *parts)
+        if not os.path.isfile(path):
+            return None
+        with open(path, "rb") as f:
+            return f.read()
+
+    def fault(self) -> Optional[int]:
+        """按配置注入 429 / 5xx"""
+        with self.lock:
+            if self.args.max_concurrency and self.active > self.args.max_concurrency:
+                return 429
+            roll = self.random.random()
+        if roll < self.args.throttle_rate:
+            return 429
+        if roll < self.args.throttle_rate + self.args.error_rate:
+            return self.random.choice((500, 502, 504))
+        return None
+
+    def delay(self):
+        latency = self.args.latency + self.random.uniform(-self.args.jitter, self.args.jitter)
+        if latency > 0:
+            time.sleep(latency)
+
+    def count(self, endpoint: str, key: str = "requests"):
+        with self.lock:
+            self.stats[key] += 1
+            if key == "requests":
+                self.by_endpoint[endpoint] = self.by_endpoint.get(endpoint, 0) + 1
+
+
+def _paginate(items: list, query: dict[str, str], default_size: int) -> tuple[list, dict[str, int]]:
+    if query.get("search_type") == "PAGED" or "page_number" in query:
+        page_size = int(query.get("page_size", default_size))
+    else:
+        page_size = max(len(items), 1)
+    page_number = int(query.get("page_number", 1))
+    page = items[(page_number - 1) * page_size:page_number * page_size]
+    return page, {"CurrentPage": page_number, "PageSize": page_size,
+                  "TotalPages": max(1, -(-len(items) // page_size)), "TotalResults": len(items),
+                  "TotalResultsOnPage": len(page)}
+
+
+def _attrs(info: dict[str, int]) -> str:
+    return " ".join(f'{k}="{v}"' for k, v in info.items())
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state: StubState
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status: int, body: bytes, content_type: str = "application/xml; charset=utf-8",
+              headers: Optional[dict[str, str]] = None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self, endpoint: str, handler):
+        state = self.state
+        with state.lock:
+            state.active += 1
+        try:
+            state.count(endpoint)
+            status = state.fault()
+            if status == 429:
+                state.count(endpoint, "throttled")
+                return self._send(429, b"Too Many Requests", "text/plain",
+                                  {"Retry-After": str(state.args.retry_after)} if state.args.retry_after else None)
+            state.delay()
+            if status is not None:
+                state.count(endpoint, "errors")
+                return self._send(status, b"Server Error", "text/plain")
+            handler()
+        finally:
+            with state.lock:
+                state.active -= 1
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if urlsplit(self.path).path.endswith("/auth/token"):
+            body = json.dumps({"access_token": f"stub-{time.time():.0f}", "expires_in": 3600}).encode()
+            return self._handle("auth", lambda: self._send(200, body, "application/json"))
+        self._send(404, b"Not Found", "text/plain")
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        path = url.path
+        if path == "/__stats":
+            with self.state.lock:
+                body = json.dumps({**self.state.stats, "by_endpoint": self.state.by_endpoint}).encode()
+            return self._send(200, body, "application/json")
+        if path.endswith("/mail"):
+            return self._handle("mail_search", lambda: self.mail_search(query))
+        if path.endswith("/workflows/search"):
+            return self._handle("workflows", lambda: self.workflows(query))
+        if path.endswith("/register"):
+            return self._handle("register", lambda: self.register(query))
+        m = re.search(r"/mail/(\d+)/attachments/([^/]+)$", path)
+        if m:
+            return self._handle("attachment", lambda: self.attachment(m.group(2)))
+        m = re.search(r"/mail/(\d+)$", path)
+        if m:
+            return self._handle("mail_detail", lambda: self.mail_detail(m.group(1)))
+        self._send(404, b"Not Found", "text/plain")
+
+    # ---------------- 接口实现 ----------------
+    def _matching_mails(self, search_query: str) -> list[tuple[int, str, datetime, Optional[str]]]:
+        mails: dict[int, tuple[int, str, datetime, Optional[str]]] = {}
+        for subject_cond, sent_after in SUBJECT_RE.findall(search_query):
+            tokens = [t.strip().rstrip("*") for t in subject_cond.split(" AND ")]
+            lower = datetime.strptime(sent_after, "%Y%m%d") if sent_after else None
+            if self.state.replay_mails is not None:
+                found = [m for m in self.state.replay_mails if all(t in m[1] for t in tokens)]
+            elif len(tokens) >= 3:
+                step = tokens[2] if len(tokens) == 4 else None
+                found = [(*m, None) for m in synthetic_mails(tokens[0], step, tokens[1], tokens[-1])]
+            else:
+                found = []
+            for mail in found:
+                if lower is None or mail[2] >= lower:
+                    mails[mail[0]] = mail
+        return list(mails.values())
+
+    def mail_search(self, query: dict[str, str]):
+        mails = self._matching_mails(query.get("search_query", ""))
+        # SENTBOX / INBOX 按 mail_id 奇偶拆分
+        sent = query.get("mail_box") == "SENTBOX"
+        mails = [m for m in mails if (m[0] % 2 == 0) == sent]
+        mails.sort(key=lambda m: m[2], reverse=query.get("sort_direction", "DESC") == "DESC")
+        page, info = _paginate(mails, query, 25)
+        records = "".join(raw or (f'<Mail MailId="{mail_id}"><MailNo>M{mail_id}</MailNo>'
+                                  f'<SentDate>{sent_date.isoformat()}.000Z</SentDate>'
+                                  f'<Subject>{escape(subject)}</Subject><AllAttachmentCount>1</AllAttachmentCount></Mail>')
+                          for mail_id, subject, sent_date, raw in page)
+        self._send(200, f'<MailSearch {_attrs(info)}><SearchResults>{records}</SearchResults></MailSearch>'.encode())
+
+    def workflows(self, query: dict[str, str]):
+        number = query.get("workflow_number", "")
+        body = self.state.replay_file("workflows", f"{number}.xml") or synthetic_workflows(number).encode()
+        self._send(200, body)
+
+    def register(self, query: dict[str, str]):
+        page, info = _paginate(self.state.documents, query, 25)
+        self._send(200, f'<RegisterSearch {_attrs(info)}><SearchResults>{"".join(page)}</SearchResults>'
+                        f'</RegisterSearch>'.encode())
+
+    def mail_detail(self, mail_id: str):
+        args = self.state.args
+        body = (self.state.replay_file("mail", f"{mail_id}.xml")
+                or synthetic_mail_detail(mail_id, args.attachments, args.attachment_size).encode())
+        self._send(200, body)
+
+    def attachment(self, attachment_id: str):
+        data = attachment_bytes(attachment_id, self.state.args.attachment_size)
+        m = re.match(r"bytes=(\d+)-(\d*)$", self.headers.get("Range", ""))
+        if not m:
+            return self._send(200, data, "application/octet-stream", {"Accept-Ranges": "bytes"})
+        start = int(m.group(1))
+        end = min(int(m.group(2)) if m.group(2) else len(data) - 1, len(data) - 1)
+        self._send(206, data[start:end + 1], "application/octet-stream",
+                   {"Accept-Ranges": "bytes", "Content-Range": f"bytes {start}-{end}/{len(data)}"})
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="本地 Aconex 替身服务器")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.05, help="每个请求的平均延迟（秒）")
+    parser.add_argument("--jitter", type=float, default=0.0, help="延迟的随机抖动范围（秒）")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="随机返回 429 的比例")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="随机返回 500/502/504 的比例")
+    parser.add_argument("--max-concurrency", type=int, default=0, help="同时处理的请求超过该值时返回 429，0 表示不限")
+    parser.add_argument("--retry-after", type=int, default=0, help="429 响应的 Retry-After 秒数，0 表示不返回该头")
+    parser.add_argument("--register-size", type=int, default=500, help="合成注册表的文档数")
+    parser.add_argument("--attachments", type=int, default=2, help="合成邮件详情的附件数")
+    parser.add_argument("--attachment-size", type=int, default=64 * 1024, help="合成附件大小（字节）")
+    parser.add_argument("--replay", default=None, help="录制 XML 的目录")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser
+
+
+def serve(args: argparse.Namespace) -> ThreadingHTTPServer:
+    handler = type("Handler", (StubHandler,), {"state": StubState(args)})
+    server = ThreadingHTTPServer((args.host, args.port), handler)
+    server.daemon_threads = True
+    return server
+
+
+if __name__ == '__main__':
+    _args = build_parser().parse_args()
+    _server = serve(_args)
+    print(f"Aconex stub listening on http://{_args.host}:{_server.server_address[1]}", flush=True)
+    try:
+        _server.serve_forever()
+    except KeyboardInterrupt:
+        pass
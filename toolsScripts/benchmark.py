@@ -0,0 +1,172 @@
+"""
+端到端吞吐基准：生成 N 行的图纸跟踪表，启动本地 Aconex 替身服务器（aconex_stub.py），
+运行 main.py 的完整流程（processTracker），报告 rows/s、requests/s、请求延迟 p50/p95 和峰值内存。
+
+用法：
+    python toolsScripts/benchmark.py --rows 2000 --sheets 2 --latency 0.05 --json bench.json
+    python toolsScripts/benchmark.py --rows 2000 --baseline bench.json     # 与上次结果对比
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from typing import Optional
+
+import openpyxl
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from config import config  # noqa: E402
+
+STUB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "aconex_stub.py")
+DISCIPLINES = ["A", "S", "M", "E", "P", "I"]
+SHEET_NAMES = ["建筑", "结构", "暖通", "电气", "给排水", "智能化"]
+HEADERS = ["序号", "图纸编号", "图纸名称", "备注", "版本号", "发图日期", "审批结果", "工作流编号", "邮件ID"]
+
+
+def make_tracker(path: str, rows: int, sheets: int):
+    """生成与实际跟踪表结构相同的工作簿：汇总表 + 每个专业一个子表"""
+    wb = openpyxl.Workbook()
+    summary = wb.active
+    summary.title = "汇总"
+    summary.append(["序号", "子表", "总数", "已完成", "未完成"])
+    for s in range(sheets):
+        name = SHEET_NAMES[s % len(SHEET_NAMES)] + ("" if s < len(SHEET_NAMES) else str(s))
+        discipline = DISCIPLINES[s % len(DISCIPLINES)]
+        summary.append([s + 1, name, 0, 0, 0])
+        ws = wb.create_sheet(name)
+        ws.append(HEADERS)
+        for i in range(1, rows + 1):
+            unit = f"{i // 500 + 1:03d}"
+            step = "0405-" if i % 5 == 0 else ""
+            ws.append([i, f"SLDS-BCEG-{unit}-{step}SDS-{discipline}-{discipline}{i:03d}", f"图名{i}"])
+    wb.save(path)
+
+
+def start_stub(args: argparse.Namespace) -> tuple[subprocess.Popen, str]:
+    cmd = [sys.executable, STUB_PATH, "--port", "0", "--latency", str(args.latency), "--jitter", str(args.jitter),
+           "--throttle-rate", str(args.throttle_rate), "--error-rate", str(args.error_rate),
+           "--max-concurrency", str(args.max_concurrency)]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True)
+    line = proc.stdout.readline()
+    if not line:
+        proc.kill()
+        raise RuntimeError("stub server failed to start")
+    return proc, line.strip().rsplit(" ", 1)[-1]
+
+
+def peak_rss_mb() -> Optional[float]:
+    try:
+        import resource
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss / 1024 / 1024 if sys.platform == "darwin" else rss / 1024  # macOS 单位为字节，Linux 为 KB
+    except ImportError:  # Windows
+        try:
+            import psutil
+            return psutil.Process().memory_info().peak_wset / 1024 / 1024
+        except (ImportError, AttributeError):
+            return None
+
+
+def percentile(values: list[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+def run_benchmark(args: argparse.Namespace) -> dict:
+    workdir = args.workdir or tempfile.mkdtemp(prefix="aconex-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    tracker = os.path.join(workdir, "tracker.xlsx")
+    make_tracker(tracker, args.rows, args.sheets)
+
+    stub, base_url = start_stub(args)
+    try:
+        # main 在导入时按 config 创建客户端和缓存，需先完成配置
+        config.lobby_url = config.resource_url = base_url
+        config.proxies = None
+        config.retry_delay = args.retry_delay
+        config.cache_db_path = os.path.join(workdir, "cache.sqlite3")
+        config.metrics_dir = None  # 不在当前目录写出指标文件，结果见基准报告
+        config.mail_cache_bypass = config.workflow_cache_bypass = not args.warm_cache
+        config.low_memory = args.low_memory
+        import main
+
+        latencies: list[float] = []
+        main.LIMITER.observers.append(lambda latency, status: latencies.append(latency))
+
+        start = time.perf_counter()
+        main.requestToken()
+        main.processTracker(tracker, tracker)
+        elapsed = time.perf_counter() - start
+
+        with urllib.request.urlopen(f"{base_url}/__stats") as response:
+            server_stats = json.load(response)
+    finally:
+        stub.terminate()
+        stub.wait()
+
+    rows = sum(_r.total for _r in main.REQUEST_DATA.values())
+    p50, p95 = percentile(latencies, 0.5), percentile(latencies, 0.95)
+    rss = peak_rss_mb()
+    return {
+        "rows": rows,
+        "seconds": round(elapsed, 3),
+        "rows_per_s": round(rows / elapsed, 2),
+        "requests": len(latencies),
+        "requests_per_s": round(len(latencies) / elapsed, 2),
+        "latency_p50_ms": round(p50 * 1000, 1) if p50 is not None else None,
+        "latency_p95_ms": round(p95 * 1000, 1) if p95 is not None else None,
+        "peak_rss_mb": round(rss, 1) if rss is not None else None,
+        "settled_concurrency": main.LIMITER.settled(),
+        "server": server_stats,
+        "params": {k: v for k, v in vars(args).items() if k not in ("json", "baseline", "workdir")},
+    }
+
+
+def print_report(result: dict, baseline: Optional[dict] = None):
+    keys = ["rows", "seconds", "rows_per_s", "requests", "requests_per_s", "latency_p50_ms", "latency_p95_ms",
+            "peak_rss_mb", "settled_concurrency"]
+    for key in keys:
+        line = f"{key:>20}: {result[key]}"
+        if baseline and isinstance(baseline.get(key), (int, float)) and baseline[key] and result[key] is not None:
+            line += f"  ({(result[key] - baseline[key]) / baseline[key]:+.1%} vs baseline {baseline[key]})"
+        print(line)
+    server = result["server"]
+    print(f"{'server':>20}: {server['requests']} requests, {server['throttled']} throttled, "
+          f"{server['errors']} errors, {server['by_endpoint']}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="main.py 端到端吞吐基准（使用本地 Aconex 替身服务器）")
+    parser.add_argument("--rows", type=int, default=1000, help="每个子表的行数")
+    parser.add_argument("--sheets", type=int, default=2, help="子表数量")
+    parser.add_argument("--latency", type=float, default=0.05, help="替身服务器的平均延迟（秒）")
+    parser.add_argument("--jitter", type=float, default=0.01)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--max-concurrency", type=int, default=0)
+    parser.add_argument("--retry-delay", type=float, default=0.1, help="覆盖 config.retry_delay")
+    parser.add_argument("--warm-cache", action="store_true", help="读取本地缓存（默认绕过缓存，只测 API 路径）")
+    parser.add_argument("--low-memory", action="store_true")
+    parser.add_argument("--workdir", default=None, help="跟踪表 / 缓存的目录，默认临时目录")
+    parser.add_argument("--json", default=None, help="把结果写入 JSON 文件，作为之后的基线")
+    parser.add_argument("--baseline", default=None, help="与之前保存的 JSON 结果对比")
+    _args = parser.parse_args()
+
+    _baseline = None
+    if _args.baseline:
+        with open(_args.baseline, encoding="utf-8") as f:
+            _baseline = json.load(f)
+
+    _result = run_benchmark(_args)
+    print_report(_result, _baseline)
+    if _args.json:
+        with open(_args.json, "w", encoding="utf-8") as f:
+            json.dump(_result, f, ensure_ascii=False, indent=2)
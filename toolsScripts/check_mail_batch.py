@@ -0,0 +1,159 @@
+"""
+批量 / 离线邮件搜索一致性检查：用 aconex_stub.py 回放一组固定邮件，以逐个图号 searchMailAsync 的在线结果为准，
+比较 searchMailBatchAsync（OR 合并查询，demuxMails 拆分）的结果，以及同步到本地仓库（mail_warehouse.py）后
+--offline 查询的结果，邮件及顺序应完全一致。
+
+固定邮件中包含容易拆错的情况：主题中同时列出多个图号、图号互为前缀、带 step 的图号、主题无法解析、
+sent_after 下界附近的邮件。
+
+用法：
+    python toolsScripts/check_mail_batch.py
+    python toolsScripts/check_mail_batch.py --replay recorded/ --drawings SLDS-BCEG-001-SDS-A-A001 SLDS-BCEG-002-SDS-S-S005
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+from datetime import datetime, timedelta
+from typing import Optional
+from xml.sax.saxutils import escape
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import aconex_stub  # noqa: E402
+from config import config  # noqa: E402
+from dataclass import patternInfo  # noqa: E402
+from subject_model import MAIN_RE  # noqa: E402
+
+BASE_DATE = datetime(2025, 3, 1, 9, 0, 0)
+
+# (主题, 距 BASE_DATE 的天数)；mail_id 按顺序分配，stub 按奇偶分到 SENTBOX / INBOX
+FIXTURE_MAILS = [
+    ("(WF-000001) SLDS-BCEG-001-SDS-A-A001_A 图名A001", 0),
+    ("最终 (WF-000001) SLDS-BCEG-001-SDS-A-A001_A 图名A001", 7),
+    ("(WF-000002) SLDS-BCEG-001-SDS-A-A001_0 图名A001", 30),
+    ("最终 (WF-000002) SLDS-BCEG-001-SDS-A-A001_0 图名A001", 37),
+    # 图号互为前缀：A0011 的邮件也含有 A001 的主题片段
+    ("(WF-000003) SLDS-BCEG-001-SDS-A-A0011_A 图名A0011", 5),
+    ("最终 (WF-000003) SLDS-BCEG-001-SDS-A-A0011_A 图名A0011", 12),
+    ("(WF-000004) SLDS-BCEG-002-SDS-S-S005_A 图名S005", 3),
+    ("最终 (WF-000004) SLDS-BCEG-002-SDS-S-S005_A 图名S005", 10),
+    # 主题中同时列出两个不同单体 / 专业的图号，解析结果只对应第一个
+    ("(WF-000005) SLDS-BCEG-001-SDS-A-A001_B / SLDS-BCEG-002-SDS-S-S005_B 合并提交", 20),
+    ("最终 (WF-000005) SLDS-BCEG-001-SDS-A-A001_B / SLDS-BCEG-002-SDS-S-S005_B 合并提交", 27),
+    ("(WF-000006) SLDS-BCEG-001-0405-SDS-A-A010_A 图名A010", 8),
+    ("最终 (WF-000006) SLDS-BCEG-001-0405-SDS-A-A010_A 图名A010", 15),
+    ("(WF-000007) SLDS-BCEG-001-SDS-A-A010_A 图名A010", 9),
+    # 主题不符合规则
+    ("转发: SLDS-BCEG-001-SDS-A-A001 图纸目录", 40),
+]
+
+# (图号, sent_after 距 BASE_DATE 的天数)
+FIXTURE_DRAWINGS = [
+    ("SLDS-BCEG-001-SDS-A-A001", None),
+    ("SLDS-BCEG-001-SDS-A-A0011", None),
+    ("SLDS-BCEG-002-SDS-S-S005", None),
+    ("SLDS-BCEG-001-0405-SDS-A-A010", None),
+    ("SLDS-BCEG-001-SDS-A-A010", None),
+    ("SLDS-BCEG-001-SDS-A-A001", 20),
+    ("SLDS-BCEG-003-SDS-M-M001", None),  # 没有邮件
+]
+
+
+def write_fixture(directory: str):
+    """把 FIXTURE_MAILS 写成 stub 回放用的 mail_search.xml"""
+    records = "".join(
+        f'<Mail MailId="{1000 + i}"><MailNo>M{1000 + i}</MailNo>'
+        f'<SentDate>{(BASE_DATE + timedelta(days=_days)).isoformat()}.000Z</SentDate>'
+        f'<Subject>{escape(_subject)}</Subject><AllAttachmentCount>1</AllAttachmentCount></Mail>'
+        for i, (_subject, _days) in enumerate(FIXTURE_MAILS))
+    with open(os.path.join(directory, "mail_search.xml"), "w", encoding="utf-8") as f:
+        f.write(f"<MailSearch><SearchResults>{records}</SearchResults></MailSearch>")
+
+
+def start_stub(replay: str) -> aconex_stub.ThreadingHTTPServer:
+    server = aconex_stub.serve(aconex_stub.build_parser().parse_args(
+        ["--port", "0", "--latency", "0", "--replay", replay]))
+    threading.Thread(target=server.serve_forever, name="aconex-stub", daemon=True).start()
+    return server
+
+
+def parse_drawing(text: str) -> patternInfo:
+    mo = MAIN_RE.match(text.strip())
+    if not mo:
+        raise ValueError(f"无法解析图号: {text}")
+    return patternInfo(unit=mo["unit"], discipline=mo["discipline"], drawing=mo["drawing"], step=mo["step"])
+
+
+async def compare(items: list[tuple[patternInfo, Optional[datetime]]], batch_size: int) -> int:
+    """返回批量或离线结果与逐个图号在线结果不一致的图号数"""
+    from main import searchMailAsync, searchMailBatchAsync
+    from mail_warehouse import syncDrawingsAsync
+
+    single = await asyncio.gather(*(searchMailAsync(_p, "ALL", sent_after=_s, early_exit=False) for _p, _s in items))
+    batched = await searchMailBatchAsync(items, "ALL", batch_size=batch_size)
+
+    await syncDrawingsAsync(list({id(_p): _p for _p, _ in items}.values()), full=True)
+    config.offline = True
+    try:
+        offline = [await searchMailAsync(_p, "ALL", sent_after=_s) for _p, _s in items]
+    finally:
+        config.offline = False
+
+    mismatches = 0
+    for (_params, _sent_after), _single, _batched, _offline in zip(items, single, batched, offline):
+        expected = [_m.mailID for _m in _single]
+        diffs = {_name: _ids for _name, _ids in (("batched", [_m.mailID for _m in _batched]),
+                                                 ("offline", [_m.mailID for _m in _offline]))
+                 if _ids != expected}
+        mismatches += bool(diffs)
+        label = f"{_params.unit}-{_params.step or ''}-{_params.discipline}-{_params.drawing}" + (
+            f" sent_after {_sent_after:%Y-%m-%d}" if _sent_after else "")
+        print(f"{'DIFF' if diffs else 'OK  '} {label}: {len(expected)} mails"
+              + "".join(f"\n     {_name + ':':<9}{_ids}" for _name, _ids in {"single": expected, **diffs}.items()
+                        if diffs))
+    return mismatches
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="比较批量与逐个图号的邮件搜索结果")
+    parser.add_argument("--replay", default=None, help="录制 XML 的目录（默认写入内置的固定邮件）")
+    parser.add_argument("--drawings", nargs="*", default=None, help="要比较的图号（默认内置的固定图号）")
+    parser.add_argument("--batch-size", type=int, default=40, help="每批合并的图号数")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="aconex-check-")
+    replay = args.replay
+    if replay is None:
+        replay = workdir
+        write_fixture(replay)
+    stub = start_stub(replay)
+
+    # main 在导入时按 config 创建客户端和缓存，需先完成配置
+    config.lobby_url = config.resource_url = f"http://127.0.0.1:{stub.server_address[1]}"
+    config.proxies = None
+    config.offline = False
+    config.cache_db_path = os.path.join(workdir, "cache.sqlite3")
+    config.warehouse_db_path = os.path.join(workdir, "mail_warehouse.sqlite3")
+    config.metrics_dir = None  # 不在当前目录写出指标文件
+    config.mail_cache_bypass = True
+    config.mail_search_early_exit = False
+    from aconex_async import run_sync
+    from main import requestToken
+
+    if args.drawings is not None:
+        drawings = [(_d, None) for _d in args.drawings]
+    else:
+        drawings = FIXTURE_DRAWINGS
+    search_items = [(parse_drawing(_d), None if _days is None else BASE_DATE + timedelta(days=_days))
+                    for _d, _days in drawings]
+
+    requestToken()
+    failed = run_sync(compare(search_items, args.batch_size))
+    stub.shutdown()
+    print(f"{len(search_items) - failed}/{len(search_items)} drawings consistent.")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,250 @@
+"""
+工作簿读写
+
+- saveWorkbookAtomic(): 先写同目录临时文件再 os.replace，保存中断不会留下损坏的目标文件
+- CheckpointSaver: 可选的中间保存；按时间间隔或完成行数触发。开始处理前复制一次完整快照，之后每个检查点
+  只把完成的行 / 收尾的 sheet 同步到快照，由后台线程序列化写盘，同一时间最多一个检查点在写，不阻塞请求处理
+- scanPendingRows() / applyPendingRows(): 低内存模式，read_only 只读扫描单元格值，行的写入先记录在 PendingRow 中，
+  之后只把改动的单元格写回完整工作簿
+"""
+import copy
+import os
+import tempfile
+import threading
+import time
+from collections.abc import Sequence
+from typing import Any, Iterable, Optional
+
+import openpyxl
+from openpyxl.cell.cell import Cell
+from openpyxl.worksheet.worksheet import Worksheet
+from openpyxl.utils.indexed_list import IndexedList
+
+
+def snapshotWorkbook(wb: openpyxl.Workbook) -> openpyxl.Workbook:
+    """
+    深拷贝工作簿
+
+    IndexedList（样式表、共享字符串）直接 deepcopy 时会先复制 _dict 再逐个 append，append 发现值已存在而跳过，
+    得到的列表为空，样式索引全部错位；这里预先正确复制后放入 memo
+    """
+    memo: dict = {}
+    for value in vars(wb).values():
+        if isinstance(value, IndexedList):
+            memo[id(value)] = IndexedList(copy.deepcopy(list(value), memo))
+    return copy.deepcopy(wb, memo)
+
+
+def saveWorkbookAtomic(wb: openpyxl.Workbook, path: str):
+    """原子保存：临时文件写完后替换目标文件"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=".~", suffix=os.path.splitext(path)[1], dir=directory)
+    os.close(fd)
+    try:
+        wb.save(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def copyCell(src: Cell, dst_ws: Worksheet):
+    """把单元格的值和样式复制到 dst_ws 的同一位置（样式索引需与 dst_ws 所在工作簿一致）"""
+    dst = dst_ws.cell(row=src.row, column=src.column)
+    dst._value = src._value
+    dst.data_type = src.data_type
+    dst._style = copy.copy(src._style)
+
+
+class CheckpointSaver:
+    """
+    write-behind 检查点：interval（秒）或 rows（完成行数）任一满足即保存一次快照；两者都为空时不做任何事
+
+    创建时（开始处理前）复制一次完整快照；rowDone(row) / sheetDone(sheet) 记录改动过的行和 sheet，
+    到期时只把这些行的单元格值和样式、以及新增的样式同步到快照，再交给后台线程写盘，
+    事件循环上的开销只与改动的单元格数有关。处理过程中只应修改单元格的值和样式。
+    rowDone() / sheetDone() / maybeSave() 必须在修改工作簿的线程上调用，close() 等待在写的检查点完成
+    """
+
+    def __init__(self, wb: openpyxl.Workbook, path: str, interval: Optional[float] = None,
+                 rows: Optional[int] = None):
+        self.wb = wb
+        self.path = path
+        self.interval = interval
+        self.rows = rows
+        self._rows_since = 0
+        self._last = time.monotonic()
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+        self.saved = 0
+        self._snapshot = snapshotWorkbook(wb) if self.enabled else None
+        self._dirty_rows: list[tuple[Cell, ...]] = []  # 上次同步后完成的行
+        self._dirty_sheets: set[str] = set()  # 上次同步后收尾的 sheet（整表同步）
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.interval or self.rows)
+
+    def rowDone(self, row: Sequence[Cell]):
+        if not self.enabled or self._closed:
+            return
+        self._dirty_rows.append(tuple(row))
+        self._rows_since += 1
+        self.maybeSave()
+
+    def sheetDone(self, sheet: Worksheet):
+        if not self.enabled or self._closed:
+            return
+        self._dirty_sheets.add(sheet.title)
+        self.maybeSave()
+
+    def maybeSave(self):
+        if not self.enabled or self._closed:
+            return
+        due = ((self.rows and self._rows_since >= self.rows)
+               or (self.interval and time.monotonic() - self._last >= self.interval))
+        if not due or (self._thread is not None and self._thread.is_alive()):
+            return  # 上一个检查点仍在写时跳过（改动继续累积），下次再触发
+        self._sync_snapshot()
+        self._rows_since = 0
+        self._last = time.monotonic()
+        self._thread = threading.Thread(target=self._save, args=(self._snapshot,), name="workbook-checkpoint",
+                                        daemon=True)
+        self._thread.start()
+
+    def _sync_snapshot(self):
+        """把改动同步到快照（只在没有检查点在写时调用）"""
+        # 样式表只追加不修改：补上新增的样式，单元格中的样式索引在两边指向相同的样式
+        for name, value in vars(self.wb).items():
+            if isinstance(value, IndexedList):
+                target = getattr(self._snapshot, name)
+                for _item in value[len(target):]:
+                    target.add(copy.deepcopy(_item))
+
+        for title in self._dirty_sheets:
+            dst_ws = self._snapshot[title]
+            for _cell in list(self.wb[title]._cells.values()):
+                if type(_cell) is Cell:
+                    copyCell(_cell, dst_ws)
+        for row in self._dirty_rows:
+            cells = [_c for _c in row if type(_c) is Cell]
+            if not cells or cells[0].parent.title in self._dirty_sheets:
+                continue
+            dst_ws = self._snapshot[cells[0].parent.title]
+            for _cell in cells:
+                copyCell(_cell, dst_ws)
+        self._dirty_rows.clear()
+        self._dirty_sheets.clear()
+
+    def _save(self, snapshot: openpyxl.Workbook):
+        start = time.monotonic()
+        try:
+            saveWorkbookAtomic(snapshot, self.path)
+        except Exception as e:  # 检查点失败不影响最终保存
+            print(f"Checkpoint save failed: {e!r}")
+            return
+        self.saved += 1
+        print(f"Checkpoint saved to '{self.path}' in {time.monotonic() - start:.2f}s.")
+
+    def close(self):
+        """停止触发新的检查点并等待在写的检查点完成（之后再做最终保存，避免旧快照覆盖）"""
+        self._closed = True
+        if self._thread is not None:
+            self._thread.join()
+
+
+class PendingCell:
+    """PendingRow 中某一列的视图，提供与 openpyxl Cell 相同的 value / fill 读写"""
+
+    __slots__ = ("_row", "_idx")
+
+    def __init__(self, row: "PendingRow", idx: int):
+        self._row = row
+        self._idx = idx
+
+    @property
+    def value(self) -> Any:
+        return self._row.get(self._idx)
+
+    @value.setter
+    def value(self, value: Any):
+        self._row.set(self._idx, value)
+
+    @property
+    def fill(self):
+        return self._row.fills.get(self._idx)
+
+    @fill.setter
+    def fill(self, fill):
+        self._row.fills[self._idx] = fill
+
+
+class PendingRow(Sequence):
+    """
+    只读扫描得到的一行（值），可像 iter_rows() 的单元格元组一样按列下标 / 切片访问；
+    写入只记录在 writes / fills 中，由 applyPendingRows() 写回
+    """
+
+    __slots__ = ("row_idx", "width", "_values", "writes", "fills")
+
+    def __init__(self, row_idx: int, values: Sequence[Any], width: int):
+        self.row_idx = row_idx  # 工作表中的行号（从 1 开始）
+        self.width = width
+        self._values = values
+        self.writes: dict[int, Any] = {}
+        self.fills: dict[int, Any] = {}
+
+    def __len__(self) -> int:
+        return self.width
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [PendingCell(self, _i) for _i in range(*index.indices(self.width))]
+        if index < 0:
+            index += self.width
+        if not 0 <= index < self.width:
+            raise IndexError(index)
+        return PendingCell(self, index)
+
+    def get(self, idx: int) -> Any:
+        if idx in self.writes:
+            return self.writes[idx]
+        return self._values[idx] if idx < len(self._values) else None
+
+    def set(self, idx: int, value: Any):
+        # 把本来为空的单元格写为空不算改动，避免第二阶段创建多余的单元格
+        if value is None and idx not in self.writes and self.get(idx) is None:
+            return
+        self.writes[idx] = value
+
+
+def scanPendingRows(path: str, skip_sheets: Iterable[str] = (), width: int = 50,
+                    key_col: int = 1) -> dict[str, list[PendingRow]]:
+    """
+    read_only + values_only 扫描每个 sheet（跳过表头），返回 {sheet 名: PendingRow 列表}；
+    key_col 列为空的行不保留
+    """
+    wb = openpyxl.load_workbook(path, read_only=True)
+    try:
+        sheets = {}
+        for ws in wb.worksheets:
+            if ws.title in skip_sheets:
+                continue
+            max_col = min(ws.max_column or width, width)
+            sheets[ws.title] = [PendingRow(_idx, _values, width)
+                                for _idx, _values in enumerate(ws.iter_rows(min_row=2, max_col=max_col,
+                                                                            values_only=True), start=2)
+                                if len(_values) > key_col and _values[key_col] is not None]
+        return sheets
+    finally:
+        wb.close()
+
+
+def applyPendingRows(sheet, rows: Iterable[PendingRow]):
+    """第二阶段：只把记录的值和填充写回完整工作簿的对应单元格"""
+    for _row in rows:
+        for _idx, _value in _row.writes.items():
+            sheet.cell(row=_row.row_idx, column=_idx + 1).value = _value
+        for _idx, _fill in _row.fills.items():
+            sheet.cell(row=_row.row_idx, column=_idx + 1).fill = _fill
@@ -0,0 +1,262 @@
+"""
+Aconex XML 响应的流式解析
+
+- 直接处理响应 bytes（或 bytes 分块），不再 decode 成 str 后 ET.fromstring 构建整棵树
+- 基于增量解析器逐个产出 dataclass，元素处理完立即清理，内存占用与单条记录相当
+- lxml 可用时优先使用，否则回退到标准库 xml.etree
+- 统一的 UTC → 东八区时间转换
+"""
+import html
+import re
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Iterable, Iterator, Optional, Tuple, TypeVar, Union
+
+try:
+    from lxml import etree as _etree
+    _LXML = True
+except ImportError:  # pragma: no cover - lxml 为可选加速
+    import xml.etree.ElementTree as _etree
+    _LXML = False
+
+from dataclass import (responseMailInfo, PageInfo, UserRef, Workflow, WorkflowSearchResult, DocumentInfo,
+                       RegisteredDocumentAttachment, Recipient, FromUserDetails, MailDetail)
+
+T = TypeVar("T")
+Source = Union[bytes, bytearray, Iterable[bytes]]
+
+TZ_CN = timezone(timedelta(hours=8))  # 东八区
+
+# parseMailDetail(include=...) 可选择解析的部分
+MAIL_DETAIL_FIELDS = frozenset({"mail_data", "from_user_details", "attachments", "recipients"})
+
+
+def parseDatetime(dt: Optional[str]) -> Optional[datetime]:
+    """
+    把 RFC-3339 / ISO-8601 字符串转为 datetime，并转换到 UTC+8。
+    - 原始 API 字段形如 '2025-08-29T08:38:39.839Z'（Z 表示 UTC）
+    - 返回值例如 2025-08-29 16:38:39.839+08:00
+    """
+    if not dt:
+        return None
+    # 将 'Z' 替换为 '+00:00'，构造成可被 fromisoformat 解析的字符串
+    return datetime.fromisoformat(dt.replace("Z", "+00:00")).astimezone(TZ_CN)
+
+
+def _chunks(source: Source) -> Iterable[bytes]:
+    return (source,) if isinstance(source, (bytes, bytearray)) else source
+
+
+def _events(source: Source) -> Iterator[Tuple[str, Any]]:
+    """增量喂入数据并产出 (event, element)"""
+    parser = _etree.XMLPullParser(events=("start", "end"))
+    for chunk in _chunks(source):
+        parser.feed(chunk)
+        yield from parser.read_events()
+    parser.close()
+    yield from parser.read_events()
+
+
+def _release(elem):
+    """释放已处理的元素；lxml 下同时删除已处理的前序兄弟节点"""
+    elem.clear()
+    if _LXML:
+        parent = elem.getparent()
+        while elem.getprevious() is not None:
+            del parent[0]
+
+
+def iterRecords(source: Source, tag: str, build: Callable[[Any], T], root_attrs: Optional[dict] = None) -> Iterator[T]:
+    """
+    逐个产出根节点下 <tag> 元素经 build() 转换后的结果
+
+    root_attrs 不为空时写入根节点属性（分页信息），在产出第一条记录前即可读取
+    """
+    root_seen = False
+    for event, elem in _events(source):
+        if event == "start":
+            if not root_seen:
+                root_seen = True
+                if root_attrs is not None:
+                    root_attrs.update(elem.attrib)
+        elif elem.tag == tag:
+            yield build(elem)
+            _release(elem)
+
+
+def pageInfo(root_attrs: dict, count: int) -> PageInfo:
+    """根节点属性 → PageInfo；非分页查询没有这些属性时按单页处理"""
+    return PageInfo(current_page=int(root_attrs.get("CurrentPage", 1)),
+                    page_size=int(root_attrs.get("PageSize", count)),
+                    total_pages=int(root_attrs.get("TotalPages", 1)),
+                    total_results=int(root_attrs.get("TotalResults", count)),
+                    total_results_on_page=int(root_attrs.get("TotalResultsOnPage", count)))
+
+
+# ---------------- mail search ----------------
+def _buildMail(elem) -> responseMailInfo:
+    return responseMailInfo(mailID=int(elem.attrib['MailId']), MailNo=elem.findtext('MailNo'),
+                            SentDate=datetime.fromisoformat(elem.findtext('SentDate').rstrip('Z')),
+                            subject=elem.findtext('Subject'),
+                            AllAttachmentCount=int(elem.findtext('AllAttachmentCount')), )
+
+
+def iterMailSearch(source: Source, root_attrs: Optional[dict] = None) -> Iterator[responseMailInfo]:
+    return iterRecords(source, "Mail", _buildMail, root_attrs)
+
+
+def parseMailSearch(source: Source) -> Tuple[PageInfo, list[responseMailInfo]]:
+    attrs: dict = {}
+    mails = list(iterMailSearch(source, attrs))
+    return pageInfo(attrs, len(mails)), mails
+
+
+# ---------------- workflow search ----------------
+def _buildUser(elem) -> UserRef:
+    """解析 <Assignee> / <Initiator> / <Reviewer>"""
+    return UserRef(organization_id=int(elem.findtext("OrganizationId")),
+                   organization_name=elem.findtext("OrganizationName").strip(), name=elem.findtext("Name").strip(),
+                   user_id=int(elem.findtext("UserId")), )
+
+
+def _buildWorkflow(elem) -> Workflow:
+    # ─ Assignees (0-N) ─
+    assignees = [_buildUser(a) for a in elem.find("Assignees").findall("Assignee")]
+
+    # ─ Initiator / Reviewer (可能缺省) ─
+    initiator = _buildUser(elem.find("Initiator"))
+    reviewer_elem = elem.find("Reviewer")
+    reviewer = _buildUser(reviewer_elem) if reviewer_elem is not None else None
+
+    return Workflow(workflow_id=int(elem.attrib["WorkflowId"]), step_name=elem.findtext("StepName").strip(),
+                    step_outcome=elem.findtext("StepOutcome").strip(),
+                    step_status=elem.findtext("StepStatus").strip(),
+
+                    date_in=parseDatetime(elem.findtext("DateIn")),
+                    date_completed=parseDatetime(elem.findtext("DateCompleted")),
+                    date_due=parseDatetime(elem.findtext("DateDue")),
+                    days_late=int(elem.findtext("DaysLate")), duration=float(elem.findtext("Duration")),
+
+                    document_number=elem.findtext("DocumentNumber").strip(),
+                    document_revision=elem.findtext("DocumentRevision").strip(),
+                    document_title=elem.findtext("DocumentTitle").strip(),
+                    document_version=int(elem.findtext("DocumentVersion")),
+                    file_name=elem.findtext("FileName").strip(),
+                    file_size=int(elem.findtext("FileSize")),
+
+                    initiator=initiator, reviewer=reviewer, assignees=assignees, )
+
+
+def iterWorkflows(source: Source, root_attrs: Optional[dict] = None) -> Iterator[Workflow]:
+    return iterRecords(source, "Workflow", _buildWorkflow, root_attrs)
+
+
+def parseWorkflowSearch(source: Source) -> WorkflowSearchResult:
+    attrs: dict = {}
+    workflows = list(iterWorkflows(source, attrs))
+    page = pageInfo(attrs, len(workflows))
+    return WorkflowSearchResult(current_page=page.current_page, page_size=page.page_size,
+                                total_pages=page.total_pages, total_results=page.total_results,
+                                total_results_on_page=page.total_results_on_page, workflows=workflows, )
+
+
+# ---------------- register ----------------
+def _buildDocument(elem) -> DocumentInfo:
+    return DocumentInfo(title=elem.findtext('Title'),
+                        revision=elem.findtext('Revision'),
+                        document_id=elem.attrib["DocumentId"],
+                        document_number=elem.findtext('DocumentNumber'),
+                        document_status=elem.findtext('DocumentStatus'),
+                        date_modified=parseDatetime(elem.findtext('DateModified')),
+                        discipline=elem.findtext('Discipline'))
+
+
+def iterDocuments(source: Source, root_attrs: Optional[dict] = None) -> Iterator[DocumentInfo]:
+    return iterRecords(source, "Document", _buildDocument, root_attrs)
+
+
+def parseRegisterPage(source: Source) -> Tuple[PageInfo, list[DocumentInfo]]:
+    """一次解析同时得到分页信息和文档列表"""
+    attrs: dict = {}
+    docs = list(iterDocuments(source, attrs))
+    return pageInfo(attrs, len(docs)), docs
+
+
+# ---------------- mail detail ----------------
+def htmlToText(raw: str) -> str:
+    """
+    使用 BeautifulSoup 把 MailData 里的富文本 HTML ➟ 纯文本。
+    - <p>、<br> 等标签自动转换为换行
+    - &lt; &gt; 实体自动解码
+    """
+    from bs4 import BeautifulSoup
+
+    if not raw:
+        return ""
+    decoded = html.unescape(raw)  # 把 &lt; 之类实体转回 <
+    soup = BeautifulSoup(decoded, "lxml")  # 速度更快；缺省回退 html.parser
+    text = soup.get_text(strip=True)  # 保留换行
+    text = re.sub(r"\s*\n\s*", "\n", text)  # 压缩相邻空行
+    text = re.sub(r"[ \t]{2,}", " ", text)  # 连续空格→单空格
+    return text.strip()
+
+
+def _getText(node, tag: str, default: str = "") -> str:
+    """安全读取子节点文本，避免 .text 为 None 报错"""
+    child = node.find(tag) if node is not None else None
+    return child.text.strip() if child is not None and child.text else default
+
+
+def parseMailDetail(source: Source, include: Optional[Iterable[str]] = None) -> MailDetail:
+    """
+    解析单封邮件的元数据；根节点的直接子元素处理完即释放
+
+    include 为 MAIL_DETAIL_FIELDS 的子集时只解析这些部分（mail_id / subject / sent_date 总是解析），
+    其余部分保持默认值（空列表 / 空字符串），如只需要附件时 include=("attachments",)
+    """
+    include = MAIL_DETAIL_FIELDS if include is None else frozenset(include)
+    unknown = include - MAIL_DETAIL_FIELDS
+    if unknown:
+        raise ValueError(f"Unknown mail detail fields: {sorted(unknown)}")
+    mail_id: Optional[str] = None
+    fields: dict[str, str] = {}
+    attachments: list[RegisteredDocumentAttachment] = []
+    recipients: list[Recipient] = []
+    from_user_details = FromUserDetails(name="", organization_name="")
+
+    depth = 0
+    for event, elem in _events(source):
+        if event == "start":
+            if depth == 0:
+                mail_id = elem.attrib.get("MailId")
+            depth += 1
+            continue
+        depth -= 1
+        if depth != 1:
+            continue
+        if elem.tag == "Attachments" and "attachments" in include:
+            # ----- 附件列表 -----
+            attachments = [RegisteredDocumentAttachment(attachment_id=a.attrib.get("attachmentId"),
+                                                        document_no=_getText(a, "DocumentNo"),
+                                                        file_name=_getText(a, "FileName"),
+                                                        file_size=_getText(a, "FileSize"),
+                                                        title=_getText(a, "Title"),
+                                                        revision=_getText(a, "Revision"),
+                                                        document_id=_getText(a, "DocumentId"),
+                                                        ) for a in elem]
+        elif elem.tag == "ToUsers" and "recipients" in include:
+            # ----- 收件人列表 -----
+            recipients = [Recipient(name=_getText(r, "Name"), organization_name=_getText(r, "OrganizationName"), )
+                          for r in elem]
+        elif elem.tag == "FromUserDetails" and "from_user_details" in include:
+            # ----- 发件人 -----
+            from_user_details = FromUserDetails(name=_getText(elem, "Name"),
+                                                organization_name=_getText(elem, "OrganizationName"), )
+        elif elem.tag in ("Subject", "SentDate") or (elem.tag == "MailData" and "mail_data" in include):
+            fields[elem.tag] = elem.text.strip() if elem.text else ""
+        _release(elem)
+
+    # ----- 组装 MailDetail -----
+    return MailDetail(mail_id=mail_id, subject=fields.get("Subject", ""),
+                      sent_date=parseDatetime(fields.get("SentDate")),
+                      mail_data=fields.get("MailData", ""), from_user_details=from_user_details,
+                      attachments=attachments, recipients=recipients, )